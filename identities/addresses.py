@@ -0,0 +1,30 @@
+"""
+Canonical forms of addresses, so that the same address sent in different
+formats finds the same identities. Msisdns are normalized to E.164 with a
+leading "+", with national numbers (starting with a single 0) given the
+country code MSISDN_DEFAULT_COUNTRY_CODE. Other address types are compared
+as they are.
+"""
+from django.conf import settings
+
+from . import bloom
+
+
+def normalize_msisdn(msisdn, country_code=None):
+    """
+    The E.164 form of an msisdn, for example "+27821234567" for
+    "+27 82 123 4567", "0027821234567", "27821234567" or, with a default
+    country code of 27, "0821234567". Values that aren't phone numbers are
+    returned unchanged.
+    """
+    if country_code is None:
+        country_code = settings.MSISDN_DEFAULT_COUNTRY_CODE
+    # The rules live in bloom, which clients copy, so that filter lookups
+    # normalize exactly as the store does
+    return bloom.normalize_msisdn(msisdn, country_code)
+
+
+def normalize_address(address_type, address):
+    if address_type == 'msisdn':
+        return normalize_msisdn(address)
+    return address
@@ -1,29 +1,147 @@
+import uuid
+
+from django.conf import settings
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+from .addresses import normalize_address
+from .estimates import planner_count
+from .models import (Identity, OptOut, OptIn, FailedHookDelivery,
+                     IdentityAddress)
+from .tasks import replay_failed_deliveries
+
+
+class EstimatedCountPaginator(Paginator):
+
+    """ Takes the query planner's row estimate as the count when it is over
+        ADMIN_EXACT_COUNT_LIMIT, so that large changelists don't wait on an
+        exact COUNT(*). Smaller results are counted exactly.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        estimate = planner_count(queryset, queryset.db)
+        if estimate > settings.ADMIN_EXACT_COUNT_LIMIT:
+            return estimate
+        return queryset.count()
+
+
+class AddressTypeFilter(admin.SimpleListFilter):
+
+    """ Lists the ADDRESS_TYPES instead of looking for every distinct address
+        type in the table.
+    """
+    title = "address type"
+    parameter_name = "address_type"
+
+    def lookups(self, request, model_admin):
+        return [(address_type, address_type)
+                for address_type in settings.ADDRESS_TYPES]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(address_type=self.value())
+        return queryset
+
 
-from .models import Identity, OptOut, OptIn
+def address_q(term, field='address', normalize=False):
+    """
+    Matches `term` as an address of any of the ADDRESS_TYPES, in the form
+    the (address type, address) indexes can be used for.
+    """
+    query = Q()
+    for address_type in settings.ADDRESS_TYPES:
+        address = term
+        if normalize:
+            address = normalize_address(address_type, term)
+        query |= Q(**{'address_type': address_type, field: address})
+    return query
 
 
-class IdentityAdmin(admin.ModelAdmin):
+class ScalableAdmin(admin.ModelAdmin):
+
+    """ Changelist defaults for tables with millions of rows: estimated
+        counts, no count of the unfiltered table and searches that match
+        whole identity ids or addresses so that they can use indexes.
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def search_addresses(self, queryset, term):
+        return queryset.filter(address_q(term))
+
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+        try:
+            identity_id = uuid.UUID(term)
+        except ValueError:
+            return self.search_addresses(queryset, term), False
+        return queryset.filter(**{self.identity_field: identity_id}), False
+
+
+class IdentityAdmin(ScalableAdmin):
     list_display = ["id", "created_at", "updated_at", "created_by",
                     "updated_by"]
     list_filter = ["created_at"]
+    list_select_related = ["created_by", "updated_by"]
+    raw_id_fields = ["communicate_through", "operator", "created_by",
+                     "updated_by"]
+    search_fields = ["=id"]
+    identity_field = "id"
+
+    def search_addresses(self, queryset, term):
+        addresses = IdentityAddress.objects.filter(
+            address_q(term, 'normalized_address', normalize=True))
+        return queryset.filter(id__in=addresses.values('identity_id'))
 
 
-class OptOutAdmin(admin.ModelAdmin):
-    list_display = ["id", "identity", "optout_type", "address_type", "address",
-                    "reason", "created_at", "created_by"]
-    list_filter = ["optout_type", "address_type", "reason", "created_at",
+class OptOutAdmin(ScalableAdmin):
+    list_display = ["id", "identity_uuid", "optout_type", "address_type",
+                    "address", "reason", "created_at", "created_by"]
+    list_filter = ["optout_type", AddressTypeFilter, "created_at",
                    "created_by"]
-    search_fields = ["identity__id", "address"]
+    list_select_related = ["created_by"]
+    raw_id_fields = ["identity", "created_by"]
+    search_fields = ["=identity__id", "=address"]
+    identity_field = "identity_id"
 
+    def identity_uuid(self, obj):
+        return obj.identity_id
+    identity_uuid.short_description = "identity"
 
-class OptInAdmin(admin.ModelAdmin):
-    list_display = ["id", "identity", "address_type", "address",
+
+class OptInAdmin(ScalableAdmin):
+    list_display = ["id", "identity_uuid", "address_type", "address",
                     "created_at", "created_by"]
-    list_filter = ["address_type", "created_at", "created_by"]
-    search_fields = ["identity__id", "address"]
+    list_filter = [AddressTypeFilter, "created_at", "created_by"]
+    list_select_related = ["created_by"]
+    raw_id_fields = ["identity", "created_by"]
+    search_fields = ["=identity__id", "=address"]
+    identity_field = "identity_id"
+
+    def identity_uuid(self, obj):
+        return obj.identity_id
+    identity_uuid.short_description = "identity"
+
+
+class FailedHookDeliveryAdmin(admin.ModelAdmin):
+    list_display = ["id", "target", "hook_id", "instance_id", "attempts",
+                    "error", "created_at"]
+    search_fields = ["=target"]
+    actions = ["replay"]
+
+    def replay(self, request, queryset):
+        count = replay_failed_deliveries(queryset)
+        self.message_user(request, "Queued %s deliveries." % count)
+    replay.short_description = "Replay selected deliveries"
 
 
 admin.site.register(Identity, IdentityAdmin)
 admin.site.register(OptOut, OptOutAdmin)
 admin.site.register(OptIn, OptInAdmin)
+admin.site.register(FailedHookDelivery, FailedHookDeliveryAdmin)
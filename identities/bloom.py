@@ -0,0 +1,152 @@
+"""
+A Bloom filter over addresses, for clients that want to check addresses
+without asking the identity store. A filter never says that an address it
+holds is absent, and says that an absent address is present at about the
+error rate it was sized for.
+
+This module doesn't depend on Django, so that clients can copy it and
+memory-map downloaded filters with `load`. Addresses are held in the
+canonical form the store uses, E.164 for msisdns; `contains_address`
+normalizes msisdns the way the store does, with the store's default country
+code, so that a national number is never missed.
+
+Filters are serialized as a header followed by the bit array:
+
+    magic "SIBF", format version (1 byte), hash count (1 byte),
+    bit count (8 bytes), address count (8 bytes), all big-endian,
+    default country code (4 bytes, ASCII digits padded with NULs)
+
+Bit i is bit (i % 8) of byte (i // 8). The hash count positions of a key
+come from double hashing the SHA-1 of "<address type>:<address>".
+"""
+import hashlib
+import math
+import mmap
+import re
+import struct
+
+
+MAGIC = b'SIBF'
+FORMAT_VERSION = 2
+HEADER = struct.Struct('>4sBBQQ4s')
+
+MSISDN_PUNCTUATION_RE = re.compile(r'[\s\-\.\(\)/]')
+
+DIGITS_RE = re.compile(r'^\d+$')
+
+
+def normalize_msisdn(msisdn, country_code):
+    """
+    The E.164 form of an msisdn, for example "+27821234567" for
+    "+27 82 123 4567", "0027821234567", "27821234567" or, with a country
+    code of "27", "0821234567". Values that aren't phone numbers are
+    returned unchanged.
+    """
+    number = MSISDN_PUNCTUATION_RE.sub('', msisdn)
+    if number.startswith('+'):
+        number = number[1:]
+    elif number.startswith('00'):
+        number = number[2:]
+    elif number.startswith('0'):
+        if not country_code:
+            return msisdn
+        number = country_code + number[1:]
+    if not DIGITS_RE.match(number):
+        return msisdn
+    return '+' + number
+
+
+def key(address_type, address):
+    return ('%s:%s' % (address_type, address)).encode('utf-8')
+
+
+def positions(item, hashes, bits):
+    digest = hashlib.sha1(item).digest()
+    h1, h2 = struct.unpack('>QQ', digest[:16])
+    h2 |= 1
+    return [(h1 + i * h2) % bits for i in range(hashes)]
+
+
+def byte_at(buffer, index):
+    value = buffer[index]
+    # Python 2 buffers give one character strings
+    return value if isinstance(value, int) else ord(value)
+
+
+class BloomFilter(object):
+
+    """ A Bloom filter of `bits` bits using `hashes` hash positions per key.
+        `data` is the bit array, which can be any buffer, such as a memory
+        map; a new zeroed one is made if it isn't given. `country_code` is
+        given to national msisdns checked with `contains_address`.
+    """
+
+    def __init__(self, bits, hashes, data=None, count=0, offset=0,
+                 country_code=''):
+        self.bits = bits
+        self.hashes = hashes
+        self.count = count
+        self.offset = offset
+        self.country_code = country_code
+        if data is None:
+            data = bytearray((bits + 7) // 8)
+        self.data = data
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate, country_code=''):
+        """
+        An empty filter sized to hold `capacity` keys with a false positive
+        rate of `error_rate`.
+        """
+        capacity = max(capacity, 1)
+        bits = int(math.ceil(
+            -capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        hashes = max(1, int(round(bits / float(capacity) * math.log(2))))
+        return cls(bits, hashes, country_code=country_code)
+
+    def add(self, item):
+        for position in positions(item, self.hashes, self.bits):
+            self.data[self.offset + position // 8] |= 1 << (position % 8)
+        self.count += 1
+
+    def __contains__(self, item):
+        for position in positions(item, self.hashes, self.bits):
+            if not byte_at(self.data, self.offset + position // 8) & (
+                    1 << (position % 8)):
+                return False
+        return True
+
+    def contains_address(self, address_type, address):
+        if address_type == 'msisdn':
+            address = normalize_msisdn(address, self.country_code)
+        return key(address_type, address) in self
+
+    def to_bytes(self):
+        return HEADER.pack(MAGIC, FORMAT_VERSION, self.hashes, self.bits,
+                           self.count, self.country_code.encode('ascii')
+                           ) + bytes(self.data)
+
+    @classmethod
+    def from_buffer(cls, buffer):
+        """
+        The filter in a serialized buffer, reading bits from the buffer
+        itself rather than copying them.
+        """
+        magic, version, hashes, bits, count, country_code = (
+            HEADER.unpack_from(buffer, 0))
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError("Not a version %s address filter" %
+                             FORMAT_VERSION)
+        if len(buffer) < HEADER.size + (bits + 7) // 8:
+            raise ValueError("Address filter is truncated")
+        return cls(bits, hashes, buffer, count, HEADER.size,
+                   country_code.rstrip(b'\0').decode('ascii'))
+
+
+def load(path):
+    """
+    Memory-maps the filter saved at `path`.
+    """
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return BloomFilter.from_buffer(buffer)
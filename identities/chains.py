@@ -0,0 +1,72 @@
+"""
+Walks the communicate_through and operator links between identities with
+recursive queries, so that a whole chain or the identities depending on one
+are read in one round trip instead of one request per hop. Walks stop at
+the depth limit and never revisit an identity, so cycles end them.
+"""
+from django.db import connections
+
+
+LINKS = {
+    'communicate_through': 'communicate_through_id',
+    'operator': 'operator_id',
+}
+
+CHAIN_SQL = """
+WITH RECURSIVE chain(id, next_id, depth, path) AS (
+    SELECT id, {link}, 0, ARRAY[id]
+    FROM identities_identity WHERE id = %s
+  UNION ALL
+    SELECT i.id, i.{link}, c.depth + 1, c.path || i.id
+    FROM chain c JOIN identities_identity i ON i.id = c.next_id
+    WHERE c.depth < %s AND NOT i.id = ANY(c.path)
+)
+SELECT id, depth, next_id FROM chain ORDER BY depth
+"""
+
+DEPENDENTS_SQL = """
+WITH RECURSIVE dependents(id, depth, path) AS (
+    SELECT id, 1, ARRAY[%s::uuid, id]
+    FROM identities_identity WHERE {link} = %s
+  UNION ALL
+    SELECT i.id, d.depth + 1, d.path || i.id
+    FROM dependents d JOIN identities_identity i ON i.{link} = d.id
+    WHERE d.depth < %s AND NOT i.id = ANY(d.path)
+)
+SELECT id, depth FROM dependents
+WHERE (depth, id) > (%s, %s::uuid)
+ORDER BY depth, id
+LIMIT %s
+"""
+
+# Sorts before every uuid, for the first page of dependents
+FIRST_ID = '00000000-0000-0000-0000-000000000000'
+
+
+def chain(identity_id, link, max_depth, using='default'):
+    """
+    The (id, depth) of the identity and the identities it links to in turn,
+    starting at depth 0, and whether the chain ended before the depth limit
+    or a cycle.
+    """
+    with connections[using].cursor() as cursor:
+        cursor.execute(CHAIN_SQL.format(link=LINKS[link]),
+                       [identity_id, max_depth])
+        rows = cursor.fetchall()
+    complete = not rows or rows[-1][2] is None
+    return [(row[0], row[1]) for row in rows], complete
+
+
+def dependents(identity_id, link, max_depth, limit, after=None,
+               using='default'):
+    """
+    Up to `limit` (id, depth) of the identities that link to the identity,
+    directly at depth 1 or through others, ordered by depth and id and
+    continuing after the (depth, id) `after`.
+    """
+    after_depth, after_id = after or (0, FIRST_ID)
+    with connections[using].cursor() as cursor:
+        cursor.execute(DEPENDENTS_SQL.format(link=LINKS[link]), [
+            identity_id, identity_id, max_depth, after_depth, after_id,
+            limit])
+        return cursor.fetchall()
@@ -0,0 +1,54 @@
+"""
+The change feed. Changes are read in (transaction id, id) order, and only
+from transactions older than the oldest one still running, so a change can
+never appear behind a cursor that has already been returned: every
+transaction that could still add one has finished.
+
+Cursors are "<transaction id>-<change id>" of the last change returned.
+"""
+from django.db import connections
+
+
+START = (0, 0)
+
+CHANGES_SQL = """
+SELECT id, txid, model_name, object_id, action, created_at
+FROM identities_change
+WHERE (txid, id) > (%s, %s)
+AND txid < txid_snapshot_xmin(txid_current_snapshot())
+ORDER BY txid, id
+LIMIT %s
+"""
+
+
+def parse_cursor(cursor):
+    """
+    The (transaction id, change id) of a cursor. Raises ValueError for
+    anything else.
+    """
+    txid, change_id = cursor.split('-')
+    position = (int(txid), int(change_id))
+    if min(position) < 0:
+        raise ValueError("Cursors can't be negative")
+    return position
+
+
+def format_cursor(position):
+    return '%s-%s' % position
+
+
+def changes_since(position, limit, using='default'):
+    """
+    Up to `limit` committed changes after the (transaction id, change id)
+    `position`, as dictionaries with the cursor that continues after each.
+    """
+    with connections[using].cursor() as cursor:
+        cursor.execute(CHANGES_SQL, [position[0], position[1], limit])
+        rows = cursor.fetchall()
+    return [{
+        "cursor": format_cursor((txid, change_id)),
+        "model": model_name,
+        "id": object_id,
+        "action": action,
+        "created_at": created_at.isoformat(),
+    } for change_id, txid, model_name, object_id, action, created_at in rows]
@@ -0,0 +1,383 @@
+"""
+Webhook delivery shared by the DeliverHook task and the deliver_hooks
+worker. The worker claims HookDelivery records in batches and keeps many
+POSTs in flight at once on a thread pool, so that a process isn't tied up
+for the whole round trip of a single delivery.
+
+Each hook target gets its own lane: claims are shared out between the
+targets with due deliveries round-robin, weighted by HOOK_TARGET_WEIGHTS
+and capped at HOOK_TARGET_CONCURRENCY in flight per target, so a backlog
+for one target doesn't hold up delivery to the others.
+
+Failed deliveries are retried with exponential backoff and moved to
+FailedHookDelivery once HOOK_MAX_RETRIES is used up. A circuit breaker per
+target fails deliveries fast while that target keeps failing.
+"""
+import hashlib
+import time
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+
+from .hooks import decode_body
+from .models import HookDelivery, FailedHookDelivery
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+def hook_headers(content_encoding=None):
+    headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Token %s' % settings.HOOK_AUTH_TOKEN
+    }
+    if content_encoding is not None:
+        headers['Content-Encoding'] = content_encoding
+    return headers
+
+
+def post_hook(target, body, session=None, content_encoding=None):
+    """
+    POSTs a payload encoded by encode_body to a hook target.
+    """
+    return (session or requests).post(
+        url=target,
+        data=decode_body(body, content_encoding),
+        headers=hook_headers(content_encoding),
+        timeout=settings.HOOK_TIMEOUT
+    )
+
+
+def retry_delay(attempts):
+    """
+    Seconds to wait before retrying a delivery that has failed `attempts`
+    times.
+    """
+    return min(settings.HOOK_RETRY_BACKOFF * 2 ** (attempts - 1),
+               settings.HOOK_RETRY_BACKOFF_MAX)
+
+
+class CircuitBreaker(object):
+
+    """ Counts consecutive failures for a hook target in the cache. After
+        HOOK_BREAKER_THRESHOLD failures the breaker opens and deliveries to
+        the target fail without a request for HOOK_BREAKER_COOLDOWN seconds,
+        after which a single delivery at a time is let through as a trial.
+
+        Failures are counted with atomic cache increments and the trial is
+        claimed with cache.add, so concurrent deliveries don't overwrite
+        each other's state. State is shared between processes only if the
+        default cache is.
+    """
+
+    def __init__(self, target):
+        key = 'hook-breaker:%s' % hashlib.md5(
+            target.encode('utf-8')).hexdigest()
+        self.failures_key = key + ':failures'
+        self.open_key = key + ':open-until'
+        self.trial_key = key + ':trial'
+
+    def allow(self):
+        open_until = cache.get(self.open_key)
+        if open_until is None:
+            return True
+        if open_until > time.time():
+            return False
+        # Held for as long as the trial request can take
+        return cache.add(self.trial_key, True, settings.HOOK_TIMEOUT)
+
+    def record_success(self):
+        cache.delete_many([self.failures_key, self.open_key, self.trial_key])
+
+    def record_failure(self):
+        cache.add(self.failures_key, 0, None)
+        try:
+            failures = cache.incr(self.failures_key)
+        except ValueError:
+            # Evicted between the add and the increment
+            cache.add(self.failures_key, 1, None)
+            failures = 1
+        if failures >= settings.HOOK_BREAKER_THRESHOLD:
+            cache.set(self.open_key,
+                      time.time() + settings.HOOK_BREAKER_COOLDOWN, None)
+            cache.delete(self.trial_key)
+
+
+def send_hook(target, body, session=None, content_encoding=None):
+    """
+    POSTs an encoded payload to a hook target through its circuit breaker.
+    Raises CircuitOpen, or a requests exception for failed requests and
+    non-2xx responses.
+    """
+    breaker = CircuitBreaker(target)
+    if not breaker.allow():
+        raise CircuitOpen("Circuit open for %s" % target)
+    try:
+        post_hook(target, body, session=session,
+                  content_encoding=content_encoding).raise_for_status()
+    except requests.exceptions.RequestException:
+        breaker.record_failure()
+        raise
+    breaker.record_success()
+
+
+def dead_letter(deliveries):
+    """
+    Stores deliveries that have used up their retries. Takes (delivery,
+    error) pairs, where the deliveries are HookDelivery instances or
+    anything with the same attributes.
+    """
+    FailedHookDelivery.objects.bulk_create([
+        FailedHookDelivery(
+            hook_id=delivery.hook_id, target=delivery.target,
+            body=delivery.body, content_encoding=delivery.content_encoding,
+            instance_id=delivery.instance_id,
+            attempts=delivery.attempts, error=str(error))
+        for delivery, error in deliveries])
+
+
+def fair_shares(depths, limit, weights=None, caps=None, order=None):
+    """
+    Splits up to `limit` claims between the targets in `depths`, a dict of
+    the number of due deliveries per target. Goes round-robin in `order`,
+    giving each target its weight (default 1) per round, until `limit` is
+    reached, each target's `caps` is reached or there is nothing left.
+    """
+    weights = weights or {}
+    caps = caps or {}
+    order = order or sorted(depths)
+    wanted = dict(
+        (target, max(min(depth, caps.get(target, depth)), 0))
+        for target, depth in depths.items())
+    shares = dict((target, 0) for target in depths)
+    while limit > 0:
+        claimed = 0
+        for target in order:
+            take = min(weights.get(target, 1),
+                       wanted[target] - shares[target], limit - claimed)
+            if take > 0:
+                shares[target] += take
+                claimed += take
+        if not claimed:
+            break
+        limit -= claimed
+    return shares
+
+
+def interleave(lanes):
+    """
+    Merges lists round-robin, one item from each list at a time.
+    """
+    merged = []
+    lanes = [list(lane) for lane in lanes]
+    while any(lanes):
+        for lane in lanes:
+            if lane:
+                merged.append(lane.pop(0))
+    return merged
+
+
+def queue_depths():
+    """
+    Pending, due and failed delivery counts per hook target.
+    """
+    now = timezone.now()
+    queues = {}
+
+    def count(queryset, field):
+        for row in queryset.values('target').annotate(count=Count('id')):
+            queue = queues.setdefault(row['target'], {
+                "target": row['target'], "pending": 0, "due": 0,
+                "failed": 0})
+            queue[field] = row['count']
+
+    count(HookDelivery.objects.order_by(), "pending")
+    count(HookDelivery.objects.filter(next_attempt_at__lte=now).order_by(),
+          "due")
+    count(FailedHookDelivery.objects.order_by(), "failed")
+    return [queues[target] for target in sorted(queues)]
+
+
+def attempt_delivery(delivery, session=None):
+    """
+    Sends a HookDelivery, or anything with the same attributes. Returns the
+    delivery and the error it failed with, if any. Safe to run on a thread
+    pool as it doesn't touch the database.
+    """
+    try:
+        send_hook(delivery.target, delivery.body, session=session,
+                  content_encoding=delivery.content_encoding)
+        return delivery, None
+    except Exception as e:
+        return delivery, e
+
+
+def deliver_all(deliveries, concurrency=None):
+    """
+    Sends the deliveries concurrently. Returns (delivery, error) pairs for
+    the deliveries that failed.
+    """
+    if not deliveries:
+        return []
+    concurrency = min(len(deliveries),
+                      concurrency or settings.HOOK_FANOUT_CONCURRENCY)
+    pool = ThreadPool(concurrency)
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=100, pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    try:
+        results = pool.map(
+            lambda delivery: attempt_delivery(delivery, session), deliveries)
+    finally:
+        pool.close()
+        pool.join()
+    return [(delivery, error) for delivery, error in results
+            if error is not None]
+
+
+class HookDeliveryWorker(object):
+
+    """ Delivers pending HookDelivery records with up to `concurrency`
+        requests in flight.
+    """
+
+    def __init__(self, concurrency=None, batch_size=None, lease=None,
+                 poll_interval=1.0):
+        self.concurrency = concurrency or settings.HOOK_WORKER_CONCURRENCY
+        self.batch_size = batch_size or settings.HOOK_WORKER_BATCH_SIZE
+        self.lease = timedelta(
+            seconds=lease or settings.HOOK_WORKER_LEASE)
+        self.poll_interval = poll_interval
+        self.in_flight = 0
+        self.in_flight_by_target = {}
+        self.lanes_claimed = 0
+        self.results = Queue()
+        self.pool = ThreadPool(self.concurrency)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=100,
+                              pool_maxsize=self.concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def claim(self, limit):
+        """
+        Reserves up to `limit` deliveries that are due for this worker,
+        shared fairly between the targets' lanes.
+        """
+        now = timezone.now()
+        due = HookDelivery.objects.filter(next_attempt_at__lte=now)
+        depths = dict(
+            (row['target'], row['count'])
+            for row in due.order_by().values('target').annotate(
+                count=Count('id')))
+        if not depths:
+            return []
+
+        # Start each round with the lane after the one that started the
+        # previous round
+        order = sorted(depths)
+        start = self.lanes_claimed % len(order)
+        order = order[start:] + order[:start]
+        self.lanes_claimed += 1
+
+        caps = dict(
+            (target, settings.HOOK_TARGET_CONCURRENCY -
+             self.in_flight_by_target.get(target, 0))
+            for target in depths)
+        shares = fair_shares(depths, limit, settings.HOOK_TARGET_WEIGHTS,
+                             caps, order)
+
+        lanes = []
+        with transaction.atomic():
+            for target in order:
+                if shares[target]:
+                    lanes.append(list(
+                        due.select_for_update().filter(target=target)
+                        .order_by('next_attempt_at')[:shares[target]]))
+            deliveries = interleave(lanes)
+            HookDelivery.objects.filter(
+                id__in=[d.id for d in deliveries]).update(
+                    next_attempt_at=now + self.lease)
+        return deliveries
+
+    def submit(self, delivery):
+        self.in_flight += 1
+        self.in_flight_by_target[delivery.target] = (
+            self.in_flight_by_target.get(delivery.target, 0) + 1)
+        self.pool.apply_async(attempt_delivery, (delivery, self.session),
+                              callback=self.results.put)
+
+    def collect(self, timeout):
+        """
+        Waits up to `timeout` seconds for at least one delivery to finish,
+        then returns all the finished deliveries.
+        """
+        finished = []
+        try:
+            finished.append(self.results.get(timeout=timeout))
+            while True:
+                finished.append(self.results.get_nowait())
+        except Empty:
+            pass
+        self.in_flight -= len(finished)
+        for delivery, error in finished:
+            self.in_flight_by_target[delivery.target] -= 1
+        return finished
+
+    def finish(self, finished):
+        done = [d.id for d, error in finished if error is None]
+        exhausted = []
+        now = timezone.now()
+        with transaction.atomic():
+            for delivery, error in finished:
+                if error is None:
+                    continue
+                delivery.attempts += 1
+                if delivery.attempts > settings.HOOK_MAX_RETRIES:
+                    exhausted.append((delivery, error))
+                    done.append(delivery.id)
+                else:
+                    HookDelivery.objects.filter(id=delivery.id).update(
+                        attempts=delivery.attempts,
+                        next_attempt_at=now + timedelta(
+                            seconds=retry_delay(delivery.attempts)))
+            if exhausted:
+                dead_letter(exhausted)
+            if done:
+                HookDelivery.objects.filter(id__in=done).delete()
+
+    def run(self, until_empty=False):
+        """
+        Delivers forever, or with `until_empty` until nothing is due.
+        """
+        while True:
+            claimed = []
+            free = self.concurrency - self.in_flight
+            if free > 0:
+                claimed = self.claim(min(free, self.batch_size))
+                for delivery in claimed:
+                    self.submit(delivery)
+            if self.in_flight:
+                self.finish(self.collect(timeout=self.poll_interval))
+            elif until_empty:
+                break
+            elif not claimed:
+                time.sleep(self.poll_interval)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
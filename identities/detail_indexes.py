@@ -0,0 +1,106 @@
+"""
+Expression indexes for the detail keys in INDEXED_DETAIL_KEYS, and the
+rewriting of search filters on those keys into the same expressions so that
+Postgres can use the indexes. Numeric and date values are read with the
+identities_to_numeric and identities_to_date functions, which return NULL
+for values that don't convert instead of failing.
+"""
+import re
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+INDEX_PREFIX = 'identities_detail_'
+
+KEY_RE = re.compile(r'^\w{1,40}$')
+
+EXPRESSIONS = {
+    'text': "(details->>%s)",
+    'numeric': "identities_to_numeric(details->>%s)",
+    'date': "identities_to_date(details->>%s)",
+}
+
+OPERATORS = {
+    'exact': '=',
+    'gt': '>',
+    'gte': '>=',
+    'lt': '<',
+    'lte': '<=',
+}
+
+
+def indexed_keys():
+    """
+    The declared detail keys and their types.
+    """
+    keys = settings.INDEXED_DETAIL_KEYS
+    for key, key_type in keys.items():
+        if not KEY_RE.match(key) or key_type not in EXPRESSIONS:
+            raise ImproperlyConfigured(
+                "Invalid INDEXED_DETAIL_KEYS entry %s: %s" % (key, key_type))
+    return keys
+
+
+def index_name(key, key_type):
+    return '%s%s_%s' % (INDEX_PREFIX, key, key_type)
+
+
+def create_index_sql(key, key_type):
+    return (
+        "CREATE INDEX CONCURRENTLY %s "
+        "ON identities_identity (%s)" % (
+            index_name(key, key_type),
+            EXPRESSIONS[key_type] % ("'%s'" % key)))
+
+
+def convert(value, key_type):
+    """
+    Converts a search value for a key of the given type. Raises ValueError
+    if it can't be.
+    """
+    if key_type == 'numeric':
+        try:
+            return Decimal(value)
+        except InvalidOperation:
+            raise ValueError("'%s' is not a number" % value)
+    if key_type == 'date':
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    return value
+
+
+def split_indexed_filter(name):
+    """
+    The key, type and operator of a filter such as details__dob__gte on an
+    indexed key, or None for any other filter.
+    """
+    parts = name.split('__')
+    if parts[0] != 'details' or len(parts) not in (2, 3):
+        return None
+    key = parts[1]
+    lookup = parts[2] if len(parts) == 3 else 'exact'
+    key_type = indexed_keys().get(key)
+    if key_type is None or lookup not in OPERATORS:
+        return None
+    return key, key_type, OPERATORS[lookup]
+
+
+def filter_identities(queryset, filter_criteria):
+    """
+    Applies search filter criteria to an identity queryset, with filters on
+    indexed keys written as the indexes' expressions. Raises ValueError for
+    values that don't suit the key's type.
+    """
+    remaining = {}
+    for name, value in filter_criteria.items():
+        indexed = split_indexed_filter(name)
+        if indexed is None:
+            remaining[name] = value
+            continue
+        key, key_type, operator = indexed
+        queryset = queryset.extra(
+            where=["%s %s %%s" % (EXPRESSIONS[key_type], operator)],
+            params=[key, convert(value, key_type)])
+    return queryset.filter(**remaining)
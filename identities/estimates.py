@@ -0,0 +1,91 @@
+"""
+Approximate counts of identity querysets, for dashboards that need them
+faster than an exact count can scan the table. Neither estimate reads more
+than a count back from the database.
+"""
+import json
+import math
+
+from django.db import connections
+from django.db.models.sql.datastructures import BaseTable
+
+from .models import IdentityAddress
+
+
+class SampledTable(BaseTable):
+
+    """ A query's base table, read through a Bernoulli sample of `percent`
+        percent of its rows.
+    """
+
+    def __init__(self, table_name, alias, percent):
+        super(SampledTable, self).__init__(table_name, alias)
+        self.percent = percent
+
+    def as_sql(self, compiler, connection):
+        sql, params = super(SampledTable, self).as_sql(compiler, connection)
+        return sql + " TABLESAMPLE BERNOULLI (%s)", params + [self.percent]
+
+    def relabeled_clone(self, change_map):
+        return self.__class__(
+            self.table_name,
+            change_map.get(self.table_alias, self.table_alias), self.percent)
+
+
+def exclude_inactive(queryset, addresses):
+    """
+    Excludes identities where any of the (address type, address) pairs is
+    flagged as inactive, in any of the address's formats.
+    """
+    for address_type, address in addresses:
+        queryset = queryset.exclude(id__in=IdentityAddress.objects.lookup(
+            address_type, address).filter(inactive=True).values(
+            'identity_id'))
+    return queryset
+
+
+def queryset_sql(queryset):
+    return queryset.order_by().values('pk').query.sql_with_params()
+
+
+def query_plan(queryset, using='default'):
+    """
+    The query planner's top plan node for the queryset.
+    """
+    sql, params = queryset_sql(queryset)
+    with connections[using].cursor() as cursor:
+        cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+        plan = cursor.fetchone()[0]
+    if not isinstance(plan, list):
+        plan = json.loads(plan)
+    return plan[0]["Plan"]
+
+
+def planner_count(queryset, using='default'):
+    """
+    The number of rows the query planner expects the queryset to return.
+    """
+    return int(query_plan(queryset, using)["Plan Rows"])
+
+
+def sample_count(queryset, percent, using='default'):
+    """
+    Estimates the size of the queryset by counting it over a Bernoulli
+    sample of `percent` percent of the table. Returns the estimate and its
+    margin of error at 95% confidence.
+    """
+    query = queryset.order_by().query.clone()
+    alias = query.get_initial_alias()
+    query.alias_map[alias] = SampledTable(
+        query.alias_map[alias].table_name, alias, float(percent))
+    matches = query.get_count(using=using)
+
+    # Each matching row is in the sample with probability p, so the number
+    # of matches in the sample is binomial and the estimate is matches / p
+    p = percent / 100.0
+    if matches:
+        error = 1.96 * math.sqrt(matches * (1 - p)) / p
+    else:
+        # Nothing matched: the rule of three bounds the count at 95%
+        error = 3 / p
+    return int(round(matches / p)), int(math.ceil(error))
@@ -0,0 +1,115 @@
+"""
+Value counts for top-level detail keys. The keys in FACETED_DETAIL_KEYS are
+counted in DetailFacetCount as identities are saved and deleted, any other
+key is counted with a GROUP BY when asked for.
+
+Values are counted as the text Postgres gives for `details->>key`, so that
+the maintained counts and the GROUP BY agree.
+"""
+import json
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.utils import six
+
+
+MISSING = object()
+
+
+def jsonb_key(key):
+    # jsonb orders object keys by their length in bytes, then bytewise
+    key = key.encode('utf-8')
+    return len(key), key
+
+
+def jsonb_text(value):
+    """
+    The text of a JSON value as Postgres renders jsonb: object keys in jsonb
+    order, ", " and ": " separators, non-ASCII characters unescaped and
+    numbers in numeric's notation.
+    """
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, six.integer_types):
+        return six.text_type(value)
+    if isinstance(value, float):
+        return format(Decimal(repr(value)), 'f')
+    if isinstance(value, dict):
+        return '{%s}' % ', '.join(
+            '%s: %s' % (jsonb_text(key), jsonb_text(value[key]))
+            for key in sorted(value, key=jsonb_key))
+    if isinstance(value, (list, tuple)):
+        return '[%s]' % ', '.join(jsonb_text(item) for item in value)
+    return json.dumps(six.text_type(value), ensure_ascii=False)
+
+
+def facet_value(value):
+    """
+    The text of a detail value, as `details->>key` returns it.
+    """
+    if value is None:
+        return None
+    if isinstance(value, six.string_types):
+        return value
+    return jsonb_text(value)
+
+
+def facet_values(details):
+    """
+    The faceted keys present in an identity's details and their values.
+    """
+    if not isinstance(details, dict):
+        return {}
+    return dict(
+        (key, facet_value(details[key]))
+        for key in settings.FACETED_DETAIL_KEYS if key in details)
+
+
+def changed_facets(old, new):
+    """
+    The (key, value, delta) changes to the counts when an identity's facet
+    values go from `old` to `new`.
+    """
+    changes = []
+    for key in set(old) | set(new):
+        before, after = old.get(key, MISSING), new.get(key, MISSING)
+        if before == after:
+            continue
+        if before is not MISSING:
+            changes.append((key, before, -1))
+        if after is not MISSING:
+            changes.append((key, after, 1))
+    return changes
+
+
+def query_facet(key, using='default'):
+    """
+    Counts the values of a detail key with a GROUP BY over all identities.
+    """
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            "SELECT details->>%s, COUNT(*) FROM identities_identity "
+            "WHERE details ? %s GROUP BY 1", [key, key])
+        return cursor.fetchall()
+
+
+def rebuild_detail_facets(keys, using='default'):
+    """
+    Recounts the values of the detail keys from scratch, in a transaction
+    so that the counts are never seen half rebuilt.
+    """
+    with transaction.atomic(using=using):
+        with connections[using].cursor() as cursor:
+            for key in keys:
+                cursor.execute(
+                    "DELETE FROM identities_detailfacetcount "
+                    "WHERE key_name = %s", [key])
+                cursor.execute(
+                    "INSERT INTO identities_detailfacetcount "
+                    "(key_name, value, count) "
+                    "SELECT %s, details->>%s, COUNT(*) "
+                    "FROM identities_identity "
+                    "WHERE details ? %s GROUP BY 2", [key, key, key])
@@ -0,0 +1,137 @@
+"""
+Guards against expensive search and filter queries. Each guarded endpoint
+runs its queries with a statement_timeout and, when a maximum cost is set,
+has the planner's estimate for its query checked first. Queries over the
+cost are rejected or, with the "replica" policy, moved off the primary to a
+replica. Rejections and downgrades are fired as metrics.
+
+The defaults come from QUERY_STATEMENT_TIMEOUT, QUERY_MAX_COST and
+QUERY_OVER_COST, and can be overridden per endpoint in QUERY_GUARDS.
+"""
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import OperationalError, connections, router, transaction
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.response import Response
+
+from seed_identity_store import routers
+from .estimates import query_plan
+
+# SQLSTATE of statements cancelled by statement_timeout
+QUERY_CANCELED = '57014'
+
+
+class QueryTooExpensive(APIException):
+    status_code = status.HTTP_400_BAD_REQUEST
+    default_detail = ("This query is too expensive to run. Narrow it down "
+                      "with more specific filters.")
+
+
+def query_guard(name):
+    """
+    The statement timeout in milliseconds, maximum cost and over cost policy
+    for the endpoint `name`.
+    """
+    guard = {
+        "timeout": settings.QUERY_STATEMENT_TIMEOUT,
+        "max_cost": settings.QUERY_MAX_COST,
+        "over_cost": settings.QUERY_OVER_COST,
+    }
+    guard.update(settings.QUERY_GUARDS.get(name, {}))
+    return guard
+
+
+def fire_guard_metric(metric_name):
+    from .tasks import fire_metric, queue_task
+    queue_task(fire_metric, {
+        "metric_name": metric_name,
+        "metric_value": 1.0
+    })
+
+
+def reject(detail=None):
+    fire_guard_metric('identities.query.rejected.sum')
+    return QueryTooExpensive(detail)
+
+
+def estimated_cost(queryset, using='default'):
+    return float(query_plan(queryset, using)["Total Cost"])
+
+
+def check_cost(queryset, guard, using='default'):
+    """
+    The database to run the queryset on. Raises QueryTooExpensive if the
+    planner's estimate is over the guard's maximum cost and it can't be
+    moved to a replica.
+    """
+    if not guard["max_cost"]:
+        return using
+    cost = estimated_cost(queryset, using)
+    if cost <= guard["max_cost"]:
+        return using
+    detail = ("This query's estimated cost of %.0f is over the limit of "
+              "%.0f. Narrow it down with more specific filters." % (
+                  cost, guard["max_cost"]))
+    if guard["over_cost"] != 'replica':
+        raise reject(detail)
+    if using in settings.REPLICA_DATABASES:
+        return using
+    replica = routers.choose_replica()
+    if replica is None:
+        raise reject(detail)
+    fire_guard_metric('identities.query.downgraded.sum')
+    return replica
+
+
+@contextmanager
+def statement_timeout(using, timeout):
+    """
+    Runs the block in a transaction on `using` that is cancelled after
+    `timeout` milliseconds, raising QueryTooExpensive instead. The previous
+    timeout is restored afterwards in case the block is part of a larger
+    transaction.
+    """
+    if not timeout:
+        yield
+        return
+    try:
+        with transaction.atomic(using=using):
+            with connections[using].cursor() as cursor:
+                cursor.execute("SHOW statement_timeout")
+                previous = cursor.fetchone()[0]
+                cursor.execute("SET LOCAL statement_timeout = %s",
+                               [int(timeout)])
+            yield
+            with connections[using].cursor() as cursor:
+                cursor.execute("SET LOCAL statement_timeout = %s",
+                               [previous])
+    except OperationalError as e:
+        cause = getattr(e, '__cause__', None)
+        if getattr(cause, 'pgcode', None) != QUERY_CANCELED:
+            raise
+        raise reject("This query took longer than %sms. Narrow it down "
+                     "with more specific filters." % timeout)
+
+
+class QueryGuardMixin(object):
+
+    """ Lists a view's queryset under the query guard named by `guard_name`.
+    """
+    guard_name = None
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        guard = query_guard(self.guard_name)
+        using = check_cost(
+            queryset, guard, router.db_for_read(queryset.model))
+
+        with statement_timeout(using, guard["timeout"]):
+            queryset = queryset.using(using)
+            page = self.paginate_queryset(queryset)
+            if page is not None:
+                serializer = self.get_serializer(page, many=True)
+                return self.get_paginated_response(serializer.data)
+            serializer = self.get_serializer(queryset, many=True)
+            return Response(serializer.data)
@@ -0,0 +1,184 @@
+"""
+Webhook events and payload encoding. An event's payload is encoded once per
+payload format, however many hooks it's delivered to, and the encoded body
+is what goes through the broker to DeliverHook.
+"""
+import base64
+import gzip
+import io
+import json
+import re
+
+from django.conf import settings
+from rest_hooks.signals import raw_hook_event
+
+
+def encode_body(data, compress=False):
+    """
+    Returns the JSON body for a payload and its content encoding. Gzipped
+    bodies are base64 encoded so that they can go through the JSON broker.
+    """
+    body = json.dumps(data)
+    if not compress:
+        return body, None
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(body.encode('utf-8'))
+    return base64.b64encode(buf.getvalue()).decode('ascii'), 'gzip'
+
+
+def decode_body(body, content_encoding=None):
+    """
+    Returns the bytes to POST for a body from encode_body.
+    """
+    if content_encoding == 'gzip':
+        return base64.b64decode(body)
+    return body
+
+
+class HookPayload(dict):
+    """
+    A hook event payload that also carries its compact form, holding only
+    ids, the event and the fields that changed. Caches its encodings.
+    """
+
+    def __init__(self, payload, compact):
+        super(HookPayload, self).__init__(payload)
+        self.compact = compact
+        self._encoded = {}
+
+    def encode(self, payload_format='full', compress=False):
+        key = (payload_format, compress)
+        if key not in self._encoded:
+            data = self.compact if payload_format == 'compact' else dict(self)
+            self._encoded[key] = encode_body(data, compress)
+        return self._encoded[key]
+
+
+FILTER_TOKEN_RE = re.compile(
+    r"""\s*('[^']*'|"[^"]*"|==|!=|\(|\)|,|[^\s(),'"=!]+)""")
+
+FILTER_FIELD_RE = re.compile(r'^\w+(\.\w+)*$')
+
+_filters = {}
+
+
+def tokenize_filter(expression):
+    tokens = []
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = FILTER_TOKEN_RE.match(expression, position)
+        if match is None:
+            raise ValueError("Unexpected '%s' in filter" %
+                             expression[position:].strip())
+        tokens.append(match.group(1))
+        position = match.end()
+    return tokens
+
+
+def unquote(token):
+    if token[:1] in ("'", '"'):
+        return token[1:-1]
+    if token in ('(', ')', ',', '==', '!='):
+        raise ValueError("Expected a value, found '%s'" % token)
+    return token
+
+
+def parse_filter(expression):
+    """
+    Parses a filter expression such as
+    `optout_type in (stop, stopall) and optout_address_type == msisdn` into
+    a list of (field path, operator, values) clauses. Fields are dotted
+    paths into the payload and values may be quoted. Raises ValueError for
+    invalid expressions.
+    """
+    if expression not in _filters:
+        try:
+            clauses = _parse_clauses(tokenize_filter(expression))
+        except IndexError:
+            raise ValueError("Incomplete filter")
+        _filters[expression] = clauses
+    return _filters[expression]
+
+
+def _parse_clauses(tokens):
+    clauses = []
+    while tokens:
+        if clauses:
+            if tokens.pop(0).lower() != 'and':
+                raise ValueError("Clauses must be joined with 'and'")
+        if len(tokens) < 3:
+            raise ValueError("Expected '<field> <operator> <value>'")
+        field = tokens.pop(0)
+        if not FILTER_FIELD_RE.match(field):
+            raise ValueError("Invalid field '%s'" % field)
+        operator = tokens.pop(0).lower()
+        if operator == 'not' and tokens[0].lower() == 'in':
+            tokens.pop(0)
+            operator = 'not in'
+        if operator in ('==', '!='):
+            values = [unquote(tokens.pop(0))]
+        elif operator in ('in', 'not in'):
+            if tokens.pop(0) != '(' or ')' not in tokens:
+                raise ValueError("Expected a list of values like (a, b)")
+            end = tokens.index(')')
+            values = [unquote(t) for t in tokens[:end] if t != ',']
+            del tokens[:end + 1]
+        else:
+            raise ValueError("Unknown operator '%s'" % operator)
+        clauses.append((field.split('.'), operator, values))
+    return clauses
+
+
+def payload_value(payload, path):
+    """
+    The value at a dotted path in the payload as text, or None.
+    """
+    value = payload
+    for key in path:
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if value is None or isinstance(value, (dict, list)):
+        return None
+    return '%s' % (value,)
+
+
+def filter_matches(expression, payload):
+    """
+    Whether the payload matches every clause of the filter expression.
+    """
+    for path, operator, values in parse_filter(expression):
+        matched = payload_value(payload, path) in values
+        if matched != (operator in ('==', 'in')):
+            return False
+    return True
+
+
+def send_hook_event(event_name, payload, user, instance_id=None):
+    """
+    Sends a HookPayload to the user's hooks for the event. With HOOK_FANOUT
+    a single task delivers it to all the hooks, otherwise rest_hooks passes
+    it to HOOK_DELIVERER once per hook. `instance_id` is the id of the
+    instance that triggered the event, kept with fan-out deliveries.
+    """
+    if settings.HOOK_FANOUT:
+        from .tasks import fan_out_hook_event, queue_task
+        queue_task(fan_out_hook_event, {
+            "event_name": event_name,
+            "payload": dict(payload),
+            "compact": payload.compact,
+            "user_id": user.id if user is not None else None,
+            "instance_id": instance_id
+        })
+    else:
+        raw_hook_event.send(
+            sender=None,
+            event_name=event_name,
+            payload=payload,
+            user=user,
+            send_hook_meta=False
+        )
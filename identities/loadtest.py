@@ -0,0 +1,200 @@
+"""
+Helpers for benchmarking the identity store: local stand-ins for the
+webhook and metrics endpoints, with configurable latency, errors and slow
+consumers, and per-operation measurements of wall time, memory allocations
+and database queries.
+"""
+import json
+import random
+import threading
+import time
+import timeit
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2 has no allocation tracing
+    tracemalloc = None
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+
+    """ Accepts any POST and answers with an empty JSON object, after the
+        server's latency and with its error rate
+    """
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        data = self.rfile.read(length)
+        delay = self.server.response_delay()
+        if delay:
+            time.sleep(delay)
+        status = 500 if self.server.should_fail() else 200
+        self.server.record_request(self.path, data, status)
+        body = json.dumps({}).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+
+    """ A local HTTP server standing in for webhook targets and the
+        go-metrics API. Binds to a free port on localhost by default.
+
+        Every response takes `latency` seconds and fails with a 500 at
+        `error_rate`. A `slow_rate` fraction of requests stand in for a slow
+        consumer and take `slow_latency` seconds more. With `timestamp_key`
+        set, successful requests with a JSON body holding a unix timestamp
+        under that key are used to measure end-to-end delays.
+    """
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, host='127.0.0.1', port=0,
+                 handler_class=StubRequestHandler, latency=0, error_rate=0,
+                 slow_rate=0, slow_latency=0, timestamp_key=None, seed=None):
+        HTTPServer.__init__(self, (host, port), handler_class)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.timestamp_key = timestamp_key
+        self.request_count = 0
+        self.error_count = 0
+        self.delays = []
+        self.first_request_at = None
+        self.last_request_at = None
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%s/' % self.server_address
+
+    def response_delay(self):
+        with self._lock:
+            slow = self._random.random() < self.slow_rate
+        return self.latency + (self.slow_latency if slow else 0)
+
+    def should_fail(self):
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def record_request(self, path, data=None, status=200):
+        now = time.time()
+        delay = None
+        if self.timestamp_key is not None and data and status < 400:
+            try:
+                delay = now - float(
+                    json.loads(data.decode('utf-8'))[self.timestamp_key])
+            except (ValueError, KeyError, TypeError):
+                pass
+        with self._lock:
+            self.request_count += 1
+            if status >= 400:
+                self.error_count += 1
+            if delay is not None:
+                self.delays.append(delay)
+            if self.first_request_at is None:
+                self.first_request_at = now
+            self.last_request_at = now
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+
+def percentile(values, pct):
+    """ Nearest-rank percentile of a list of numbers.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = int(round((len(ordered) - 1) * pct / 100.0))
+    return ordered[index]
+
+
+def summarise_latencies(timings):
+    """ Summary statistics, in milliseconds, for a list of timings that are
+        in milliseconds.
+    """
+    count = len(timings)
+    return {
+        "count": count,
+        "mean_ms": sum(timings) / count if count else 0.0,
+        "p50_ms": percentile(timings, 50),
+        "p95_ms": percentile(timings, 95),
+        "p99_ms": percentile(timings, 99),
+        "max_ms": max(timings) if count else 0.0,
+    }
+
+
+def measure(name, func, iterations=100, setup=None):
+    """ Measures `func` over `iterations` calls. `setup`, if given, is called
+        before every call and is not measured.
+
+        Timings, allocations and queries are taken in separate passes so
+        that allocation tracing and query capturing don't skew timings.
+    """
+    timings = []
+    for i in range(iterations):
+        if setup is not None:
+            setup()
+        start = timeit.default_timer()
+        func()
+        timings.append((timeit.default_timer() - start) * 1000.0)
+
+    allocated = None
+    if tracemalloc is not None:
+        peaks = []
+        tracemalloc.start()
+        try:
+            for i in range(iterations):
+                if setup is not None:
+                    setup()
+                tracemalloc.clear_traces()
+                func()
+                peaks.append(tracemalloc.get_traced_memory()[1])
+        finally:
+            tracemalloc.stop()
+        allocated = sum(peaks) / 1024.0 / iterations
+
+    queries = 0
+    for i in range(iterations):
+        if setup is not None:
+            setup()
+        with CaptureQueriesContext(connection) as context:
+            func()
+        queries += len(context.captured_queries)
+
+    result = summarise_latencies(timings)
+    result.update({
+        "name": name,
+        "iterations": iterations,
+        "allocated_kb": allocated,
+        "queries": float(queries) / iterations,
+    })
+    return result
@@ -0,0 +1,147 @@
+import copy
+import json
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test.utils import override_settings
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+from rest_hooks.models import Hook
+
+from seed_identity_store.celery import app
+from identities import loadtest
+from identities.models import Identity
+from identities.tasks import deliver_hook_wrapper, populate_detail_key
+from identities.views import IdentitySearchList
+
+
+IDENTITY_DETAILS = {
+    "name": "Benchmark Name",
+    "default_addr_type": "msisdn",
+    "personnel_code": "12345",
+    "addresses": {
+        "msisdn": {
+            "+27000000001": {}
+        },
+        "email": {
+            "bench1@example.org": {"default": True},
+            "bench2@example.org": {}
+        }
+    }
+}
+
+
+class Command(BaseCommand):
+    help = ("Runs micro-benchmarks of the model and task hot paths "
+            "in-process, against local stand-ins for the broker and the "
+            "metrics and webhook endpoints. Nothing is left in the database.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--iterations', type=int, default=100,
+            help='Number of calls to measure per operation')
+        parser.add_argument(
+            '--operation', action='append', dest='operations', default=[],
+            help='Only run the named operation (may be repeated)')
+        parser.add_argument(
+            '--json', action='store_true', default=False,
+            help='Output the results as JSON')
+
+    def handle(self, *args, **options):
+        webhook = loadtest.StubServer().start()
+        metrics = loadtest.StubServer().start()
+        always_eager = app.conf.CELERY_ALWAYS_EAGER
+        app.conf.CELERY_ALWAYS_EAGER = True
+        try:
+            with override_settings(METRICS_URL=metrics.url):
+                with transaction.atomic():
+                    results = self.run_benchmarks(
+                        webhook, options['iterations'],
+                        options['operations'])
+                    transaction.set_rollback(True)
+        finally:
+            app.conf.CELERY_ALWAYS_EAGER = always_eager
+            webhook.stop()
+            metrics.stop()
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+
+        self.stdout.write("%-40s %10s %10s %10s %12s %8s" % (
+            "operation", "mean ms", "p95 ms", "max ms", "alloc KiB",
+            "queries"))
+        for result in results:
+            allocated = result["allocated_kb"]
+            self.stdout.write("%-40s %10.3f %10.3f %10.3f %12s %8.1f" % (
+                result["name"], result["mean_ms"], result["p95_ms"],
+                result["max_ms"],
+                "n/a" if allocated is None else "%.1f" % allocated,
+                result["queries"]))
+
+    def run_benchmarks(self, webhook, iterations, operations):
+        user = User.objects.create_user('benchmark-hotpaths')
+        hook = Hook.objects.create(user=user, event='optout.requested',
+                                   target=webhook.url)
+        identity = Identity.objects.create(
+            details=copy.deepcopy(IDENTITY_DETAILS),
+            created_by=user, updated_by=user)
+
+        def reset_details():
+            identity.details = copy.deepcopy(IDENTITY_DETAILS)
+
+        search_request = Request(APIRequestFactory().get(
+            '/api/v1/identities/search/',
+            {'details__addresses__msisdn': '+27000000001'}))
+
+        def search():
+            view = IdentitySearchList()
+            view.request = search_request
+            view.kwargs = {}
+            return list(view.get_queryset())
+
+        payload = {
+            "identity": str(identity.id),
+            "identity_details": IDENTITY_DETAILS,
+            "optout_type": "stop",
+        }
+
+        benchmarks = [
+            ("Identity.optout_address",
+             lambda: identity.optout_address(
+                 "single", "msisdn", "+27000000001"),
+             reset_details),
+            ("Identity.remove_details",
+             lambda: identity.remove_details(user),
+             reset_details),
+            ("Identity.serialize_hook",
+             lambda: identity.serialize_hook(hook),
+             None),
+            ("IdentityManager.filter_by_addr",
+             lambda: list(Identity.objects.filter_by_addr(
+                 "msisdn", "+27000000001")),
+             None),
+            ("IdentitySearchList.get_queryset", search, None),
+            ("PopulateDetailKey.run",
+             lambda: populate_detail_key.run(
+                 list(IDENTITY_DETAILS.keys())),
+             None),
+            ("deliver_hook_wrapper",
+             lambda: deliver_hook_wrapper(webhook.url, payload, None, hook),
+             None),
+        ]
+
+        names = [name for name, func, setup in benchmarks]
+        for operation in operations:
+            if operation not in names:
+                raise CommandError("Unknown operation '%s', choose from: %s"
+                                   % (operation, ", ".join(names)))
+
+        results = []
+        for name, func, setup in benchmarks:
+            if operations and name not in operations:
+                continue
+            results.append(loadtest.measure(
+                name, func, iterations=iterations, setup=setup))
+        return results
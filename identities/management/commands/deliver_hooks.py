@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from identities.delivery import HookDeliveryWorker
+
+
+class Command(BaseCommand):
+    help = ("Delivers webhooks queued by the "
+            "identities.tasks.queue_hook_delivery HOOK_DELIVERER, with many "
+            "deliveries in flight at once.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--concurrency', type=int, default=None,
+            help='Maximum number of deliveries in flight')
+        parser.add_argument(
+            '--batch-size', type=int, default=None,
+            help='Maximum number of deliveries to claim at a time')
+        parser.add_argument(
+            '--until-empty', action='store_true', default=False,
+            help='Exit once there are no deliveries due')
+
+    def handle(self, *args, **options):
+        worker = HookDeliveryWorker(concurrency=options['concurrency'],
+                                    batch_size=options['batch_size'])
+        try:
+            worker.run(until_empty=options['until_empty'])
+        finally:
+            worker.close()
@@ -0,0 +1,274 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from seed_identity_store.celery import app
+from identities import loadtest
+from identities.tasks import DeliverHook, fire_metric, scheduled_metrics
+
+
+DELAY_METRIC = 'loadtest.delay.last'
+
+
+class TaskMonitor(object):
+
+    """ Follows task events from the workers, counting tasks by name and
+        adding up the time spent running them.
+    """
+
+    def __init__(self):
+        self.names = {}
+        self.counts = {}
+        self.runtime = 0.0
+        self.last_event_at = None
+        self.ready = threading.Event()
+        self.receiver = None
+        self._lock = threading.Lock()
+
+    def count(self, event, state):
+        with self._lock:
+            name = self.names.get(event['uuid'], 'unknown')
+            counts = self.counts.setdefault(
+                name, {"succeeded": 0, "failed": 0, "retried": 0})
+            counts[state] += 1
+            self.runtime += event.get('runtime') or 0.0
+            self.last_event_at = time.time()
+
+    def on_received(self, event):
+        with self._lock:
+            self.names[event['uuid']] = event['name']
+
+    def on_succeeded(self, event):
+        self.count(event, "succeeded")
+
+    def on_failed(self, event):
+        self.count(event, "failed")
+
+    def on_retried(self, event):
+        self.count(event, "retried")
+
+    def finished(self, name):
+        counts = self.counts.get(name, {})
+        return counts.get("succeeded", 0) + counts.get("failed", 0)
+
+    def run(self):
+        with app.connection() as connection:
+            self.receiver = app.events.Receiver(connection, handlers={
+                'task-received': self.on_received,
+                'task-succeeded': self.on_succeeded,
+                'task-failed': self.on_failed,
+                'task-retried': self.on_retried,
+            })
+            self.ready.set()
+            self.receiver.capture(limit=None, timeout=None, wakeup=True)
+
+    def start(self):
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        self.ready.wait()
+        return self
+
+    def stop(self):
+        if self.receiver is not None:
+            self.receiver.should_stop = True
+
+
+class Command(BaseCommand):
+    help = ("Drives DeliverHook, FireMetric and ScheduledMetrics through real "
+            "Celery workers against local stand-ins for webhook targets and "
+            "the metrics API, and reports deliveries per second, end-to-end "
+            "delay and worker utilization. The workers must use METRICS_URL "
+            "of the metrics stand-in, see --metrics-port and "
+            "--spawn-worker.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--deliveries', type=int, default=1000,
+            help='Number of DeliverHook tasks to send')
+        parser.add_argument(
+            '--metrics', type=int, default=1000,
+            help='Number of FireMetric tasks to send')
+        parser.add_argument(
+            '--scheduled', type=int, default=10,
+            help='Number of ScheduledMetrics runs to send')
+        parser.add_argument(
+            '--latency', type=float, default=0,
+            help='Milliseconds the stand-ins take to respond')
+        parser.add_argument(
+            '--error-rate', type=float, default=0,
+            help='Fraction of requests the stand-ins fail with a 500')
+        parser.add_argument(
+            '--slow-rate', type=float, default=0,
+            help='Fraction of requests the stand-ins respond to slowly')
+        parser.add_argument(
+            '--slow-latency', type=float, default=1000,
+            help='Extra milliseconds taken by slow responses')
+        parser.add_argument(
+            '--host', default='127.0.0.1',
+            help='Address for the stand-ins to listen on')
+        parser.add_argument(
+            '--hook-port', type=int, default=0,
+            help='Port for the webhook stand-in, a free port by default')
+        parser.add_argument(
+            '--metrics-port', type=int, default=0,
+            help='Port for the metrics stand-in, a free port by default')
+        parser.add_argument(
+            '--spawn-worker', action='store_true', default=False,
+            help='Start a worker pointed at the metrics stand-in instead of '
+                 'using the workers already running')
+        parser.add_argument(
+            '--worker-concurrency', type=int, default=4,
+            help='Concurrency of the spawned worker')
+        parser.add_argument(
+            '--timeout', type=float, default=300,
+            help='Seconds to wait for the tasks to finish')
+        parser.add_argument(
+            '--json', action='store_true', default=False,
+            help='Output the results as JSON')
+
+    def handle(self, *args, **options):
+        if app.conf.CELERY_ALWAYS_EAGER:
+            raise CommandError("Needs a broker and workers, but "
+                               "CELERY_ALWAYS_EAGER is set")
+        stub_options = dict(
+            host=options['host'],
+            latency=options['latency'] / 1000.0,
+            error_rate=options['error_rate'],
+            slow_rate=options['slow_rate'],
+            slow_latency=options['slow_latency'] / 1000.0)
+        hooks = loadtest.StubServer(
+            port=options['hook_port'], timestamp_key='sent_at',
+            **stub_options).start()
+        metrics = loadtest.StubServer(
+            port=options['metrics_port'], timestamp_key=DELAY_METRIC,
+            **stub_options).start()
+
+        worker = None
+        try:
+            if options['spawn_worker']:
+                worker = self.spawn_worker(
+                    metrics.url, options['worker_concurrency'])
+            elif settings.METRICS_URL != metrics.url:
+                self.stderr.write(
+                    "Metrics will only reach the stand-in if the workers "
+                    "have METRICS_URL=%s" % metrics.url)
+            results = self.run_load(hooks, metrics, options)
+        finally:
+            if worker is not None:
+                worker.terminate()
+                worker.wait()
+            hooks.stop()
+            metrics.stop()
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+
+        self.stdout.write("%-20s %9s %7s %9s %9s %9s %9s" % (
+            "stand-in", "requests", "errors", "per sec", "p50 ms",
+            "p95 ms", "p99 ms"))
+        for name in ("webhooks", "metrics"):
+            result = results[name]
+            self.stdout.write("%-20s %9d %7d %9.1f %9.1f %9.1f %9.1f" % (
+                name, result["requests"], result["errors"],
+                result["per_second"], result["delay"]["p50_ms"],
+                result["delay"]["p95_ms"], result["delay"]["p99_ms"]))
+        self.stdout.write("")
+        self.stdout.write("%-60s %9s %7s %7s" % (
+            "task", "succeeded", "failed", "retried"))
+        for name in sorted(results["tasks"]):
+            counts = results["tasks"][name]
+            self.stdout.write("%-60s %9d %7d %7d" % (
+                name, counts["succeeded"], counts["failed"],
+                counts["retried"]))
+        self.stdout.write("")
+        self.stdout.write(
+            "Finished in %.1fs, worker utilization %.0f%% of %d "
+            "processes%s" % (
+                results["duration"], results["utilization"] * 100,
+                results["worker_processes"],
+                "" if results["completed"] else " (timed out)"))
+
+    def spawn_worker(self, metrics_url, concurrency):
+        env = dict(os.environ, METRICS_URL=metrics_url)
+        worker = subprocess.Popen([
+            sys.executable, os.path.join(settings.BASE_DIR, 'manage.py'),
+            'celery', 'worker', '--events', '--loglevel', 'WARNING',
+            '--concurrency', str(concurrency),
+            '--queues', 'seed_identity_store,priority,metrics'], env=env)
+        deadline = time.time() + 30
+        while not app.control.ping(timeout=1):
+            if worker.poll() is not None or time.time() > deadline:
+                worker.terminate()
+                raise CommandError("The worker didn't start")
+        return worker
+
+    def worker_processes(self):
+        stats = app.control.inspect().stats() or {}
+        return sum(
+            worker.get('pool', {}).get('max-concurrency', 0)
+            for worker in stats.values())
+
+    def run_load(self, hooks, metrics, options):
+        app.control.enable_events()
+        monitor = TaskMonitor().start()
+        # Give the event queue a moment to be bound before sending
+        time.sleep(1)
+        processes = self.worker_processes()
+        scheduled_fires = options['scheduled'] * len(
+            settings.METRICS_SCHEDULED_TASKS)
+        expected = {
+            DeliverHook.name: options['deliveries'],
+            fire_metric.name: options['metrics'] + scheduled_fires,
+            scheduled_metrics.name: options['scheduled'],
+        }
+
+        started = time.time()
+        for i in range(options['deliveries']):
+            DeliverHook.apply_async(kwargs={
+                "target": hooks.url,
+                "payload": {"sent_at": time.time(), "seq": i}})
+        for i in range(options['metrics']):
+            fire_metric.apply_async(kwargs={
+                "metric_name": DELAY_METRIC, "metric_value": time.time()})
+        for i in range(options['scheduled']):
+            scheduled_metrics.apply_async()
+
+        deadline = started + options['timeout']
+        completed = False
+        while time.time() < deadline:
+            if all(monitor.finished(name) >= count
+                   for name, count in expected.items()):
+                completed = True
+                break
+            time.sleep(0.5)
+        monitor.stop()
+
+        duration = (monitor.last_event_at or time.time()) - started
+        return {
+            "webhooks": self.stub_results(hooks, duration),
+            "metrics": self.stub_results(metrics, duration),
+            "tasks": monitor.counts,
+            "duration": duration,
+            "worker_processes": processes,
+            "utilization": (monitor.runtime / (duration * processes)
+                            if processes and duration > 0 else 0.0),
+            "completed": completed,
+        }
+
+    def stub_results(self, server, duration):
+        delivered = server.request_count - server.error_count
+        return {
+            "requests": server.request_count,
+            "errors": server.error_count,
+            "per_second": delivered / duration if duration > 0 else 0.0,
+            "delay": loadtest.summarise_latencies(
+                [delay * 1000.0 for delay in server.delays]),
+        }
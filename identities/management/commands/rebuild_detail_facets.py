@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from identities.facets import rebuild_detail_facets
+
+
+class Command(BaseCommand):
+    help = ("Recounts the detail values in FACETED_DETAIL_KEYS from scratch. "
+            "Run after adding a key to FACETED_DETAIL_KEYS.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'keys', nargs='*',
+            help='Only recount these keys')
+
+    def handle(self, *args, **options):
+        keys = options['keys'] or settings.FACETED_DETAIL_KEYS
+        rebuild_detail_facets(keys)
+        self.stdout.write("Recounted %s." % ", ".join(keys))
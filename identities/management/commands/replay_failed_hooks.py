@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from identities.models import FailedHookDelivery
+from identities.tasks import replay_failed_deliveries
+
+
+class Command(BaseCommand):
+    help = "Queues failed webhook deliveries for delivery again."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--target', default=None,
+            help='Only replay deliveries to this target URL')
+        parser.add_argument(
+            '--hook', type=int, default=None,
+            help='Only replay deliveries for this hook id')
+
+    def handle(self, *args, **options):
+        failed_deliveries = FailedHookDelivery.objects.order_by('id')
+        if options['target'] is not None:
+            failed_deliveries = failed_deliveries.filter(
+                target=options['target'])
+        if options['hook'] is not None:
+            failed_deliveries = failed_deliveries.filter(
+                hook_id=options['hook'])
+        count = replay_failed_deliveries(failed_deliveries)
+        self.stdout.write("Queued %s deliveries." % count)
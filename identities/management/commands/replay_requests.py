@@ -0,0 +1,130 @@
+import json
+import re
+import threading
+import time
+import timeit
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.core.management.base import BaseCommand, CommandError
+
+from identities import loadtest
+
+
+UUID_RE = re.compile(
+    r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+
+
+def endpoint_name(method, path):
+    """ Groups requests by method and path, with ids collapsed.
+    """
+    return "%s %s" % (method, UUID_RE.sub('{id}', path))
+
+
+class Command(BaseCommand):
+    help = ("Replays requests recorded by RequestCaptureMiddleware against "
+            "a local instance and reports latency distributions.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('capture_file')
+        parser.add_argument(
+            '--url', default='http://localhost:8000',
+            help='Base URL of the instance to replay against')
+        parser.add_argument(
+            '--token', default=None,
+            help='Auth token to send with the replayed requests')
+        parser.add_argument(
+            '--speed', type=float, default=1.0,
+            help='Replay speed relative to the original traffic, 0 replays '
+                 'as fast as possible')
+        parser.add_argument(
+            '--concurrency', type=int, default=20,
+            help='Maximum number of requests in flight')
+        parser.add_argument(
+            '--json', action='store_true', default=False,
+            help='Output the results as JSON')
+
+    def handle(self, *args, **options):
+        if options['speed'] < 0:
+            raise CommandError("--speed can't be negative")
+        with open(options['capture_file']) as capture:
+            records = [json.loads(line) for line in capture if line.strip()]
+        if not records:
+            raise CommandError("No requests found in %s"
+                               % options['capture_file'])
+        records.sort(key=lambda record: record["timestamp"])
+
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=options['concurrency'])
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if options['token'] is not None:
+            session.headers['Authorization'] = 'Token %s' % options['token']
+
+        base_url = options['url'].rstrip('/')
+        timings = {}
+        errors = {}
+        lock = threading.Lock()
+
+        def replay(record):
+            name = endpoint_name(record["method"], record["path"])
+            start = timeit.default_timer()
+            try:
+                response = session.request(
+                    record["method"], base_url + record["path"],
+                    params=record["query"],
+                    data=(None if record["body"] is None
+                          else json.dumps(record["body"])),
+                    headers={'Content-Type': 'application/json'})
+                failed = response.status_code >= 500
+            except requests.exceptions.RequestException:
+                failed = True
+            elapsed = (timeit.default_timer() - start) * 1000.0
+            with lock:
+                timings.setdefault(name, []).append(elapsed)
+                if failed:
+                    errors[name] = errors.get(name, 0) + 1
+
+        pool = ThreadPool(options['concurrency'])
+        first = records[0]["timestamp"]
+        started = timeit.default_timer()
+        for record in records:
+            if options['speed']:
+                offset = (record["timestamp"] - first) / options['speed']
+                delay = offset - (timeit.default_timer() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            pool.apply_async(replay, (record,))
+        pool.close()
+        pool.join()
+        duration = timeit.default_timer() - started
+
+        results = []
+        for name in sorted(timings):
+            result = loadtest.summarise_latencies(timings[name])
+            result.update({"endpoint": name, "errors": errors.get(name, 0)})
+            results.append(result)
+        overall = loadtest.summarise_latencies(
+            [t for values in timings.values() for t in values])
+        overall.update({
+            "endpoint": "all",
+            "errors": sum(errors.values()),
+            "requests_per_second": len(records) / duration,
+        })
+        results.append(overall)
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+
+        self.stdout.write("%-50s %7s %7s %9s %9s %9s %9s" % (
+            "endpoint", "count", "errors", "p50 ms", "p95 ms", "p99 ms",
+            "max ms"))
+        for result in results:
+            self.stdout.write("%-50s %7d %7d %9.1f %9.1f %9.1f %9.1f" % (
+                result["endpoint"], result["count"], result["errors"],
+                result["p50_ms"], result["p95_ms"], result["p99_ms"],
+                result["max_ms"]))
+        self.stdout.write("Replayed %d requests in %.1fs (%.1f/s)" % (
+            len(records), duration, overall["requests_per_second"]))
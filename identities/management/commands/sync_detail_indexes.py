@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from identities.detail_indexes import (INDEX_PREFIX, create_index_sql,
+                                       index_name, indexed_keys)
+
+
+class Command(BaseCommand):
+    help = ("Creates the expression indexes for the detail keys in "
+            "INDEXED_DETAIL_KEYS, concurrently so that identities can still "
+            "be written meanwhile.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--drop-undeclared', action='store_true', default=False,
+            help='Also drop the indexes of keys no longer declared')
+        parser.add_argument(
+            '--dry-run', action='store_true', default=False,
+            help='Only print the SQL that would be run')
+
+    def handle(self, *args, **options):
+        keys = indexed_keys()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT indexname FROM pg_indexes "
+                "WHERE tablename = 'identities_identity' "
+                "AND indexname LIKE %s", [INDEX_PREFIX.replace('_', r'\_') +
+                                          '%'])
+            existing = set(row[0] for row in cursor.fetchall())
+
+        statements = [
+            create_index_sql(key, key_type)
+            for key, key_type in sorted(keys.items())
+            if index_name(key, key_type) not in existing]
+        if options['drop_undeclared']:
+            declared = set(index_name(key, key_type)
+                           for key, key_type in keys.items())
+            statements.extend(
+                "DROP INDEX CONCURRENTLY IF EXISTS %s" % name
+                for name in sorted(existing - declared))
+
+        for statement in statements:
+            self.stdout.write(statement)
+            if not options['dry_run']:
+                # CONCURRENTLY can't run in a transaction, so each statement
+                # is run on its own in autocommit mode
+                with connection.cursor() as cursor:
+                    cursor.execute(statement)
+        if not statements:
+            self.stdout.write("Detail indexes are up to date.")
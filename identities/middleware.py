@@ -0,0 +1,131 @@
+import hashlib
+import json
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+
+from seed_identity_store import routers
+
+
+def redact(data, keys):
+    """ Returns a copy of `data` with the values of any dictionary keys in
+        `keys` (compared case-insensitively) replaced by "redacted".
+    """
+    if isinstance(data, dict):
+        return dict(
+            (k, "redacted" if k.lower() in keys else redact(v, keys))
+            for k, v in data.items())
+    if isinstance(data, list):
+        return [redact(v, keys) for v in data]
+    return data
+
+
+class RequestCaptureMiddleware(object):
+
+    """ Records a sample of API requests to a JSON lines file so that they
+        can be replayed with the `replay_requests` management command.
+        Only enabled when REQUEST_CAPTURE_FILE is set. Headers are never
+        recorded and the values of keys in REQUEST_CAPTURE_REDACT are
+        redacted from query strings and bodies.
+    """
+
+    def __init__(self):
+        self.path = getattr(settings, 'REQUEST_CAPTURE_FILE', None)
+        if not self.path:
+            raise MiddlewareNotUsed()
+        self.sample_rate = settings.REQUEST_CAPTURE_SAMPLE_RATE
+        self.redact_keys = set(
+            k.lower() for k in settings.REQUEST_CAPTURE_REDACT)
+        self.lock = threading.Lock()
+
+    def process_request(self, request):
+        if not request.path.startswith('/api/'):
+            return None
+        if random.random() >= self.sample_rate:
+            return None
+
+        query = [
+            [k, "redacted" if k.lower() in self.redact_keys else v]
+            for k, values in request.GET.lists() for v in values]
+
+        body = None
+        content_type = request.META.get('CONTENT_TYPE', '')
+        if content_type.startswith('application/json') and request.body:
+            try:
+                body = json.loads(request.body.decode('utf-8'))
+            except ValueError:
+                body = None
+        elif request.method == 'POST' and request.POST:
+            body = dict(request.POST.items())
+        body = redact(body, self.redact_keys)
+
+        record = json.dumps({
+            "timestamp": time.time(),
+            "method": request.method,
+            "path": request.path,
+            "query": query,
+            "body": body,
+        })
+        with self.lock:
+            with open(self.path, 'a') as capture:
+                capture.write(record + '\n')
+        return None
+
+
+class ReplicaRoutingMiddleware(object):
+
+    """ Sends the reads of safe requests to views with `read_from_replica`
+        set to a replica, unless the client has written in the last
+        REPLICA_STICKY_SECONDS, so that clients always read their own
+        writes. Clients are told apart by their Authorization header, or
+        their address if they don't send one. Views that only read for some
+        other methods can list them all in `read_only_methods`. Only enabled
+        when there are REPLICA_DATABASES.
+    """
+    SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+    def __init__(self):
+        if not getattr(settings, 'REPLICA_DATABASES', None):
+            raise MiddlewareNotUsed()
+
+    def client_key(self, request):
+        client = (request.META.get('HTTP_AUTHORIZATION') or
+                  request.META.get('REMOTE_ADDR', ''))
+        return 'replica-pin:%s' % hashlib.md5(
+            client.encode('utf-8')).hexdigest()
+
+    def read_only(self, request):
+        return getattr(request, '_read_only',
+                       request.method in self.SAFE_METHODS)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view_class = getattr(view_func, 'cls', None)
+        request._read_only = request.method in getattr(
+            view_class, 'read_only_methods', self.SAFE_METHODS)
+        if (request._read_only and
+                getattr(view_class, 'read_from_replica', False) and
+                not cache.get(self.client_key(request))):
+            request._replica = routers.use_replica()
+            request._replica.__enter__()
+        return None
+
+    def finish(self, request):
+        replica = getattr(request, '_replica', None)
+        if replica is not None:
+            del request._replica
+            replica.__exit__(None, None, None)
+
+    def process_exception(self, request, exception):
+        self.finish(request)
+        return None
+
+    def process_response(self, request, response):
+        self.finish(request)
+        if not self.read_only(request) and response.status_code < 400:
+            cache.set(self.client_key(request), True,
+                      settings.REPLICA_STICKY_SECONDS)
+        return response
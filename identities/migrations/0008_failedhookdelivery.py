@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.1 on 2026-10-18 11:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identities', '0007_hookdelivery'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FailedHookDelivery',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hook_id', models.IntegerField(null=True)),
+                ('target', models.URLField(db_index=True, max_length=255)),
+                ('body', models.TextField()),
+                ('instance_id', models.CharField(max_length=255, null=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('error', models.TextField(null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.1 on 2026-10-18 12:41
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identities', '0008_failedhookdelivery'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HookOptions',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hook_id', models.IntegerField(unique=True)),
+                ('payload_format', models.CharField(choices=[('full', 'The identity details and the event'), ('compact', 'Ids, the event and the changed fields only')], default='full', help_text='Payload to deliver to the hook.', max_length=20)),
+                ('compress', models.BooleanField(default=False, help_text='Gzip the payload.')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='failedhookdelivery',
+            name='content_encoding',
+            field=models.CharField(max_length=20, null=True),
+        ),
+        migrations.AddField(
+            model_name='hookdelivery',
+            name='content_encoding',
+            field=models.CharField(max_length=20, null=True),
+        ),
+    ]
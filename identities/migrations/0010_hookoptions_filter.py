@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.1 on 2026-10-18 14:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identities', '0009_hookoptions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='hookoptions',
+            name='filter',
+            field=models.CharField(blank=True, help_text='Only deliver events whose payload matches, e.g. optout_type in (stop, stopall)', max_length=500, null=True),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.1 on 2026-10-18 14:38
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identities', '0010_hookoptions_filter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CoalescedHookEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hook_id', models.IntegerField()),
+                ('identity_id', models.CharField(max_length=255)),
+                ('target', models.URLField(max_length=255)),
+                ('body', models.TextField()),
+                ('content_encoding', models.CharField(max_length=20, null=True)),
+                ('instance_id', models.CharField(max_length=255, null=True)),
+                ('events', models.IntegerField(default=1)),
+                ('deliver_at', models.DateTimeField(db_index=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='hookoptions',
+            name='coalesce_window',
+            field=models.PositiveIntegerField(default=0, help_text='Seconds to hold an event for further events for the same identity, delivering only the latest. 0 to disable.'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='coalescedhookevent',
+            unique_together=set([('hook_id', 'identity_id')]),
+        ),
+    ]
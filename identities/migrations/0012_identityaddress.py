@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.1 on 2026-10-18 15:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Copied from identities.models as it was when this migration was written,
+# so that later changes there don't change what the backfill does
+
+
+def is_set(value):
+    return value in (True, 'True', 'true')
+
+
+def identity_addresses(details):
+    addresses = {}
+    if not isinstance(details, dict) or not isinstance(
+            details.get("addresses"), dict):
+        return addresses
+    for address_type, entries in details["addresses"].items():
+        if not isinstance(entries, dict):
+            continue
+        for address, metadata in entries.items():
+            if not isinstance(metadata, dict):
+                metadata = {}
+            addresses[(address_type, address)] = {
+                "default": len(entries) == 1 or is_set(
+                    metadata.get("default")),
+                "optedout": is_set(metadata.get("optedout")),
+                "inactive": is_set(metadata.get("inactive")),
+            }
+    return addresses
+
+
+def backfill_identity_addresses(apps, schema_editor):
+    Identity = apps.get_model('identities', 'Identity')
+    IdentityAddress = apps.get_model('identities', 'IdentityAddress')
+    batch = []
+    for identity in Identity.objects.only('id', 'details').iterator():
+        for (address_type, address), flags in identity_addresses(
+                identity.details).items():
+            batch.append(IdentityAddress(
+                identity_id=identity.id, address_type=address_type,
+                address=address, **flags))
+        if len(batch) >= 1000:
+            IdentityAddress.objects.bulk_create(batch)
+            batch = []
+    IdentityAddress.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identities', '0011_coalescedhookevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdentityAddress',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('address_type', models.CharField(max_length=50)),
+                ('address', models.CharField(max_length=255)),
+                ('default', models.BooleanField(default=False)),
+                ('optedout', models.BooleanField(default=False)),
+                ('inactive', models.BooleanField(default=False)),
+                ('identity', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='identity_addresses', to='identities.Identity')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='identityaddress',
+            unique_together=set([('identity', 'address_type', 'address')]),
+        ),
+        migrations.RunSQL(
+            "CREATE INDEX identities_identityaddress_contactable "
+            "ON identities_identityaddress (address_type, id) "
+            "WHERE NOT optedout AND NOT inactive",
+            "DROP INDEX identities_identityaddress_contactable"),
+        migrations.RunPython(backfill_identity_addresses,
+                             migrations.RunPython.noop),
+    ]
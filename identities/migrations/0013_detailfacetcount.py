@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.1 on 2026-10-18 16:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+# The FACETED_DETAIL_KEYS default when this migration was written. Other
+# keys can be counted afterwards with the rebuild_detail_facets command.
+FACETED_DETAIL_KEYS = ['preferred_language', 'default_addr_type']
+
+
+def count_detail_facets(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        for key in FACETED_DETAIL_KEYS:
+            cursor.execute(
+                "INSERT INTO identities_detailfacetcount "
+                "(key_name, value, count) "
+                "SELECT %s, details->>%s, COUNT(*) FROM identities_identity "
+                "WHERE details ? %s GROUP BY 2", [key, key, key])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identities', '0012_identityaddress'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DetailFacetCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key_name', models.CharField(max_length=200)),
+                ('value', models.TextField(null=True)),
+                ('count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='detailfacetcount',
+            unique_together=set([('key_name', 'value')]),
+        ),
+        migrations.RunPython(count_detail_facets, migrations.RunPython.noop),
+    ]
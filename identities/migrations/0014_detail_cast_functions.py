@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.1 on 2026-10-18 16:40
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+TO_NUMERIC = r"""
+CREATE OR REPLACE FUNCTION identities_to_numeric(value text) RETURNS numeric
+AS $$
+BEGIN
+    RETURN value::numeric;
+EXCEPTION WHEN others THEN
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+"""
+
+TO_DATE = r"""
+CREATE OR REPLACE FUNCTION identities_to_date(value text) RETURNS date
+AS $$
+BEGIN
+    IF value !~ '^\d{4}-\d{2}-\d{2}$' THEN
+        RETURN NULL;
+    END IF;
+    RETURN to_date(value, 'YYYY-MM-DD');
+EXCEPTION WHEN others THEN
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identities', '0013_detailfacetcount'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            TO_NUMERIC, "DROP FUNCTION identities_to_numeric(text)"),
+        migrations.RunSQL(
+            TO_DATE, "DROP FUNCTION identities_to_date(text)"),
+    ]
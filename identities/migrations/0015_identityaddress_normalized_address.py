@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.1 on 2026-10-18 18:05
+from __future__ import unicode_literals
+
+import re
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+# Copied from identities.addresses as it was when this migration was
+# written, so that later changes there don't change what the backfill does
+
+MSISDN_PUNCTUATION_RE = re.compile(r'[\s\-\.\(\)/]')
+
+DIGITS_RE = re.compile(r'^\d+$')
+
+
+def normalize_msisdn(msisdn):
+    country_code = settings.MSISDN_DEFAULT_COUNTRY_CODE
+    number = MSISDN_PUNCTUATION_RE.sub('', msisdn)
+    if number.startswith('+'):
+        number = number[1:]
+    elif number.startswith('00'):
+        number = number[2:]
+    elif number.startswith('0'):
+        if not country_code:
+            return msisdn
+        number = country_code + number[1:]
+    if not DIGITS_RE.match(number):
+        return msisdn
+    return '+' + number
+
+
+def backfill_normalized_addresses(apps, schema_editor):
+    IdentityAddress = apps.get_model('identities', 'IdentityAddress')
+    IdentityAddress.objects.exclude(address_type='msisdn').update(
+        normalized_address=models.F('address'))
+    msisdns = IdentityAddress.objects.filter(
+        address_type='msisdn').only('id', 'address_type', 'address')
+    for address in msisdns.iterator():
+        IdentityAddress.objects.filter(id=address.id).update(
+            normalized_address=normalize_msisdn(address.address))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identities', '0014_detail_cast_functions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='identityaddress',
+            name='normalized_address',
+            field=models.CharField(default='', max_length=255),
+        ),
+        migrations.AlterIndexTogether(
+            name='identityaddress',
+            index_together=set([('address_type', 'normalized_address')]),
+        ),
+        migrations.RunPython(backfill_normalized_addresses,
+                             migrations.RunPython.noop),
+    ]
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.1 on 2026-10-18 18:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+CREATE_INDEX = (
+    "CREATE INDEX CONCURRENTLY identities_identity_created_at_idx "
+    "ON identities_identity (created_at)")
+
+DROP_INDEX = (
+    "DROP INDEX CONCURRENTLY IF EXISTS identities_identity_created_at_idx")
+
+
+def run_concurrently(schema_editor, sql):
+    """
+    Runs a CONCURRENTLY statement, which can't run in a transaction, so that
+    writes to identities carry on while the index is built.
+    """
+    connection = schema_editor.connection
+    if not connection.in_atomic_block:
+        schema_editor.execute(sql)
+        return
+    # Django 1.9 ignores atomic = False and runs every migration in a
+    # transaction. Nothing else has run in this one, so it is committed and
+    # the statement run on its own in autocommit mode.
+    raw = connection.connection
+    raw.commit()
+    raw.autocommit = True
+    try:
+        cursor = raw.cursor()
+        try:
+            cursor.execute(sql)
+        finally:
+            cursor.close()
+    finally:
+        raw.autocommit = False
+
+
+def create_index(apps, schema_editor):
+    run_concurrently(schema_editor, CREATE_INDEX)
+
+
+def drop_index(apps, schema_editor):
+    run_concurrently(schema_editor, DROP_INDEX)
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('identities', '0015_identityaddress_normalized_address'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(create_index, drop_index),
+            ],
+            state_operations=[
+                migrations.AlterField(
+                    model_name='identity',
+                    name='created_at',
+                    field=models.DateTimeField(auto_now_add=True,
+                                               db_index=True),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.1 on 2026-10-18 19:02
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identities', '0016_identity_created_at_index'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='optin',
+            index_together=set([('identity', 'created_at'), ('address_type', 'address', 'created_at')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='optout',
+            index_together=set([('identity', 'created_at'), ('address_type', 'address', 'created_at')]),
+        ),
+    ]
@@ -2,19 +2,25 @@ import uuid
 
 from django.contrib.postgres.fields import JSONField
 from django.contrib.auth.models import User
-from django.db import models
-from django.db.models.signals import post_save, pre_save
+from django.db import models, transaction, connections, IntegrityError
+from django.db.models import F, Q
+from django.db.models.signals import post_save, pre_save, post_delete
 from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 from django.core.exceptions import ValidationError
-from rest_hooks.signals import raw_hook_event
+from rest_hooks.models import Hook
+
+from .addresses import normalize_address
+from .facets import changed_facets, facet_values
+from .hooks import HookPayload, filter_matches, send_hook_event
 
 
 class IdentityManager(models.Manager):
 
     def filter_by_addr(self, address_type, address):
-        filter_string = "details__addresses__%s__has_key" % (address_type, )
-        return self.filter(**{filter_string: address})
+        return self.filter(id__in=IdentityAddress.objects.lookup(
+            address_type, address).values('identity_id'))
 
 
 @python_2_unicode_compatible
@@ -44,7 +50,7 @@ class Identity(models.Model):
     operator = models.ForeignKey(
         'self', related_name='identities_created_by',
         null=True, blank=True)
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
     updated_at = models.DateTimeField(auto_now=True)
     created_by = models.ForeignKey(User, related_name='identities_created',
                                    null=True)
@@ -54,8 +60,17 @@ class Identity(models.Model):
 
     objects = IdentityManager()
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Identity, cls).from_db(db, field_names, values)
+        # Remember the faceted detail values as loaded so that saving can
+        # adjust their counts
+        if 'details' in field_names:
+            instance._facet_values = facet_values(instance.details)
+        return instance
+
     def serialize_hook(self, hook):
-        return {
+        return HookPayload({
             'hook': hook.dict(),
             'data': {
                 'id': str(self.id),
@@ -68,7 +83,13 @@ class Identity(models.Model):
                 'updated_at': self.updated_at.isoformat(),
                 'updated_by': self.updated_by.username
             }
-        }
+        }, compact={
+            'hook': hook.dict(),
+            'data': {
+                'id': str(self.id),
+                'version': self.version
+            }
+        })
 
     def __str__(self):
         return str(self.id)
@@ -91,15 +112,154 @@ class Identity(models.Model):
             if scope == "all" or cur_address_type == address_type:
                 # for each address value (e.g. foo1@bar.com, +27123, etc.)
                 for cur_address, cur_details in addresses.items():
-                    if scope == "all" or cur_address == address:
+                    if scope == "all" or normalize_address(
+                            address_type, cur_address) == normalize_address(
+                            address_type, address):
                         cur_details["optedout"] = True
         self.save()
 
     def optin_address(self, address_type=None, address=None):
-        self.details["addresses"][address_type][address]["optedout"] = False
+        normalized = normalize_address(address_type, address)
+        addresses = self.details["addresses"][address_type]
+        for cur_address, cur_details in addresses.items():
+            if normalize_address(address_type, cur_address) == normalized:
+                cur_details["optedout"] = False
         self.save()
 
 
+def is_set(value):
+    return value in (True, 'True', 'true')
+
+
+def identity_addresses(details):
+    """
+    The addresses in an identity's details with their flags, keyed by
+    (address type, address). An address is the default if it's the only one
+    of its type or is flagged as the default, as for IdentityAddresses.
+    """
+    addresses = {}
+    if not isinstance(details, dict) or not isinstance(
+            details.get("addresses"), dict):
+        return addresses
+    for address_type, entries in details["addresses"].items():
+        if not isinstance(entries, dict):
+            continue
+        for address, metadata in entries.items():
+            if not isinstance(metadata, dict):
+                metadata = {}
+            addresses[(address_type, address)] = {
+                "default": len(entries) == 1 or is_set(
+                    metadata.get("default")),
+                "optedout": is_set(metadata.get("optedout")),
+                "inactive": is_set(metadata.get("inactive")),
+            }
+    return addresses
+
+
+class IdentityAddressManager(models.Manager):
+
+    def sync(self, identity):
+        """
+        Brings the identity's addresses in line with its details, only
+        touching the addresses that changed.
+        """
+        wanted = dict(
+            (key, dict(flags, normalized_address=normalize_address(*key)))
+            for key, flags in identity_addresses(identity.details).items())
+        with transaction.atomic():
+            existing = dict(
+                ((a.address_type, a.address), a)
+                for a in self.filter(identity=identity))
+            removed = [a.id for key, a in existing.items()
+                       if key not in wanted]
+            if removed:
+                self.filter(id__in=removed).delete()
+            added = []
+            for key, flags in wanted.items():
+                address = existing.get(key)
+                if address is None:
+                    added.append(self.model(
+                        identity=identity, address_type=key[0],
+                        address=key[1], **flags))
+                elif any(getattr(address, field) != value
+                         for field, value in flags.items()):
+                    self.filter(id=address.id).update(**flags)
+            if added:
+                self.bulk_create(added)
+
+    def lookup(self, address_type, address):
+        """
+        The addresses of a type that have the same canonical form as
+        `address`.
+        """
+        return self.filter(
+            address_type=address_type,
+            normalized_address=normalize_address(address_type, address))
+
+    def contactable(self):
+        return self.filter(optedout=False, inactive=False)
+
+    def optout_status(self, addresses):
+        """
+        Whether each of the (address type, address) pairs that any identity
+        has is opted out, keyed by address type and canonical address. An
+        address is opted out if it is opted out for any identity.
+        """
+        by_type = {}
+        for address_type, address in addresses:
+            by_type.setdefault(address_type, set()).add(
+                normalize_address(address_type, address))
+        if not by_type:
+            return {}
+        query = Q()
+        for address_type, normalized in by_type.items():
+            query |= Q(address_type=address_type,
+                       normalized_address__in=normalized)
+        status = {}
+        for address_type, normalized, optedout in self.filter(
+                query).values_list(
+                'address_type', 'normalized_address', 'optedout'):
+            key = (address_type, normalized)
+            status[key] = status.get(key, False) or optedout
+        return status
+
+
+@python_2_unicode_compatible
+class IdentityAddress(models.Model):
+    """
+    An address from an identity's details, kept in step with the identity
+    so that the contactable addresses of a type can be read with a single
+    index scan instead of by going through every identity, and so that
+    identities can be found by the canonical form of an address.
+    """
+    identity = models.ForeignKey(Identity, related_name='identity_addresses')
+    address_type = models.CharField(null=False, max_length=50)
+    address = models.CharField(null=False, max_length=255)
+    normalized_address = models.CharField(null=False, max_length=255,
+                                          default='')
+    default = models.BooleanField(default=False)
+    optedout = models.BooleanField(default=False)
+    inactive = models.BooleanField(default=False)
+
+    objects = IdentityAddressManager()
+
+    class Meta:
+        unique_together = ('identity', 'address_type', 'address')
+        index_together = ('address_type', 'normalized_address')
+
+    def __str__(self):
+        return "%s %s" % (self.address_type, self.address)
+
+
+@receiver(post_save, sender=Identity)
+def sync_identity_addresses(sender, instance, **kwargs):
+    """
+    Opt-outs, opt-ins and forgetting all save the identity, so this keeps
+    the addresses up to date for all of them.
+    """
+    IdentityAddress.objects.sync(instance)
+
+
 @python_2_unicode_compatible
 class OptIn(models.Model):
     """An opt-in"""
@@ -128,6 +288,12 @@ class OptIn(models.Model):
 
     user = property(lambda self: self.created_by)
 
+    class Meta:
+        index_together = [
+            ('address_type', 'address', 'created_at'),
+            ('identity', 'created_at'),
+        ]
+
     def __str__(self):
         return str(self.id)
 
@@ -171,18 +337,17 @@ def handle_optin(sender, instance, created, **kwargs):
 
     identity = instance.identity
 
-    raw_hook_event.send(
-        sender=None,
-        event_name='optin.requested',
-        payload={
-            'identity': str(identity.id),
-            'identity_details': identity.details,
-            'optin_address_type': instance.address_type,
-            'optin_address': instance.address
-        },
-        user=instance.user,
-        send_hook_meta=False
-    )
+    send_hook_event('optin.requested', HookPayload({
+        'identity': str(identity.id),
+        'identity_details': identity.details,
+        'optin_address_type': instance.address_type,
+        'optin_address': instance.address
+    }, compact={
+        'identity': str(identity.id),
+        'event': 'optin.requested',
+        'optin_address_type': instance.address_type,
+        'optin_address': instance.address
+    }), instance.user, str(instance.id))
 
     identity.optin_address(address_type=instance.address_type,
                            address=instance.address)
@@ -228,6 +393,12 @@ class OptOut(models.Model):
 
     user = property(lambda self: self.created_by)
 
+    class Meta:
+        index_together = [
+            ('address_type', 'address', 'created_at'),
+            ('identity', 'created_at'),
+        ]
+
     def __str__(self):
         return str(self.id)
 
@@ -262,6 +433,234 @@ class DetailKey(models.Model):
         return str(self.key_name)
 
 
+class DetailFacetCountManager(models.Manager):
+
+    def adjust(self, key_name, value, delta):
+        updated = self.filter(key_name=key_name, value=value).update(
+            count=F('count') + delta)
+        if updated or delta < 0:
+            return
+        try:
+            with transaction.atomic():
+                self.create(key_name=key_name, value=value, count=delta)
+        except IntegrityError:
+            # Created by someone else in the meantime
+            self.filter(key_name=key_name, value=value).update(
+                count=F('count') + delta)
+
+
+@python_2_unicode_compatible
+class DetailFacetCount(models.Model):
+    """
+    The number of identities with each value of a detail key in
+    FACETED_DETAIL_KEYS, kept up to date as identities are saved and
+    deleted.
+    """
+    key_name = models.CharField(null=False, max_length=200)
+    value = models.TextField(null=True)
+    count = models.IntegerField(default=0)
+
+    objects = DetailFacetCountManager()
+
+    class Meta:
+        unique_together = ('key_name', 'value')
+
+    def __str__(self):
+        return "%s=%s" % (self.key_name, self.value)
+
+
+@python_2_unicode_compatible
+class HookOptions(models.Model):
+    """
+    Delivery options for a rest_hooks Hook. Hooks without options get the
+    full payload, uncompressed.
+    """
+    PAYLOAD_FORMAT_CHOICES = (
+        ('full', "The identity details and the event"),
+        ('compact', "Ids, the event and the changed fields only")
+    )
+    hook_id = models.IntegerField(null=False, unique=True)
+    payload_format = models.CharField(
+        null=False, max_length=20, default="full",
+        choices=PAYLOAD_FORMAT_CHOICES,
+        help_text="Payload to deliver to the hook.")
+    compress = models.BooleanField(
+        default=False, help_text="Gzip the payload.")
+    filter = models.CharField(
+        null=True, blank=True, max_length=500,
+        help_text="Only deliver events whose payload matches, e.g. "
+                  "optout_type in (stop, stopall)")
+    coalesce_window = models.PositiveIntegerField(
+        default=0,
+        help_text="Seconds to hold an event for further events for the same "
+                  "identity, delivering only the latest. 0 to disable.")
+
+    def __str__(self):
+        return str(self.hook_id)
+
+    def accepts(self, payload):
+        """
+        Whether an event payload should be delivered to the hook.
+        """
+        return not self.filter or filter_matches(self.filter, payload)
+
+    @classmethod
+    def for_hook(cls, hook):
+        try:
+            return cls.objects.get(hook_id=hook.id)
+        except cls.DoesNotExist:
+            return cls(hook_id=hook.id)
+
+
+@receiver(post_delete, sender=Hook)
+def delete_hook_options(sender, instance, **kwargs):
+    HookOptions.objects.filter(hook_id=instance.id).delete()
+    CoalescedHookEvent.objects.filter(hook_id=instance.id).delete()
+
+
+@python_2_unicode_compatible
+class OutboxMessage(models.Model):
+    """
+    A Celery task waiting to be published. Written in the same transaction
+    as the change that triggered it and published by the relay_outbox task
+    once that transaction has committed.
+    """
+    task_name = models.CharField(null=False, max_length=255)
+    kwargs = JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return "%s %s" % (self.task_name, self.id)
+
+
+@python_2_unicode_compatible
+class HookDelivery(models.Model):
+    """
+    A webhook delivery waiting for the deliver_hooks worker. next_attempt_at
+    is pushed forward while a worker holds the delivery, so that deliveries
+    held by a worker that dies are picked up again.
+    """
+    hook_id = models.IntegerField(null=True)
+    target = models.URLField(null=False, max_length=255)
+    body = models.TextField(null=False)
+    content_encoding = models.CharField(null=True, max_length=20)
+    instance_id = models.CharField(null=True, max_length=255)
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now,
+                                           db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return "%s %s" % (self.target, self.id)
+
+
+@python_2_unicode_compatible
+class FailedHookDelivery(models.Model):
+    """
+    A webhook delivery that failed on every attempt. Kept so that it can be
+    replayed once the target has recovered.
+    """
+    hook_id = models.IntegerField(null=True)
+    target = models.URLField(null=False, max_length=255, db_index=True)
+    body = models.TextField(null=False)
+    content_encoding = models.CharField(null=True, max_length=20)
+    instance_id = models.CharField(null=True, max_length=255)
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return "%s %s" % (self.target, self.id)
+
+
+@python_2_unicode_compatible
+class CoalescedHookEvent(models.Model):
+    """
+    The latest event for an identity held for a hook with a coalesce window.
+    Later events for the identity replace the body until deliver_at, when
+    flush_coalesced_events hands it to DeliverHook.
+    """
+    hook_id = models.IntegerField(null=False)
+    identity_id = models.CharField(null=False, max_length=255)
+    target = models.URLField(null=False, max_length=255)
+    body = models.TextField(null=False)
+    content_encoding = models.CharField(null=True, max_length=20)
+    instance_id = models.CharField(null=True, max_length=255)
+    events = models.IntegerField(default=1)
+    deliver_at = models.DateTimeField(null=False, db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('hook_id', 'identity_id')
+
+    def __str__(self):
+        return "%s %s" % (self.target, self.identity_id)
+
+
+class OptOutBloomFilterManager(models.Manager):
+
+    def latest_version(self):
+        """
+        The latest version, without its data until it is read.
+        """
+        return self.defer('data').order_by('-id').first()
+
+
+@python_2_unicode_compatible
+class OptOutBloomFilter(models.Model):
+    """
+    A version of the Bloom filter of opted out addresses built by
+    rebuild_optout_filter, in the format of identities.bloom.
+    """
+    data = models.BinaryField()
+    etag = models.CharField(null=False, max_length=40)
+    address_count = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = OptOutBloomFilterManager()
+
+    def __str__(self):
+        return "Version %s of %s addresses" % (self.id, self.address_count)
+
+
+class ChangeManager(models.Manager):
+
+    def record(self, instance, action, using=None):
+        """
+        Records a change to `instance` as part of the current transaction,
+        with the transaction's id so that the change feed can tell when
+        every change before it has been committed.
+        """
+        with connections[using or self.db].cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO identities_change "
+                "(txid, model_name, object_id, action, created_at) "
+                "VALUES (txid_current(), %s, %s, %s, %s)",
+                [instance._meta.model_name, str(instance.pk), action,
+                 timezone.now()])
+
+
+@python_2_unicode_compatible
+class Change(models.Model):
+    """
+    A write to an identity, opt-out or opt-in, in the order the change feed
+    returns them: by the id of the transaction that made it, then by id.
+    """
+    txid = models.BigIntegerField(null=False)
+    model_name = models.CharField(null=False, max_length=50)
+    object_id = models.CharField(null=False, max_length=36)
+    action = models.CharField(null=False, max_length=10)
+    created_at = models.DateTimeField(null=False, db_index=True)
+
+    objects = ChangeManager()
+
+    class Meta:
+        index_together = ('txid', 'id')
+
+    def __str__(self):
+        return "%s %s %s" % (self.action, self.model_name, self.object_id)
+
+
 @receiver(pre_save, sender=OptOut)
 def optout_saved(sender, instance, **kwargs):
     """
@@ -284,17 +683,17 @@ def handle_optout(sender, instance, created, **kwargs):
 
     identity = instance.identity
 
-    raw_hook_event.send(
-        sender=None,
-        event_name='optout.requested',
-        payload={
-            'identity': str(identity.id),
-            'identity_details': identity.details,
-            'optout_type': instance.optout_type,
-        },
-        user=instance.user,
-        send_hook_meta=False
-    )
+    send_hook_event('optout.requested', HookPayload({
+        'identity': str(identity.id),
+        'identity_details': identity.details,
+        'optout_type': instance.optout_type,
+    }, compact={
+        'identity': str(identity.id),
+        'event': 'optout.requested',
+        'optout_type': instance.optout_type,
+        'optout_address_type': instance.address_type,
+        'optout_address': instance.address
+    }), instance.user, str(instance.id))
 
     if instance.optout_type == "forget":
         identity.remove_details(instance.user)
@@ -306,11 +705,35 @@ def handle_optout(sender, instance, created, **kwargs):
         identity.optout_address(scope="all")
 
 
+@receiver(post_save, sender=Identity)
+def update_detail_facets(sender, instance, created, **kwargs):
+    if created:
+        old = {}
+    elif hasattr(instance, '_facet_values'):
+        old = instance._facet_values
+    else:
+        # Saved without being loaded, so there's nothing to compare with
+        return
+    new = facet_values(instance.details)
+    for key_name, value, delta in changed_facets(old, new):
+        DetailFacetCount.objects.adjust(key_name, value, delta)
+    instance._facet_values = new
+
+
+@receiver(post_delete, sender=Identity)
+def remove_detail_facets(sender, instance, **kwargs):
+    old = getattr(instance, '_facet_values', None)
+    if old is None:
+        old = facet_values(instance.details)
+    for key_name, value, delta in changed_facets(old, {}):
+        DetailFacetCount.objects.adjust(key_name, value, delta)
+
+
 @receiver(post_save, sender=Identity)
 def fire_metrics_if_new(sender, instance, created, **kwargs):
-    from .tasks import fire_metric
+    from .tasks import fire_metric, queue_task
     if created:
-        fire_metric.apply_async(kwargs={
+        queue_task(fire_metric, {
             "metric_name": 'identities.created.sum',
             "metric_value": 1.0
         })
@@ -318,8 +741,23 @@ def fire_metrics_if_new(sender, instance, created, **kwargs):
 
 @receiver(post_save, sender=Identity)
 def fire_detailkeys_if_new(sender, instance, created, **kwargs):
-    from .tasks import populate_detail_key
+    from .tasks import populate_detail_key, queue_task
     if created and instance.details is not None:
-        populate_detail_key.apply_async(kwargs={
-            "key_names": instance.details.keys()
+        queue_task(populate_detail_key, {
+            "key_names": list(instance.details.keys())
         })
+
+
+@receiver(post_save, sender=Identity)
+@receiver(post_save, sender=OptOut)
+@receiver(post_save, sender=OptIn)
+def record_save(sender, instance, created, **kwargs):
+    Change.objects.record(instance, 'created' if created else 'updated',
+                          kwargs.get('using'))
+
+
+@receiver(post_delete, sender=Identity)
+@receiver(post_delete, sender=OptOut)
+@receiver(post_delete, sender=OptIn)
+def record_delete(sender, instance, **kwargs):
+    Change.objects.record(instance, 'deleted', kwargs.get('using'))
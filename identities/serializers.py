@@ -1,7 +1,8 @@
 from django.contrib.auth.models import User, Group
 from rest_framework import serializers
 from rest_hooks.models import Hook
-from .models import Identity, OptOut, OptIn
+from .hooks import parse_filter
+from .models import Identity, OptOut, OptIn, HookOptions
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -47,10 +48,63 @@ class OptInSerializer(serializers.ModelSerializer):
 
 
 class HookSerializer(serializers.ModelSerializer):
+    """
+    Serializes a Hook together with its HookOptions.
+    """
+    OPTION_FIELDS = ('payload_format', 'compress', 'filter',
+                     'coalesce_window')
+
+    payload_format = serializers.ChoiceField(
+        choices=HookOptions.PAYLOAD_FORMAT_CHOICES, default='full')
+    compress = serializers.BooleanField(default=False)
+    filter = serializers.CharField(
+        required=False, allow_null=True, allow_blank=True, max_length=500)
+    coalesce_window = serializers.IntegerField(min_value=0, default=0)
+
     class Meta:
         model = Hook
         read_only_fields = ('user',)
 
+    def validate_filter(self, value):
+        if value:
+            try:
+                parse_filter(value)
+            except ValueError as e:
+                raise serializers.ValidationError(
+                    "Invalid filter: %s" % (e,))
+        return value or None
+
+    def to_representation(self, instance):
+        options = HookOptions.for_hook(instance)
+        for field in self.OPTION_FIELDS:
+            setattr(instance, field, getattr(options, field))
+        return super(HookSerializer, self).to_representation(instance)
+
+    def save_options(self, hook, validated_options):
+        if not validated_options:
+            return
+        options = HookOptions.for_hook(hook)
+        for field, value in validated_options.items():
+            setattr(options, field, value)
+        options.save()
+
+    def pop_options(self, validated_data):
+        return dict(
+            (field, validated_data.pop(field))
+            for field in self.OPTION_FIELDS if field in validated_data)
+
+    def create(self, validated_data):
+        options = self.pop_options(validated_data)
+        hook = super(HookSerializer, self).create(validated_data)
+        self.save_options(hook, options)
+        return hook
+
+    def update(self, instance, validated_data):
+        options = self.pop_options(validated_data)
+        hook = super(HookSerializer, self).update(instance, validated_data)
+        self.save_options(hook, options)
+        return hook
+
 
 class AddressSerializer(serializers.Serializer):
     address = serializers.CharField(max_length=500)
@@ -1,41 +1,312 @@
-import json
+import hashlib
 import uuid
+from datetime import timedelta
+
 import requests
 from celery.task import Task
 from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
 from go_http.metrics import MetricsApiClient
-from .models import Identity, DetailKey
+from rest_hooks.models import Hook
+from .bloom import BloomFilter, key as bloom_key
+from .delivery import (CircuitOpen, dead_letter, deliver_all, retry_delay,
+                       send_hook)
+from .hooks import HookPayload, encode_body
+from .models import (Identity, DetailKey, OutboxMessage, HookDelivery,
+                     FailedHookDelivery, HookOptions, CoalescedHookEvent,
+                     IdentityAddress, OptOutBloomFilter, Change)
+
+
+def queue_task(task, kwargs):
+    """
+    Queues `task` to run with `kwargs`. With OUTBOX_ENABLED the task is
+    written to the outbox as part of the current transaction and published
+    by relay_outbox once committed, otherwise it is published immediately.
+    """
+    if settings.OUTBOX_ENABLED:
+        OutboxMessage.objects.create(task_name=task.name, kwargs=kwargs)
+    else:
+        task.apply_async(kwargs=kwargs)
 
 
 class DeliverHook(Task):
-    def run(self, target, payload, instance_id=None, hook_id=None, **kwargs):
+    def run(self, target, payload=None, instance_id=None, hook_id=None,
+            body=None, content_encoding=None, previous_attempts=0,
+            **kwargs):
         """
         target:     the url to receive the payload.
         payload:    a python primitive data structure
         instance_id:   a possibly None "trigger" instance ID
         hook_id:       the ID of defining Hook object
+        body:       the payload encoded by encode_body, used instead of
+                    payload
+        content_encoding:  the content encoding of body
+        previous_attempts:  deliveries already tried outside this task,
+                    which count towards HOOK_MAX_RETRIES
         """
-        requests.post(
-            url=target,
-            data=json.dumps(payload),
-            headers={
-                'Content-Type': 'application/json',
-                'Authorization': 'Token %s' % settings.HOOK_AUTH_TOKEN
-            }
-        )
+        if body is None:
+            body, content_encoding = encode_body(payload)
+        try:
+            send_hook(target, body, content_encoding=content_encoding)
+        except (CircuitOpen, requests.exceptions.RequestException) as e:
+            attempts = previous_attempts + self.request.retries + 1
+            if attempts > settings.HOOK_MAX_RETRIES:
+                dead_letter([(HookDelivery(
+                    hook_id=hook_id, target=target, body=body,
+                    content_encoding=content_encoding,
+                    instance_id=instance_id, attempts=attempts), e)])
+                return "Gave up delivering to <%s> after %s attempts" % (
+                    target, attempts)
+            # Not thrown, so that eagerly run tasks (which retry at once)
+            # don't raise Retry to their caller
+            countdown = retry_delay(attempts)
+            self.retry(
+                kwargs=dict(target=target, instance_id=instance_id,
+                            hook_id=hook_id, body=body,
+                            content_encoding=content_encoding,
+                            previous_attempts=previous_attempts),
+                exc=e, countdown=countdown,
+                max_retries=settings.HOOK_MAX_RETRIES, throw=False)
+            return "Retrying delivery to <%s> in <%s>s" % (target, countdown)
+        return "Delivered to <%s>" % target
 
 
-def deliver_hook_wrapper(target, payload, instance, hook):
+def get_instance_id(instance):
     if instance is not None:
         if isinstance(instance.id, uuid.UUID):
-            instance_id = str(instance.id)
-        else:
-            instance_id = instance.id
-    else:
-        instance_id = None
-    kwargs = dict(target=target, payload=payload,
+            return str(instance.id)
+        return instance.id
+    return None
+
+
+def encode_for_hook(payload, options):
+    """
+    Encodes a payload in the format the hook's options ask for. Events sent
+    with a HookPayload are only encoded once per format.
+    """
+    if isinstance(payload, HookPayload):
+        return payload.encode(options.payload_format, options.compress)
+    return encode_body(payload, options.compress)
+
+
+def get_identity_id(payload, instance):
+    """
+    The identity an event is about: the instance for identity events and
+    the payload's identity for opt-out and opt-in events.
+    """
+    if isinstance(instance, Identity):
+        return str(instance.id)
+    if isinstance(payload, dict) and payload.get("identity"):
+        return str(payload["identity"])
+    return None
+
+
+def coalesce_event(options, target, body, content_encoding, instance_id,
+                   identity_id):
+    """
+    Holds an event for hooks with a coalesce window, replacing any event
+    already held for the same identity so that only the latest is delivered
+    once the window is up. Returns whether the event was held, which it
+    never is unless HOOK_COALESCING_ENABLED.
+    """
+    if not settings.HOOK_COALESCING_ENABLED:
+        return False
+    if not options.coalesce_window or identity_id is None:
+        return False
+    with transaction.atomic():
+        event, created = (
+            CoalescedHookEvent.objects.select_for_update().get_or_create(
+                hook_id=options.hook_id, identity_id=identity_id,
+                defaults=dict(
+                    target=target, body=body,
+                    content_encoding=content_encoding,
+                    instance_id=instance_id,
+                    deliver_at=timezone.now() + timedelta(
+                        seconds=options.coalesce_window))))
+        if not created:
+            CoalescedHookEvent.objects.filter(id=event.id).update(
+                target=target, body=body, content_encoding=content_encoding,
+                instance_id=instance_id, events=event.events + 1)
+    return True
+
+
+def deliver_hook_wrapper(target, payload, instance, hook):
+    options = HookOptions.for_hook(hook)
+    if not options.accepts(payload):
+        return
+    body, content_encoding = encode_for_hook(payload, options)
+    instance_id = get_instance_id(instance)
+    if coalesce_event(options, target, body, content_encoding, instance_id,
+                      get_identity_id(payload, instance)):
+        return
+    kwargs = dict(target=target, body=body, content_encoding=content_encoding,
                   instance_id=instance_id, hook_id=hook.id)
-    DeliverHook.apply_async(kwargs=kwargs)
+    queue_task(DeliverHook, kwargs)
+
+
+def queue_hook_delivery(target, payload, instance, hook):
+    """
+    HOOK_DELIVERER that leaves the delivery to the deliver_hooks worker.
+    """
+    options = HookOptions.for_hook(hook)
+    if not options.accepts(payload):
+        return
+    body, content_encoding = encode_for_hook(payload, options)
+    instance_id = get_instance_id(instance)
+    if coalesce_event(options, target, body, content_encoding, instance_id,
+                      get_identity_id(payload, instance)):
+        return
+    HookDelivery.objects.create(
+        hook_id=hook.id, target=target, body=body,
+        content_encoding=content_encoding, instance_id=instance_id)
+
+
+class FanOutHookEvent(Task):
+
+    """ Delivers an event to all of a user's hooks for it concurrently, from
+        a single task carrying a single copy of the payload. Deliveries that
+        fail are retried separately through DeliverHook, counting the fan-out
+        attempt towards HOOK_MAX_RETRIES.
+    """
+    name = "seed_identity_store.identities.tasks.fan_out_hook_event"
+
+    def run(self, event_name, payload, compact, user_id, instance_id=None,
+            **kwargs):
+        payload = HookPayload(payload, compact=compact)
+        hooks = list(Hook.objects.filter(event=event_name, user_id=user_id))
+        options = dict(
+            (o.hook_id, o) for o in HookOptions.objects.filter(
+                hook_id__in=[hook.id for hook in hooks]))
+
+        identity_id = get_identity_id(payload, None)
+        deliveries = []
+        for hook in hooks:
+            hook_options = options.get(hook.id, HookOptions(hook_id=hook.id))
+            if not hook_options.accepts(payload):
+                continue
+            body, content_encoding = payload.encode(
+                hook_options.payload_format, hook_options.compress)
+            if coalesce_event(hook_options, hook.target, body,
+                              content_encoding, instance_id, identity_id):
+                continue
+            deliveries.append(HookDelivery(
+                hook_id=hook.id, target=hook.target, body=body,
+                content_encoding=content_encoding, instance_id=instance_id,
+                attempts=1))
+
+        failed = deliver_all(deliveries)
+        if settings.HOOK_MAX_RETRIES < 1:
+            dead_letter(failed)
+        else:
+            for delivery, error in failed:
+                DeliverHook.apply_async(kwargs=dict(
+                    target=delivery.target, hook_id=delivery.hook_id,
+                    instance_id=delivery.instance_id, body=delivery.body,
+                    content_encoding=delivery.content_encoding,
+                    previous_attempts=delivery.attempts),
+                    countdown=retry_delay(delivery.attempts))
+        return "Delivered <%s> to <%s> of <%s> hooks" % (
+            event_name, len(deliveries) - len(failed), len(deliveries))
+
+fan_out_hook_event = FanOutHookEvent()
+
+
+class FlushCoalescedEvents(Task):
+
+    """ Hands the coalesced hook events whose window is up to DeliverHook.
+    """
+    name = "seed_identity_store.identities.tasks.flush_coalesced_events"
+
+    def run(self, batch_size=None, **kwargs):
+        batch_size = batch_size or settings.OUTBOX_BATCH_SIZE
+        flushed = 0
+        while True:
+            with transaction.atomic():
+                events = list(
+                    CoalescedHookEvent.objects.select_for_update()
+                    .filter(deliver_at__lte=timezone.now())
+                    .order_by('deliver_at')[:batch_size])
+                for event in events:
+                    queue_task(DeliverHook, dict(
+                        target=event.target, instance_id=event.instance_id,
+                        hook_id=event.hook_id, body=event.body,
+                        content_encoding=event.content_encoding))
+                CoalescedHookEvent.objects.filter(
+                    id__in=[e.id for e in events]).delete()
+            flushed += len(events)
+            if len(events) < batch_size:
+                break
+        return "Flushed <%s> coalesced hook events" % flushed
+
+flush_coalesced_events = FlushCoalescedEvents()
+
+
+class RebuildOptOutFilter(Task):
+
+    """ Builds a new version of the Bloom filter of opted out addresses if
+        they have changed since the last one, keeping the previous
+        OPTOUT_FILTER_VERSIONS versions.
+    """
+    name = "seed_identity_store.identities.tasks.rebuild_optout_filter"
+
+    def run(self, **kwargs):
+        addresses = IdentityAddress.objects.filter(
+            optedout=True).values_list(
+            'address_type', 'normalized_address').distinct()
+        bloom_filter = BloomFilter.for_capacity(
+            addresses.count(), settings.OPTOUT_FILTER_ERROR_RATE,
+            settings.MSISDN_DEFAULT_COUNTRY_CODE)
+        for address_type, address in addresses.iterator():
+            bloom_filter.add(bloom_key(address_type, address))
+        data = bloom_filter.to_bytes()
+        etag = hashlib.sha1(data).hexdigest()
+
+        latest = OptOutBloomFilter.objects.latest_version()
+        if latest is not None and latest.etag == etag:
+            return "Opt-out filter version <%s> is up to date" % latest.id
+        version = OptOutBloomFilter.objects.create(
+            data=data, etag=etag, address_count=bloom_filter.count)
+        # Ids can have gaps, so the oldest version kept is found by order
+        stale = OptOutBloomFilter.objects.order_by('-id').values_list(
+            'id', flat=True)[settings.OPTOUT_FILTER_VERSIONS:]
+        OptOutBloomFilter.objects.filter(id__in=list(stale)).delete()
+        return "Built opt-out filter version <%s> of <%s> addresses" % (
+            version.id, version.address_count)
+
+rebuild_optout_filter = RebuildOptOutFilter()
+
+
+class PruneChanges(Task):
+
+    """ Removes change feed entries older than CHANGE_RETENTION_DAYS.
+    """
+    name = "seed_identity_store.identities.tasks.prune_changes"
+
+    def run(self, **kwargs):
+        cutoff = timezone.now() - timedelta(
+            days=settings.CHANGE_RETENTION_DAYS)
+        deleted, _ = Change.objects.filter(created_at__lt=cutoff).delete()
+        return "Pruned <%s> changes" % deleted
+
+prune_changes = PruneChanges()
+
+
+def replay_failed_deliveries(failed_deliveries):
+    """
+    Queues the given FailedHookDelivery records for delivery again and
+    removes them. Returns the number of deliveries queued.
+    """
+    with transaction.atomic():
+        failed_deliveries = list(failed_deliveries.select_for_update())
+        for failed in failed_deliveries:
+            queue_task(DeliverHook, dict(
+                target=failed.target, instance_id=failed.instance_id,
+                hook_id=failed.hook_id, body=failed.body,
+                content_encoding=failed.content_encoding))
+        FailedHookDelivery.objects.filter(
+            id__in=[failed.id for failed in failed_deliveries]).delete()
+    return len(failed_deliveries)
 
 
 def get_metric_client(session=None):
@@ -117,3 +388,33 @@ class PopulateDetailKey(Task):
         return "Added <%s> new DetailKey records" % len(new_items)
 
 populate_detail_key = PopulateDetailKey()
+
+
+class RelayOutbox(Task):
+
+    """ Publishes the tasks waiting in the outbox, in batches over a single
+        broker connection, and removes them once published.
+    """
+    name = "seed_identity_store.identities.tasks.relay_outbox"
+
+    def run(self, batch_size=None, **kwargs):
+        batch_size = batch_size or settings.OUTBOX_BATCH_SIZE
+        published = 0
+        while True:
+            with transaction.atomic():
+                messages = list(OutboxMessage.objects.select_for_update()
+                                .order_by('id')[:batch_size])
+                if messages:
+                    with self.app.producer_or_acquire() as producer:
+                        for message in messages:
+                            task = self.app.tasks[message.task_name]
+                            task.apply_async(kwargs=message.kwargs,
+                                             producer=producer)
+                    OutboxMessage.objects.filter(
+                        id__in=[m.id for m in messages]).delete()
+            published += len(messages)
+            if len(messages) < batch_size:
+                break
+        return "Published <%s> outbox messages" % published
+
+relay_outbox = RelayOutbox()
@@ -1,5 +1,11 @@
+import gzip
+import io
 import json
+import os
+import requests
 import responses
+import tempfile
+import time
 
 try:
     from urllib.parse import urlparse
@@ -7,8 +13,13 @@ except ImportError:
     from urlparse import urlparse
 
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection, transaction
 from django.db.models.signals import post_save
-from django.test import TestCase
+from django.http import HttpResponse
+from django.test import (TestCase, TransactionTestCase, RequestFactory,
+                         override_settings)
 from django.conf import settings
 from rest_framework import status
 from rest_framework.test import APIClient
@@ -17,10 +28,31 @@ from rest_hooks.models import Hook
 from requests_testadapter import TestAdapter, TestSession
 from go_http.metrics import MetricsApiClient
 
-from .models import (Identity, OptOut, OptIn, DetailKey, handle_optout,
+from .addresses import normalize_msisdn
+from .admin import EstimatedCountPaginator
+from .delivery import (HookDeliveryWorker, CircuitBreaker, retry_delay,
+                       fair_shares, interleave)
+from .detail_indexes import split_indexed_filter, create_index_sql
+from .facets import query_facet
+from .guards import QueryTooExpensive, statement_timeout
+from .hooks import (HookPayload, encode_body, decode_body, parse_filter,
+                    filter_matches)
+from .models import (Identity, OptOut, OptIn, DetailKey, OutboxMessage,
+                     HookDelivery, FailedHookDelivery, HookOptions,
+                     CoalescedHookEvent, IdentityAddress, DetailFacetCount,
+                     OptOutBloomFilter,
+                     handle_optout,
                      handle_optin, fire_metrics_if_new)
-from .tasks import deliver_hook_wrapper, fire_metric, scheduled_metrics
-from . import tasks
+from .tasks import (deliver_hook_wrapper, fire_metric, scheduled_metrics,
+                    relay_outbox, queue_hook_delivery,
+                    replay_failed_deliveries,
+                    flush_coalesced_events, rebuild_optout_filter)
+from .management.commands.replay_requests import endpoint_name
+from .middleware import RequestCaptureMiddleware, ReplicaRoutingMiddleware
+from .views import (IdentitySearchList, CreatedAtCursorPagination,
+                    OptOutStatus)
+from . import bloom, changes, loadtest, tasks
+from seed_identity_store import dbpool, routers
 
 
 class RecordingAdapter(TestAdapter):
@@ -64,6 +96,14 @@ class AuthenticatedAPITestCase(APITestCase):
             }
         return Identity.objects.create(**id_data)
 
+    def make_hook(self, target='http://example.com/api/v1/',
+                  event='optout.requested', **options):
+        hook = Hook.objects.create(user=self.user, event=event,
+                                   target=target)
+        if options:
+            HookOptions.objects.create(hook_id=hook.id, **options)
+        return hook
+
     def _replace_get_metric_client(self, session=None):
         return MetricsApiClient(
             auth_token=settings.METRICS_AUTH_TOKEN,
@@ -89,6 +129,7 @@ class AuthenticatedAPITestCase(APITestCase):
     def setUp(self):
         super(AuthenticatedAPITestCase, self).setUp()
 
+        cache.clear()
         self._replace_post_save_hooks()
         tasks.get_metric_client = self._replace_get_metric_client
 
@@ -1256,6 +1297,7 @@ class TestHealthcheckAPI(AuthenticatedAPITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data["up"], True)
         self.assertEqual(response.data["result"]["database"], "Accessible")
+        self.assertTrue("database_pools" in response.data["result"])
 
 
 class TestMetricsAPI(AuthenticatedAPITestCase):
@@ -1270,6 +1312,8 @@ class TestMetricsAPI(AuthenticatedAPITestCase):
         self.assertEqual(
             response.data["metrics_available"], [
                 'identities.created.sum',
+                'identities.query.rejected.sum',
+                'identities.query.downgraded.sum',
                 'identities.created.last',
             ]
         )
@@ -1412,3 +1456,1519 @@ class TestMetrics(AuthenticatedAPITestCase):
             adapter.request, 'POST',
             data={"identities.created.last": 2.0}
         )
+
+
+class TestLoadTestHelpers(AuthenticatedAPITestCase):
+
+    def test_measure(self):
+        # Setup
+        self.make_identity()
+        # Execute
+        result = loadtest.measure(
+            "count", lambda: Identity.objects.count(), iterations=3)
+        # Check
+        self.assertEqual(result["name"], "count")
+        self.assertEqual(result["iterations"], 3)
+        self.assertEqual(result["queries"], 1.0)
+        self.assertTrue(result["mean_ms"] >= 0)
+
+    def test_percentile(self):
+        self.assertEqual(loadtest.percentile([], 95), 0.0)
+        self.assertEqual(loadtest.percentile([3, 1, 2], 50), 2)
+        self.assertEqual(loadtest.percentile(list(range(101)), 95), 95)
+
+    def test_stub_server(self):
+        # Setup
+        server = loadtest.StubServer().start()
+        # Execute
+        try:
+            response = requests.post(server.url, data=json.dumps({}))
+        finally:
+            server.stop()
+        # Check
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(server.request_count, 1)
+
+    def test_stub_server_errors_and_delays(self):
+        # Setup
+        server = loadtest.StubServer(error_rate=1.0,
+                                     timestamp_key="sent_at").start()
+        # Execute
+        try:
+            failed = requests.post(server.url, data=json.dumps({
+                "sent_at": time.time()}))
+            server.error_rate = 0
+            ok = requests.post(server.url, data=json.dumps({
+                "sent_at": time.time() - 1}))
+        finally:
+            server.stop()
+        # Check
+        self.assertEqual(failed.status_code, 500)
+        self.assertEqual(ok.status_code, 200)
+        self.assertEqual(server.request_count, 2)
+        self.assertEqual(server.error_count, 1)
+        self.assertEqual(len(server.delays), 1)
+        self.assertTrue(server.delays[0] >= 1)
+
+
+class TestRequestCapture(AuthenticatedAPITestCase):
+
+    def setUp(self):
+        super(TestRequestCapture, self).setUp()
+        handle, self.capture_file = tempfile.mkstemp()
+        os.close(handle)
+
+    def tearDown(self):
+        super(TestRequestCapture, self).tearDown()
+        os.remove(self.capture_file)
+
+    def test_capture_disabled_by_default(self):
+        with self.settings(REQUEST_CAPTURE_FILE=None):
+            self.assertRaises(MiddlewareNotUsed, RequestCaptureMiddleware)
+
+    def test_capture_redacts_secrets(self):
+        # Setup
+        with self.settings(REQUEST_CAPTURE_FILE=self.capture_file,
+                           REQUEST_CAPTURE_SAMPLE_RATE=1.0):
+            middleware = RequestCaptureMiddleware()
+        request = RequestFactory().post(
+            '/api/v1/optout/?token=abc&source=test',
+            json.dumps({"address": "+27123", "password": "secret"}),
+            content_type='application/json')
+        # Execute
+        middleware.process_request(request)
+        # Check
+        with open(self.capture_file) as capture:
+            records = [json.loads(line) for line in capture]
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]["method"], "POST")
+        self.assertEqual(records[0]["path"], "/api/v1/optout/")
+        self.assertEqual(sorted(records[0]["query"]),
+                         [["source", "test"], ["token", "redacted"]])
+        self.assertEqual(records[0]["body"],
+                         {"address": "+27123", "password": "redacted"})
+
+    def test_capture_ignores_non_api_requests(self):
+        # Setup
+        with self.settings(REQUEST_CAPTURE_FILE=self.capture_file,
+                           REQUEST_CAPTURE_SAMPLE_RATE=1.0):
+            middleware = RequestCaptureMiddleware()
+        # Execute
+        middleware.process_request(RequestFactory().get('/admin/'))
+        # Check
+        self.assertEqual(os.path.getsize(self.capture_file), 0)
+
+    def test_endpoint_name(self):
+        self.assertEqual(
+            endpoint_name(
+                "GET", "/api/v1/identities/"
+                "219f0f88-7d2b-414d-933c-1f8e652869c4/"),
+            "GET /api/v1/identities/{id}/")
+
+
+class TestOutbox(AuthenticatedAPITestCase):
+
+    def test_outbox_disabled(self):
+        # Execute
+        self.make_identity()
+        # Check
+        self.assertEqual(OutboxMessage.objects.count(), 0)
+        self.assertEqual(DetailKey.objects.count(), 4)
+
+    def test_outbox_written_in_transaction(self):
+        # Execute
+        with self.settings(OUTBOX_ENABLED=True):
+            self.make_identity()
+        # Check
+        self.assertEqual(DetailKey.objects.count(), 0)
+        message = OutboxMessage.objects.get()
+        self.assertEqual(message.task_name, tasks.populate_detail_key.name)
+        self.assertEqual(sorted(message.kwargs["key_names"]), [
+            "addresses", "default_addr_type", "name", "personnel_code"])
+
+    def test_relay_outbox(self):
+        # Setup
+        with self.settings(OUTBOX_ENABLED=True):
+            self.make_identity()
+            self.make_identity(id_data={"details": {"fresh": "as"}})
+        # Execute
+        result = relay_outbox.apply_async(kwargs={"batch_size": 1})
+        # Check
+        self.assertEqual(result.get(), "Published <2> outbox messages")
+        self.assertEqual(OutboxMessage.objects.count(), 0)
+        self.assertEqual(DetailKey.objects.count(), 5)
+
+    @responses.activate
+    def test_outbox_hook_delivery(self):
+        # Setup
+        hook = self.make_hook()
+        responses.add(
+            responses.POST,
+            'http://example.com/api/v1/',
+            json.dumps({}),
+            status=200, content_type='application/json')
+        # Execute
+        with self.settings(OUTBOX_ENABLED=True):
+            deliver_hook_wrapper('http://example.com/api/v1/', {"foo": "bar"},
+                                 None, hook)
+        self.assertEqual(len(responses.calls), 0)
+        relay_outbox.apply_async()
+        # Check
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(json.loads(responses.calls[0].request.body),
+                         {"foo": "bar"})
+
+
+class TestHookDeliveryWorker(AuthenticatedAPITestCase):
+
+    def test_queue_hook_delivery(self):
+        # Setup
+        hook = self.make_hook()
+        identity = self.make_identity()
+        # Execute
+        queue_hook_delivery(hook.target, {"foo": "bar"}, identity, hook)
+        # Check
+        delivery = HookDelivery.objects.get()
+        self.assertEqual(delivery.hook_id, hook.id)
+        self.assertEqual(delivery.target, hook.target)
+        self.assertEqual(json.loads(delivery.body), {"foo": "bar"})
+        self.assertEqual(delivery.instance_id, str(identity.id))
+
+    @responses.activate
+    def test_worker_delivers(self):
+        # Setup
+        hook = self.make_hook()
+        for i in range(3):
+            queue_hook_delivery(hook.target, {"count": i}, None, hook)
+        responses.add(
+            responses.POST,
+            'http://example.com/api/v1/',
+            json.dumps({}),
+            status=200, content_type='application/json')
+        # Execute
+        worker = HookDeliveryWorker(concurrency=2, batch_size=2,
+                                    poll_interval=0.1)
+        worker.run(until_empty=True)
+        worker.close()
+        # Check
+        self.assertEqual(len(responses.calls), 3)
+        self.assertEqual(
+            sorted(json.loads(c.request.body)["count"]
+                   for c in responses.calls),
+            [0, 1, 2])
+        self.assertEqual(responses.calls[0].request.headers["Authorization"],
+                         "Token %s" % settings.HOOK_AUTH_TOKEN)
+        self.assertEqual(HookDelivery.objects.count(), 0)
+
+    @responses.activate
+    def test_worker_keeps_failed_deliveries(self):
+        # Setup
+        hook = self.make_hook(target='http://example.com/down/')
+        queue_hook_delivery(hook.target, {"foo": "bar"}, None, hook)
+        # Execute
+        worker = HookDeliveryWorker(concurrency=2, poll_interval=0.1)
+        worker.run(until_empty=True)
+        worker.close()
+        # Check
+        delivery = HookDelivery.objects.get()
+        self.assertEqual(delivery.attempts, 1)
+
+
+class TestHookRetries(AuthenticatedAPITestCase):
+
+    def test_retry_delay(self):
+        with self.settings(HOOK_RETRY_BACKOFF=10, HOOK_RETRY_BACKOFF_MAX=60):
+            self.assertEqual(retry_delay(1), 10)
+            self.assertEqual(retry_delay(2), 20)
+            self.assertEqual(retry_delay(3), 40)
+            self.assertEqual(retry_delay(4), 60)
+
+    @responses.activate
+    def test_deliver_hook_retries_then_dead_letters(self):
+        # Setup
+        hook = self.make_hook()
+        responses.add(
+            responses.POST,
+            'http://example.com/api/v1/',
+            json.dumps({}),
+            status=500, content_type='application/json')
+        # Execute
+        with self.settings(HOOK_MAX_RETRIES=2):
+            deliver_hook_wrapper(hook.target, {"foo": "bar"}, None, hook)
+        # Check
+        self.assertEqual(len(responses.calls), 3)
+        failed = FailedHookDelivery.objects.get()
+        self.assertEqual(failed.target, hook.target)
+        self.assertEqual(failed.hook_id, hook.id)
+        self.assertEqual(json.loads(failed.body), {"foo": "bar"})
+        self.assertEqual(failed.attempts, 3)
+
+    @responses.activate
+    def test_circuit_breaker_fails_fast(self):
+        # Setup
+        hook = self.make_hook()
+        responses.add(
+            responses.POST,
+            'http://example.com/api/v1/',
+            json.dumps({}),
+            status=503, content_type='application/json')
+        # Execute
+        with self.settings(HOOK_MAX_RETRIES=3, HOOK_BREAKER_THRESHOLD=2):
+            deliver_hook_wrapper(hook.target, {"foo": "bar"}, None, hook)
+        # Check
+        self.assertEqual(len(responses.calls), 2)
+        failed = FailedHookDelivery.objects.get()
+        self.assertEqual(failed.attempts, 4)
+        self.assertTrue("Circuit open" in failed.error)
+
+    def test_circuit_breaker_single_trial(self):
+        # Setup
+        breaker = CircuitBreaker('http://example.com/api/v1/')
+        with self.settings(HOOK_BREAKER_THRESHOLD=2, HOOK_BREAKER_COOLDOWN=0):
+            breaker.record_failure()
+            self.assertTrue(breaker.allow())
+            breaker.record_failure()
+            # Execute
+            trials = [breaker.allow() for i in range(3)]
+            breaker.record_success()
+            # Check
+            self.assertEqual(trials, [True, False, False])
+            self.assertTrue(breaker.allow())
+            self.assertTrue(breaker.allow())
+
+    @responses.activate
+    def test_replay_failed_deliveries(self):
+        # Setup
+        hook = self.make_hook()
+        FailedHookDelivery.objects.create(
+            hook_id=hook.id, target=hook.target, body='{"foo": "bar"}',
+            attempts=9)
+        responses.add(
+            responses.POST,
+            'http://example.com/api/v1/',
+            json.dumps({}),
+            status=200, content_type='application/json')
+        # Execute
+        count = replay_failed_deliveries(FailedHookDelivery.objects.all())
+        # Check
+        self.assertEqual(count, 1)
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(json.loads(responses.calls[0].request.body),
+                         {"foo": "bar"})
+        self.assertEqual(FailedHookDelivery.objects.count(), 0)
+
+    @responses.activate
+    def test_worker_dead_letters(self):
+        # Setup
+        hook = self.make_hook(target='http://example.com/down/')
+        queue_hook_delivery(hook.target, {"foo": "bar"}, None, hook)
+        # Execute
+        with self.settings(HOOK_MAX_RETRIES=0):
+            worker = HookDeliveryWorker(concurrency=2, poll_interval=0.1)
+            worker.run(until_empty=True)
+            worker.close()
+        # Check
+        self.assertEqual(HookDelivery.objects.count(), 0)
+        failed = FailedHookDelivery.objects.get()
+        self.assertEqual(failed.attempts, 1)
+
+
+class TestHookDeliveryLanes(AuthenticatedAPITestCase):
+
+    def test_fair_shares_round_robin(self):
+        shares = fair_shares({"a": 100000, "b": 2, "c": 5}, 10)
+        self.assertEqual(shares, {"a": 4, "b": 2, "c": 4})
+
+    def test_fair_shares_weights_and_caps(self):
+        shares = fair_shares({"a": 100, "b": 100, "c": 100}, 12,
+                             weights={"a": 2}, caps={"c": 1})
+        self.assertEqual(shares, {"a": 8, "b": 3, "c": 1})
+
+    def test_interleave(self):
+        self.assertEqual(interleave([[1, 2, 3], [4], [5, 6]]),
+                         [1, 4, 5, 2, 6, 3])
+
+    def test_claim_shares_between_targets(self):
+        # Setup
+        busy = self.make_hook('http://example.com/busy/')
+        quiet = self.make_hook('http://example.com/quiet/')
+        for i in range(10):
+            queue_hook_delivery(busy.target, {"count": i}, None, busy)
+        queue_hook_delivery(quiet.target, {"count": 0}, None, quiet)
+        # Execute
+        worker = HookDeliveryWorker(concurrency=4)
+        claimed = worker.claim(4)
+        worker.close()
+        # Check
+        targets = [d.target for d in claimed]
+        self.assertEqual(len(targets), 4)
+        self.assertEqual(targets.count(quiet.target), 1)
+
+    def test_queue_depths_view(self):
+        # Setup
+        hook = self.make_hook()
+        queue_hook_delivery(hook.target, {"foo": "bar"}, None, hook)
+        queue_hook_delivery(hook.target, {"foo": "bar"}, None, hook)
+        FailedHookDelivery.objects.create(target=hook.target, body='{}')
+        # Execute
+        response = self.client.get('/api/v1/webhook/queues/',
+                                   content_type='application/json')
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["queues"], [{
+            "target": "http://example.com/api/v1/",
+            "pending": 2,
+            "due": 2,
+            "failed": 1,
+        }])
+
+
+class TestHookPayloads(AuthenticatedAPITestCase):
+
+    def test_encode_body_gzip(self):
+        body, content_encoding = encode_body({"foo": "bar"}, compress=True)
+        self.assertEqual(content_encoding, "gzip")
+        data = gzip.GzipFile(
+            fileobj=io.BytesIO(decode_body(body, content_encoding))).read()
+        self.assertEqual(json.loads(data.decode('utf-8')), {"foo": "bar"})
+
+    def test_hook_payload_encoded_once(self):
+        payload = HookPayload({"foo": "bar", "big": "x"}, compact={"foo": 1})
+        self.assertEqual(json.loads(payload.encode()[0]),
+                         {"foo": "bar", "big": "x"})
+        self.assertEqual(json.loads(payload.encode("compact")[0]),
+                         {"foo": 1})
+        self.assertTrue(payload.encode("compact") is
+                        payload.encode("compact"))
+
+    @responses.activate
+    def test_optout_compact_payload(self):
+        # Setup
+        post_save.connect(receiver=handle_optout, sender=OptOut)
+        user = User.objects.get(username='testuser')
+        self.make_hook(payload_format="compact")
+        identity = self.make_identity()
+        responses.add(
+            responses.POST,
+            'http://example.com/api/v1/',
+            json.dumps({}),
+            status=200, content_type='application/json')
+        # Execute
+        OptOut.objects.create(
+            identity=identity, created_by=user, request_source="test_source",
+            requestor_source_id=1, address_type="msisdn", address="+27123",
+            optout_type="stop")
+        # Check
+        self.assertEqual(json.loads(responses.calls[0].request.body), {
+            "identity": str(identity.id),
+            "event": "optout.requested",
+            "optout_type": "stop",
+            "optout_address_type": "msisdn",
+            "optout_address": "+27123",
+        })
+
+    @responses.activate
+    def test_deliver_gzipped_payload(self):
+        # Setup
+        hook = self.make_hook(compress=True)
+        responses.add(
+            responses.POST,
+            'http://example.com/api/v1/',
+            json.dumps({}),
+            status=200, content_type='application/json')
+        # Execute
+        deliver_hook_wrapper(hook.target, {"foo": "bar"}, None, hook)
+        # Check
+        request = responses.calls[0].request
+        self.assertEqual(request.headers["Content-Encoding"], "gzip")
+        data = gzip.GzipFile(fileobj=io.BytesIO(request.body)).read()
+        self.assertEqual(json.loads(data.decode('utf-8')), {"foo": "bar"})
+
+    def test_create_webhook_with_options(self):
+        # Setup
+        post_data = {
+            "target": "http://example.com/test_source/",
+            "event": "optout.requested",
+            "payload_format": "compact",
+            "compress": True
+        }
+        # Execute
+        response = self.client.post('/api/v1/webhook/',
+                                    json.dumps(post_data),
+                                    content_type='application/json')
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data["payload_format"], "compact")
+        self.assertEqual(response.data["compress"], True)
+        options = HookOptions.objects.get(hook_id=response.data["id"])
+        self.assertEqual(options.payload_format, "compact")
+        self.assertEqual(options.compress, True)
+
+
+class TestHookFanOut(AuthenticatedAPITestCase):
+
+    def setUp(self):
+        super(TestHookFanOut, self).setUp()
+        post_save.connect(receiver=handle_optout, sender=OptOut)
+
+    def make_optout(self, identity):
+        return OptOut.objects.create(
+            identity=identity, created_by=self.user,
+            request_source="test_source", requestor_source_id=1,
+            address_type="msisdn", address="+27123", optout_type="stop")
+
+    @responses.activate
+    def test_fan_out(self):
+        # Setup
+        full = self.make_hook('http://example.com/full/')
+        compact = self.make_hook('http://example.com/compact/',
+                                 payload_format="compact")
+        identity = self.make_identity()
+        for target in (full.target, compact.target):
+            responses.add(
+                responses.POST, target, json.dumps({}),
+                status=200, content_type='application/json')
+        # Execute
+        with self.settings(HOOK_FANOUT=True, OUTBOX_ENABLED=True):
+            self.make_optout(identity)
+        # Check
+        message = OutboxMessage.objects.get()
+        self.assertEqual(message.task_name, tasks.fan_out_hook_event.name)
+        relay_outbox.apply_async()
+        bodies = dict((c.request.url, json.loads(c.request.body))
+                      for c in responses.calls)
+        self.assertEqual(len(bodies), 2)
+        self.assertEqual(bodies[full.target]["optout_type"], "stop")
+        self.assertTrue("identity_details" in bodies[full.target])
+        self.assertEqual(bodies[compact.target]["optout_address"], "+27123")
+        self.assertFalse("identity_details" in bodies[compact.target])
+
+    @responses.activate
+    def test_fan_out_retries_failed_deliveries(self):
+        # Setup
+        up = self.make_hook('http://example.com/up/')
+        down = self.make_hook('http://example.com/down/')
+        identity = self.make_identity()
+        responses.add(
+            responses.POST, up.target, json.dumps({}),
+            status=200, content_type='application/json')
+        responses.add(
+            responses.POST, down.target, json.dumps({}),
+            status=500, content_type='application/json')
+        # Execute
+        with self.settings(HOOK_FANOUT=True, HOOK_MAX_RETRIES=1):
+            self.make_optout(identity)
+        # Check
+        urls = [c.request.url for c in responses.calls]
+        self.assertEqual(urls.count(up.target), 1)
+        self.assertEqual(urls.count(down.target), 2)
+        # The fan-out delivery counts as the first attempt, so DeliverHook
+        # tries once more before dead lettering it
+        optout = OptOut.objects.get()
+        failed = FailedHookDelivery.objects.get()
+        self.assertEqual(failed.target, down.target)
+        self.assertEqual(failed.hook_id, down.id)
+        self.assertEqual(failed.instance_id, str(optout.id))
+        self.assertEqual(failed.attempts, 2)
+
+
+class TestHookFilters(AuthenticatedAPITestCase):
+
+    def test_parse_filter(self):
+        self.assertEqual(
+            parse_filter("optout_type in (stop, 'stop all') and "
+                         "identity_details.lang != eng"),
+            [(["optout_type"], "in", ["stop", "stop all"]),
+             (["identity_details", "lang"], "!=", ["eng"])])
+        for expression in ("optout_type", "optout_type = stop",
+                           "optout_type in stop", "a == b or c == d",
+                           "optout_type not in"):
+            self.assertRaises(ValueError, parse_filter, expression)
+
+    def test_filter_matches(self):
+        payload = {"optout_type": "stop", "identity_details": {"lang": "eng"}}
+        self.assertTrue(filter_matches("optout_type == stop", payload))
+        self.assertTrue(filter_matches(
+            "optout_type in (stop, stopall) and identity_details.lang == eng",
+            payload))
+        self.assertFalse(filter_matches(
+            "optout_type not in (stop, stopall)", payload))
+        self.assertFalse(filter_matches("missing.key == stop", payload))
+
+    @responses.activate
+    def test_filtered_event_not_delivered(self):
+        # Setup
+        hook = self.make_hook(filter="optout_type == stopall")
+        responses.add(
+            responses.POST,
+            'http://example.com/api/v1/',
+            json.dumps({}),
+            status=200, content_type='application/json')
+        # Execute
+        deliver_hook_wrapper(hook.target, {"optout_type": "stop"}, None, hook)
+        deliver_hook_wrapper(hook.target, {"optout_type": "stopall"}, None,
+                             hook)
+        # Check
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(json.loads(responses.calls[0].request.body),
+                         {"optout_type": "stopall"})
+
+    def test_create_webhook_invalid_filter(self):
+        # Setup
+        post_data = {
+            "target": "http://example.com/test_source/",
+            "event": "optout.requested",
+            "filter": "optout_type = stop"
+        }
+        # Execute
+        response = self.client.post('/api/v1/webhook/',
+                                    json.dumps(post_data),
+                                    content_type='application/json')
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertTrue("filter" in response.data)
+        self.assertEqual(Hook.objects.count(), 0)
+
+
+@override_settings(HOOK_COALESCING_ENABLED=True)
+class TestHookCoalescing(AuthenticatedAPITestCase):
+
+    def setUp(self):
+        super(TestHookCoalescing, self).setUp()
+        post_save.connect(receiver=handle_optout, sender=OptOut)
+        self.hook = self.make_hook(coalesce_window=10)
+
+    def make_optout(self, identity, optout_type):
+        return OptOut.objects.create(
+            identity=identity, created_by=self.user,
+            request_source="test_source", requestor_source_id=1,
+            address_type="msisdn", address="+27123", optout_type=optout_type)
+
+    @responses.activate
+    def test_repeated_events_coalesced(self):
+        # Setup
+        identity = self.make_identity()
+        other = self.make_identity()
+        responses.add(
+            responses.POST,
+            'http://example.com/api/v1/',
+            json.dumps({}),
+            status=200, content_type='application/json')
+        # Execute
+        self.make_optout(identity, "stop")
+        self.make_optout(identity, "stopall")
+        self.make_optout(other, "stop")
+        flush_coalesced_events.apply_async()
+        # Check
+        self.assertEqual(len(responses.calls), 0)
+        self.assertEqual(CoalescedHookEvent.objects.count(), 2)
+        held = CoalescedHookEvent.objects.get(identity_id=str(identity.id))
+        self.assertEqual(held.events, 2)
+
+        CoalescedHookEvent.objects.update(deliver_at=held.created_at)
+        flush_coalesced_events.apply_async()
+        self.assertEqual(len(responses.calls), 2)
+        types = sorted(json.loads(c.request.body)["optout_type"]
+                       for c in responses.calls)
+        self.assertEqual(types, ["stop", "stopall"])
+        self.assertEqual(CoalescedHookEvent.objects.count(), 0)
+
+    @responses.activate
+    def test_no_window_not_coalesced(self):
+        # Setup
+        HookOptions.objects.update(coalesce_window=0)
+        identity = self.make_identity()
+        responses.add(
+            responses.POST,
+            'http://example.com/api/v1/',
+            json.dumps({}),
+            status=200, content_type='application/json')
+        # Execute
+        self.make_optout(identity, "stop")
+        self.make_optout(identity, "stopall")
+        # Check
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual(CoalescedHookEvent.objects.count(), 0)
+
+
+class TestReplicaRouting(AuthenticatedAPITestCase):
+
+    def test_reads_go_to_primary_by_default(self):
+        router = routers.ReplicaRouter()
+        self.assertEqual(router.db_for_read(Identity), None)
+        with self.settings(REPLICA_DATABASES=['default']):
+            self.assertEqual(router.db_for_read(Identity), None)
+            with routers.use_replica():
+                self.assertEqual(router.db_for_read(Identity), 'default')
+        self.assertEqual(router.db_for_write(Identity), 'default')
+
+    def test_lagging_replica_skipped(self):
+        router = routers.ReplicaRouter()
+        with self.settings(REPLICA_DATABASES=['default'],
+                           REPLICA_MAX_LAG=-1):
+            with routers.use_replica():
+                self.assertEqual(router.db_for_read(Identity), None)
+
+    def test_middleware_disabled_without_replicas(self):
+        self.assertRaises(MiddlewareNotUsed, ReplicaRoutingMiddleware)
+
+    def test_reads_stick_to_primary_after_write(self):
+        # Setup
+        with self.settings(REPLICA_DATABASES=['default']):
+            middleware = ReplicaRoutingMiddleware()
+        factory = RequestFactory()
+        view = IdentitySearchList.as_view()
+        token = 'Token abc'
+        # Execute
+        read = factory.get('/api/v1/identities/search/',
+                           HTTP_AUTHORIZATION=token)
+        middleware.process_view(read, view, (), {})
+        before_write = routers.reading_from_replica()
+        middleware.process_response(read, HttpResponse())
+
+        write = factory.post('/api/v1/optout/', HTTP_AUTHORIZATION=token)
+        middleware.process_view(write, view, (), {})
+        middleware.process_response(write, HttpResponse(status=201))
+
+        read = factory.get('/api/v1/identities/search/',
+                           HTTP_AUTHORIZATION=token)
+        middleware.process_view(read, view, (), {})
+        after_write = routers.reading_from_replica()
+        middleware.process_response(read, HttpResponse())
+        # Check
+        self.assertTrue(before_write)
+        self.assertFalse(after_write)
+        self.assertFalse(routers.reading_from_replica())
+
+
+class FakeConnection(object):
+
+    """ Stands in for a psycopg2 connection in the connection pool tests
+    """
+    closed = 0
+    autocommit = True
+    fail_queries = False
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql):
+        if self.fail_queries:
+            raise Exception("server closed the connection")
+
+    def rollback(self):
+        pass
+
+    def reset(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+class TestConnectionPool(TestCase):
+
+    def test_connections_reused(self):
+        # Setup
+        pool = dbpool.ConnectionPool(FakeConnection, size=2, timeout=0)
+        # Execute
+        first = pool.checkout()
+        pool.checkin(first)
+        second = pool.checkout()
+        # Check
+        self.assertTrue(first is second)
+        self.assertEqual(first.autocommit, False)
+        stats = pool.stats()
+        self.assertEqual(stats["created"], 1)
+        self.assertEqual(stats["checkouts"], 2)
+        self.assertEqual(stats["in_use"], 1)
+
+    def test_pool_bounded(self):
+        # Setup
+        pool = dbpool.ConnectionPool(FakeConnection, size=1, timeout=0.01)
+        pool.checkout()
+        # Execute
+        self.assertRaises(dbpool.PoolExhausted, pool.checkout)
+        # Check
+        self.assertEqual(pool.stats()["waits"], 1)
+        self.assertEqual(pool.stats()["in_use"], 1)
+
+    def test_broken_connections_replaced(self):
+        # Setup
+        pool = dbpool.ConnectionPool(FakeConnection, size=1, timeout=0)
+        broken = pool.checkout()
+        pool.checkin(broken)
+        broken.fail_queries = True
+        # Execute
+        connection = pool.checkout()
+        # Check
+        self.assertFalse(connection is broken)
+        self.assertTrue(broken.closed)
+        self.assertEqual(pool.stats()["discarded"], 1)
+
+    def test_pools_per_process(self):
+        pool = dbpool.get_pool('test', FakeConnection, 1, 0)
+        self.assertTrue(dbpool.get_pool('test', FakeConnection, 1, 0) is pool)
+        self.assertEqual(dbpool.pool_stats()['test']["size"], 1)
+
+
+class TestContactableAddresses(AuthenticatedAPITestCase):
+
+    def test_addresses_synced(self):
+        # Execute
+        identity = self.make_identity()
+        # Check
+        addresses = dict(
+            ((a.address_type, a.address), (a.default, a.optedout))
+            for a in IdentityAddress.objects.filter(identity=identity))
+        self.assertEqual(addresses, {
+            ("msisdn", "+27123"): (True, False),
+            ("email", "foo1@bar.com"): (True, False),
+            ("email", "foo2@bar.com"): (False, False),
+        })
+
+    def test_addresses_synced_on_optout(self):
+        # Setup
+        identity = self.make_identity()
+        # Execute
+        identity.optout_address("single", "email", "foo1@bar.com")
+        identity.details["addresses"]["msisdn"] = {}
+        identity.save()
+        # Check
+        self.assertEqual(
+            list(IdentityAddress.objects.contactable().values_list(
+                'address', flat=True)),
+            ["foo2@bar.com"])
+        self.assertEqual(IdentityAddress.objects.count(), 2)
+
+    def test_stream_contactable_addresses(self):
+        # Setup
+        first = self.make_identity()
+        second = self.make_identity()
+        second.optout_address("single", "email", "foo2@bar.com")
+        # Execute
+        with self.settings(CONTACTABLE_CHUNK_SIZE=1):
+            response = self.client.get(
+                '/api/v1/addresses/contactable/',
+                {"address_type": "email", "default": "true"})
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        addresses = json.loads(
+            b''.join(response.streaming_content).decode('utf-8'))
+        self.assertEqual(
+            [(a["identity"], a["address"]) for a in addresses],
+            [(str(first.id), "foo1@bar.com"),
+             (str(second.id), "foo1@bar.com")])
+        self.assertEqual(
+            addresses, sorted(addresses, key=lambda a: a["id"]))
+
+    def test_stream_requires_address_type(self):
+        response = self.client.get('/api/v1/addresses/contactable/')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class TestIdentityCount(AuthenticatedAPITestCase):
+
+    def setUp(self):
+        super(TestIdentityCount, self).setUp()
+        self.make_identity()
+        inactive = self.make_identity()
+        inactive.details["addresses"]["msisdn"]["+27123"]["inactive"] = True
+        inactive.save()
+        self.make_identity({"details": {"lang": "xh", "addresses": {}}})
+
+    def test_exact_count(self):
+        # Execute
+        response = self.client.get('/api/v1/identities/count/', {
+            "details__addresses__msisdn": "+27123",
+            "include_inactive": "false"})
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {
+            "count": 1, "exact": True, "method": "exact", "error": 0})
+
+    def test_sampled_count(self):
+        # Execute
+        with self.settings(COUNT_SAMPLE_PERCENT=100):
+            response = self.client.get('/api/v1/identities/count/', {
+                "details__addresses__msisdn": "+27123", "exact": "false"})
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {
+            "count": 2, "exact": False, "method": "sample", "error": 0})
+
+    def test_planner_count(self):
+        # Execute
+        response = self.client.get('/api/v1/identities/count/', {
+            "details__lang": "xh", "exact": "false", "method": "plan"})
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["method"], "plan")
+        self.assertTrue(response.data["count"] >= 0)
+        self.assertEqual(response.data["error"], None)
+
+    def test_unknown_method(self):
+        response = self.client.get('/api/v1/identities/count/', {
+            "exact": "false", "method": "guess"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class TestDetailFacets(AuthenticatedAPITestCase):
+
+    def make_identity_with(self, **details):
+        details.setdefault("addresses", {})
+        return self.make_identity({"details": details})
+
+    def facet_counts(self, key_name):
+        return dict(DetailFacetCount.objects.filter(
+            key_name=key_name, count__gt=0).values_list('value', 'count'))
+
+    def test_counts_maintained(self):
+        # Setup
+        identity = self.make_identity_with(preferred_language="xho")
+        self.make_identity_with(preferred_language="xho")
+        # Execute
+        identity = Identity.objects.get(id=identity.id)
+        identity.details["preferred_language"] = "eng"
+        identity.save()
+        self.make_identity_with(preferred_language="zul").delete()
+        # Check
+        self.assertEqual(self.facet_counts("preferred_language"),
+                         {"xho": 1, "eng": 1})
+
+    def test_facets(self):
+        # Setup
+        self.make_identity_with(preferred_language="xho", region="north")
+        self.make_identity_with(preferred_language="xho", region="south")
+        self.make_identity_with(preferred_language="eng", region="south")
+        # Execute
+        response = self.client.get('/api/v1/identities/facets/',
+                                   {"keys": "preferred_language,region"})
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["facets"], {
+            "preferred_language": {"source": "counts", "values": [
+                {"value": "xho", "count": 2},
+                {"value": "eng", "count": 1}]},
+            "region": {"source": "query", "values": [
+                {"value": "south", "count": 2},
+                {"value": "north", "count": 1}]},
+        })
+
+    def test_counts_match_query(self):
+        # Setup
+        nested = {"first": ["xho", 1.5, 10], "ab": {"pref": True},
+                  "z": None}
+        self.make_identity_with(preferred_language=nested)
+        self.make_identity_with(preferred_language=nested)
+        self.make_identity_with(preferred_language=u"isiZul\u00fa")
+        self.make_identity_with(preferred_language={u"\u00e9": 1, "ab": 2})
+        # Execute
+        counts = self.facet_counts("preferred_language")
+        queried = dict(query_facet("preferred_language"))
+        # Check
+        self.assertEqual(counts, queried)
+        self.assertEqual(counts[
+            '{"z": null, "ab": {"pref": true}, "first": ["xho", 1.5, 10]}'],
+            2)
+        self.assertEqual(counts[u'{"ab": 2, "\u00e9": 1}'], 1)
+
+    def test_unknown_key(self):
+        response = self.client.get('/api/v1/identities/facets/',
+                                   {"keys": "nope"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class TestIndexedDetailSearch(AuthenticatedAPITestCase):
+
+    KEYS = {"personnel_code": "text", "age": "numeric", "dob": "date"}
+
+    def setUp(self):
+        super(TestIndexedDetailSearch, self).setUp()
+        for age, dob in ((17, "1999-01-01"), (25, "1991-05-05"),
+                         ("unknown", "not a date")):
+            self.make_identity({"details": {
+                "age": age, "dob": dob, "addresses": {}}})
+
+    def search(self, params):
+        with self.settings(INDEXED_DETAIL_KEYS=self.KEYS):
+            return self.client.get('/api/v1/identities/search/', params)
+
+    def test_split_indexed_filter(self):
+        with self.settings(INDEXED_DETAIL_KEYS=self.KEYS):
+            self.assertEqual(split_indexed_filter("details__age__gte"),
+                             ("age", "numeric", ">="))
+            self.assertEqual(split_indexed_filter("details__dob"),
+                             ("dob", "date", "="))
+            self.assertEqual(split_indexed_filter("details__name"), None)
+            self.assertEqual(
+                split_indexed_filter("details__age__contains"), None)
+        self.assertEqual(
+            create_index_sql("age", "numeric"),
+            "CREATE INDEX CONCURRENTLY "
+            "identities_detail_age_numeric ON identities_identity "
+            "(identities_to_numeric(details->>'age'))")
+
+    def test_numeric_range(self):
+        response = self.search({"details__age__gte": "18"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([r["details"]["age"] for r in
+                          response.data["results"]], [25])
+
+    def test_date(self):
+        response = self.search({"details__dob__lt": "1995-01-01"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([r["details"]["dob"] for r in
+                          response.data["results"]], ["1991-05-05"])
+
+    def test_invalid_value(self):
+        response = self.search({"details__age": "old"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class TestQueryGuards(AuthenticatedAPITestCase):
+
+    def setUp(self):
+        super(TestQueryGuards, self).setUp()
+        self.make_identity()
+
+    def show_timeout(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SHOW statement_timeout")
+            return cursor.fetchone()[0]
+
+    def test_statement_timeout(self):
+        # Setup
+        before = self.show_timeout()
+        # Execute
+        with statement_timeout('default', 25):
+            during = self.show_timeout()
+        # Check
+        self.assertEqual(during, "25ms")
+        self.assertEqual(self.show_timeout(), before)
+
+    @responses.activate
+    def test_statement_timeout_cancels(self):
+        # Setup
+        self.session = None
+        responses.add(responses.POST, "http://metrics-url/metrics/",
+                      json={"foo": "bar"},
+                      status=200, content_type='application/json')
+        # Execute
+        with self.assertRaises(QueryTooExpensive):
+            with statement_timeout('default', 10):
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT pg_sleep(1)")
+        # Check
+        self.assertEqual(json.loads(responses.calls[0].request.body),
+                         {"identities.query.rejected.sum": 1.0})
+
+    @responses.activate
+    def test_search_over_cost_rejected(self):
+        # Setup
+        self.session = None
+        responses.add(responses.POST, "http://metrics-url/metrics/",
+                      json={"foo": "bar"},
+                      status=200, content_type='application/json')
+        # Execute
+        with self.settings(QUERY_GUARDS={
+                "identity-search": {"max_cost": 0.001}}):
+            response = self.client.get('/api/v1/identities/search/', {
+                "details__addresses__msisdn": "+27123"})
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertTrue("estimated cost" in response.data["detail"])
+        self.assertEqual(len(responses.calls), 1)
+
+    @responses.activate
+    def test_over_cost_without_replicas_rejected(self):
+        # Setup
+        self.session = None
+        responses.add(responses.POST, "http://metrics-url/metrics/",
+                      json={"foo": "bar"},
+                      status=200, content_type='application/json')
+        # Execute
+        with self.settings(QUERY_MAX_COST=0.001, QUERY_OVER_COST='replica',
+                           REPLICA_DATABASES=[]):
+            response = self.client.get('/api/v1/identities/')
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_under_cost_allowed(self):
+        # Execute
+        with self.settings(QUERY_MAX_COST=1e9):
+            response = self.client.get('/api/v1/identities/count/', {
+                "details__addresses__msisdn": "+27123",
+                "include_inactive": "false"})
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["count"], 1)
+
+
+class TestMsisdnNormalization(AuthenticatedAPITestCase):
+
+    def setUp(self):
+        super(TestMsisdnNormalization, self).setUp()
+        self.identity = self.make_identity({"details": {"addresses": {
+            "msisdn": {"+27821234567": {}}}}})
+
+    def test_normalize_msisdn(self):
+        for msisdn in ("+27821234567", "+27 82 123 4567", "0027821234567",
+                       "27821234567", "082-123-4567", "(082) 123 4567"):
+            self.assertEqual(normalize_msisdn(msisdn, "27"), "+27821234567")
+        self.assertEqual(normalize_msisdn("0821234567", ""), "0821234567")
+        self.assertEqual(normalize_msisdn("not a number", "27"),
+                         "not a number")
+
+    def test_address_normalized_on_save(self):
+        # Setup
+        identity = self.make_identity({"details": {"addresses": {
+            "msisdn": {"0831234567": {}}, "email": {"Foo@Bar.com": {}}}}})
+        # Check
+        addresses = IdentityAddress.objects.filter(identity=identity)
+        self.assertEqual(
+            sorted(addresses.values_list('address', 'normalized_address')),
+            [("0831234567", "+27831234567"),
+             ("Foo@Bar.com", "Foo@Bar.com")])
+
+    def test_filter_by_addr(self):
+        for msisdn in ("+27821234567", "27821234567", "0821234567"):
+            self.assertEqual(
+                list(Identity.objects.filter_by_addr("msisdn", msisdn)),
+                [self.identity])
+        self.assertEqual(
+            list(Identity.objects.filter_by_addr("msisdn", "0821234568")),
+            [])
+
+    def test_search_normalizes(self):
+        # Execute
+        response = self.client.get('/api/v1/identities/search/', {
+            "details__addresses__msisdn": "082 123 4567"})
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([r["id"] for r in response.data["results"]],
+                         [str(self.identity.id)])
+
+    def test_optout_normalizes(self):
+        # Execute
+        response = self.client.post('/api/v1/optout/', json.dumps({
+            "optout_type": "stop", "address_type": "msisdn",
+            "address": "0821234567", "request_source": "test_source"}),
+            content_type='application/json')
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        identity = Identity.objects.get(id=self.identity.id)
+        self.assertEqual(
+            identity.details["addresses"]["msisdn"]["+27821234567"],
+            {"optedout": True})
+
+
+class TestIdentityTraversal(AuthenticatedAPITestCase):
+
+    def setUp(self):
+        super(TestIdentityTraversal, self).setUp()
+        # A household: the head, two members communicating through the head
+        # and a dependent communicating through one of them
+        self.head = self.make_identity()
+        self.members = sorted([
+            Identity.objects.create(details={"addresses": {}},
+                                    communicate_through=self.head)
+            for _ in range(2)], key=lambda i: str(i.id))
+        self.child = Identity.objects.create(
+            details={"addresses": {}}, communicate_through=self.members[0])
+
+    def test_chain(self):
+        # Execute
+        response = self.client.get(
+            '/api/v1/identities/%s/chain/' % self.child.id)
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["complete"], True)
+        self.assertEqual(
+            [(r["depth"], r["identity"]["id"])
+             for r in response.data["results"]],
+            [(0, str(self.child.id)), (1, str(self.members[0].id)),
+             (2, str(self.head.id))])
+
+    def test_chain_depth_limit(self):
+        # Execute
+        response = self.client.get(
+            '/api/v1/identities/%s/chain/' % self.child.id, {"max_depth": 1})
+        # Check
+        self.assertEqual(response.data["complete"], False)
+        self.assertEqual(len(response.data["results"]), 2)
+
+    def test_chain_cycle(self):
+        # Setup
+        Identity.objects.filter(id=self.head.id).update(
+            communicate_through=self.child)
+        # Execute
+        response = self.client.get(
+            '/api/v1/identities/%s/chain/' % self.child.id)
+        # Check
+        self.assertEqual(response.data["complete"], False)
+        self.assertEqual(len(response.data["results"]), 3)
+
+    def test_dependents_pages(self):
+        # Execute
+        first = self.client.get(
+            '/api/v1/identities/%s/dependents/' % self.head.id, {"limit": 2})
+        second = self.client.get(first.data["next"])
+        # Check
+        self.assertEqual(
+            [(r["depth"], r["identity"]["id"])
+             for r in first.data["results"] + second.data["results"]],
+            [(1, str(self.members[0].id)), (1, str(self.members[1].id)),
+             (2, str(self.child.id))])
+        self.assertEqual(second.data["next"], None)
+
+    def test_dependents_invalid(self):
+        response = self.client.get(
+            '/api/v1/identities/%s/dependents/' % self.head.id,
+            {"via": "parent"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(
+            '/api/v1/identities/%s/dependents/' % self.head.id,
+            {"after": "soon"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get('/api/v1/identities/nope/dependents/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class TestAdmin(AuthenticatedAPITestCase):
+
+    def setUp(self):
+        super(TestAdmin, self).setUp()
+        self.identity = self.make_identity({"details": {"addresses": {
+            "msisdn": {"+27821234567": {}}}}})
+        self.other = self.make_identity()
+        self.client.login(username='testsu', password='dummypwd')
+
+    def test_estimated_count(self):
+        queryset = Identity.objects.all()
+        with self.settings(ADMIN_EXACT_COUNT_LIMIT=1000):
+            self.assertEqual(EstimatedCountPaginator(queryset, 10).count, 2)
+        with self.settings(ADMIN_EXACT_COUNT_LIMIT=-1):
+            self.assertTrue(
+                EstimatedCountPaginator(queryset, 10).count >= 0)
+
+    def test_identity_search_by_address(self):
+        # Execute
+        response = self.client.get('/admin/identities/identity/',
+                                   {"q": "0821234567"})
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertContains(response, str(self.identity.id))
+        self.assertNotContains(response, str(self.other.id))
+
+    def test_optout_changelist(self):
+        # Setup
+        OptOut.objects.create(
+            identity=self.identity, address_type="msisdn",
+            address="+27821234567", request_source="test_source")
+        # Execute
+        response = self.client.get('/admin/identities/optout/', {
+            "address_type": "msisdn", "q": str(self.identity.id)})
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertContains(response, "+27821234567")
+
+    def test_identity_change_form(self):
+        response = self.client.get(
+            '/admin/identities/identity/%s/change/' % self.identity.id)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotContains(response, '<select name="communicate_through"')
+
+
+class TestOptHistory(AuthenticatedAPITestCase):
+
+    def setUp(self):
+        super(TestOptHistory, self).setUp()
+        self.identity = self.make_identity()
+        self.optouts = [
+            OptOut.objects.create(
+                identity=self.identity, address_type="msisdn",
+                address="+27123", request_source="test_source",
+                optout_type="stop")
+            for _ in range(3)]
+        OptOut.objects.create(
+            identity=self.identity, address_type="email",
+            address="foo1@bar.com", request_source="test_source",
+            optout_type="stop")
+        OptIn.objects.create(
+            identity=self.identity, address_type="msisdn",
+            address="+27123", request_source="test_source")
+
+    def test_optout_history_pages(self):
+        # Setup
+        self.addCleanup(setattr, CreatedAtCursorPagination, 'page_size',
+                        CreatedAtCursorPagination.page_size)
+        CreatedAtCursorPagination.page_size = 2
+        # Execute
+        first = self.client.get('/api/v1/optout/', {
+            "address_type": "msisdn", "address": "+27123"})
+        second = self.client.get(first.data["next"])
+        # Check
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [r["id"] for r in first.data["results"] +
+             second.data["results"]],
+            [str(o.id) for o in reversed(self.optouts)])
+        self.assertEqual(second.data["next"], None)
+
+    def test_optout_history_since(self):
+        # Setup
+        since = self.optouts[1].created_at.isoformat()
+        # Execute
+        response = self.client.get('/api/v1/optout/', {
+            "identity": str(self.identity.id), "created_from": since})
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data["results"]), 3)
+
+    def test_optin_history(self):
+        # Execute
+        response = self.client.get('/api/v1/optin/', {
+            "identity": str(self.identity.id)})
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [r["address"] for r in response.data["results"]], ["+27123"])
+
+
+class TestOptOutStatus(AuthenticatedAPITestCase):
+
+    def setUp(self):
+        super(TestOptOutStatus, self).setUp()
+        self.identity = self.make_identity({"details": {"addresses": {
+            "msisdn": {"+27821234567": {}, "+27831234567": {}}}}})
+
+    def check(self, *addresses):
+        return self.client.post('/api/v1/optout/status/', json.dumps({
+            "addresses": [{"address_type": "msisdn", "address": address}
+                          for address in addresses]}),
+            content_type='application/json')
+
+    def test_status(self):
+        # Setup
+        OptOut.objects.create(
+            identity=self.identity, address_type="msisdn",
+            address="+27821234567", request_source="test_source",
+            optout_type="stop")
+        # Execute
+        response = self.check("0821234567", "+27831234567", "+27841234567")
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [(r["address"], r["optedout"], r["known"])
+             for r in response.data["results"]],
+            [("0821234567", True, True), ("+27831234567", False, True),
+             ("+27841234567", False, False)])
+
+    def test_optin_clears_status(self):
+        # Setup
+        OptOut.objects.create(
+            identity=self.identity, address_type="msisdn",
+            address="+27821234567", request_source="test_source",
+            optout_type="stop")
+        OptIn.objects.create(
+            identity=self.identity, address_type="msisdn",
+            address="+27821234567", request_source="test_source")
+        # Execute
+        response = self.check("+27821234567")
+        # Check
+        self.assertEqual(response.data["results"][0]["optedout"], False)
+
+    def test_invalid_batches(self):
+        response = self.client.post('/api/v1/optout/status/', json.dumps({
+            "addresses": [{"address_type": "msisdn"}]}),
+            content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        with self.settings(OPTOUT_STATUS_MAX_BATCH=1):
+            response = self.check("+27821234567", "+27831234567")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_check_does_not_pin_to_primary(self):
+        # Setup
+        with self.settings(REPLICA_DATABASES=['default']):
+            middleware = ReplicaRoutingMiddleware()
+        request = RequestFactory().post('/api/v1/optout/status/',
+                                        HTTP_AUTHORIZATION='Token abc')
+        # Execute
+        middleware.process_view(request, OptOutStatus.as_view(), (), {})
+        on_replica = routers.reading_from_replica()
+        middleware.process_response(request, HttpResponse())
+        # Check
+        self.assertTrue(on_replica)
+        self.assertEqual(cache.get(middleware.client_key(request)), None)
+
+
+class TestOptOutBloomFilter(AuthenticatedAPITestCase):
+
+    def setUp(self):
+        super(TestOptOutBloomFilter, self).setUp()
+        self.identity = self.make_identity({"details": {"addresses": {
+            "msisdn": {"+27821234567": {"optedout": True},
+                       "+27831234567": {}}}}})
+
+    def test_filter_round_trip(self):
+        # Setup
+        bloom_filter = bloom.BloomFilter.for_capacity(1000, 0.01)
+        for i in range(1000):
+            bloom_filter.add(bloom.key("msisdn", "+27%09d" % i))
+        path = tempfile.mktemp()
+        self.addCleanup(os.remove, path)
+        with open(path, 'wb') as f:
+            f.write(bloom_filter.to_bytes())
+        # Execute
+        loaded = bloom.load(path)
+        # Check
+        self.assertEqual(loaded.count, 1000)
+        self.assertTrue(all(loaded.contains_address("msisdn", "+27%09d" % i)
+                            for i in range(1000)))
+        false_positives = sum(
+            loaded.contains_address("msisdn", "+28%09d" % i)
+            for i in range(1000))
+        self.assertTrue(false_positives < 50)
+
+    def test_rebuild_versions(self):
+        # Execute
+        rebuild_optout_filter.apply_async()
+        rebuild_optout_filter.apply_async()
+        OptOut.objects.create(
+            identity=self.identity, address_type="msisdn",
+            address="+27831234567", request_source="test_source",
+            optout_type="stop")
+        rebuild_optout_filter.apply_async()
+        # Check
+        versions = OptOutBloomFilter.objects.order_by('id')
+        self.assertEqual([v.address_count for v in versions], [1, 2])
+        latest = bloom.BloomFilter.from_buffer(bytes(versions[1].data))
+        self.assertTrue(latest.contains_address("msisdn", "+27821234567"))
+        self.assertTrue(latest.contains_address("msisdn", "+27831234567"))
+
+    def test_rebuild_keeps_newest_versions(self):
+        # Setup
+        for etag in ("a", "b", "c"):
+            OptOutBloomFilter.objects.create(data=b"", etag=etag)
+        OptOutBloomFilter.objects.get(etag="c").delete()
+        # Execute
+        with self.settings(OPTOUT_FILTER_VERSIONS=2):
+            rebuild_optout_filter.apply_async()
+        # Check
+        versions = OptOutBloomFilter.objects.order_by('id')
+        self.assertEqual([v.etag for v in versions][:1], ["b"])
+        self.assertEqual(versions.count(), 2)
+
+    def test_national_msisdns(self):
+        # Setup
+        rebuild_optout_filter.apply_async()
+        # Execute
+        latest = bloom.BloomFilter.from_buffer(
+            bytes(OptOutBloomFilter.objects.get().data))
+        # Check
+        self.assertEqual(latest.country_code, "27")
+        self.assertTrue(latest.contains_address("msisdn", "0821234567"))
+        self.assertTrue(latest.contains_address("msisdn", "+27 82 123 4567"))
+        self.assertTrue(latest.contains_address("msisdn", "0027821234567"))
+
+    def test_download(self):
+        # Setup
+        rebuild_optout_filter.apply_async()
+        version = OptOutBloomFilter.objects.get()
+        # Execute
+        response = self.client.get('/api/v1/optout/filter/')
+        cached = self.client.get('/api/v1/optout/filter/',
+                                 HTTP_IF_NONE_MATCH=response['ETag'])
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['ETag'], '"%s"' % version.etag)
+        self.assertEqual(response['X-Filter-Version'], str(version.id))
+        self.assertTrue(bloom.BloomFilter.from_buffer(
+            response.content).contains_address("msisdn", "+27821234567"))
+        self.assertEqual(cached.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_no_filter_yet(self):
+        response = self.client.get('/api/v1/optout/filter/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class TestChangeFeed(TransactionTestCase):
+
+    # Changes are only returned once the transaction that made them has
+    # finished, so these tests commit their writes
+
+    def setUp(self):
+        post_save.disconnect(handle_optout, sender=Identity)
+        post_save.disconnect(handle_optin, sender=Identity)
+        post_save.disconnect(fire_metrics_if_new, sender=Identity)
+        self.client = APIClient()
+        self.user = User.objects.create_user('feeduser', 'feed@example.com',
+                                             'feedpass')
+        self.client.force_authenticate(user=self.user)
+        self.identity = Identity.objects.create(
+            details={"addresses": {"msisdn": {"+27123": {}}}})
+
+    def tearDown(self):
+        post_save.connect(handle_optout, sender=Identity)
+        post_save.connect(handle_optin, sender=Identity)
+        post_save.connect(fire_metrics_if_new, sender=Identity)
+
+    def feed(self, **params):
+        response = self.client.get('/api/v1/changes/', params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_changes_in_order(self):
+        # Setup
+        self.identity.details["lang"] = "en"
+        self.identity.save()
+        OptOut.objects.create(
+            identity=self.identity, address_type="msisdn",
+            address="+27123", request_source="test_source",
+            optout_type="stop")
+        # Execute
+        data = self.feed()
+        # Check
+        # The opt-out updates the identity before its own change is recorded
+        self.assertEqual(
+            [(c["model"], c["action"]) for c in data["results"]], [
+                ("identity", "created"), ("identity", "updated"),
+                ("identity", "updated"), ("optout", "created")])
+        self.assertEqual(data["results"][0]["id"], str(self.identity.id))
+        self.assertEqual(data["next"], data["results"][-1]["cursor"])
+        self.assertFalse(data["more"])
+
+    def test_resume_from_cursor(self):
+        # Setup
+        first = self.feed(limit=1)
+        self.identity.delete()
+        # Execute
+        rest = self.feed(since=first["next"])
+        empty = self.feed(since=rest["next"])
+        # Check
+        self.assertTrue(first["more"])
+        self.assertEqual([c["action"] for c in rest["results"]],
+                         ["deleted"])
+        self.assertEqual(empty["results"], [])
+        self.assertEqual(empty["next"], rest["next"])
+
+    def test_uncommitted_changes_held_back(self):
+        # Setup
+        cursor = self.feed()["next"]
+        # Execute
+        with transaction.atomic():
+            Identity.objects.create(details={"addresses": {}})
+            with connection.cursor() as db:
+                db.execute(changes.CHANGES_SQL,
+                           list(changes.parse_cursor(cursor)) + [10])
+                during = db.fetchall()
+        after = self.feed(since=cursor)
+        # Check
+        self.assertEqual(during, [])
+        self.assertEqual([c["action"] for c in after["results"]],
+                         ["created"])
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/v1/changes/', {"since": "latest"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
@@ -15,10 +15,22 @@ router.register(r'webhook', views.HookViewSet)
 urlpatterns = [
     url(r'^api/v1/identities/search/$',
         views.IdentitySearchList.as_view()),
+    url(r'^api/v1/identities/count/$', views.IdentityCount.as_view()),
+    url(r'^api/v1/identities/facets/$', views.DetailFacets.as_view()),
+    url(r'^api/v1/identities/(?P<identity_id>[^/]+)/chain/$',
+        views.IdentityChain.as_view()),
+    url(r'^api/v1/identities/(?P<identity_id>[^/]+)/dependents/$',
+        views.IdentityDependents.as_view()),
     url(r'^api/v1/identities/(?P<identity_id>.+)/addresses/(?P<address_type>.+)$',  # noqa
         views.IdentityAddresses.as_view()),
     url(r'^api/v1/user/token/$', views.UserView.as_view(),
         name='create-user-token'),
     url(r'^api/v1/detailkeys/', views.DetailKeyView.as_view()),
+    url(r'^api/v1/webhook/queues/$', views.HookQueueView.as_view()),
+    url(r'^api/v1/optout/status/$', views.OptOutStatus.as_view()),
+    url(r'^api/v1/optout/filter/$', views.OptOutBloomFilterView.as_view()),
+    url(r'^api/v1/changes/$', views.ChangeFeed.as_view()),
+    url(r'^api/v1/addresses/contactable/$',
+        views.ContactableAddresses.as_view()),
     url(r'^api/v1/', include(router.urls)),
 ]
@@ -1,17 +1,35 @@
-from rest_framework import viewsets, generics, mixins, status
+import json
+import uuid
+
+from rest_framework import viewsets, generics, mixins, pagination, status
 from rest_framework.exceptions import ValidationError
 from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.authtoken.models import Token
+from rest_framework.utils.urls import replace_query_param
 from rest_framework import filters
 from rest_hooks.models import Hook
+from django.conf import settings
 from django.contrib.auth.models import User, Group
-from .models import Identity, OptOut, OptIn, DetailKey
+from django.db import router
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.utils import six
+from .models import (Identity, OptOut, OptIn, DetailKey, IdentityAddress,
+                     DetailFacetCount, OptOutBloomFilter)
 from .serializers import (UserSerializer, GroupSerializer, AddressSerializer,
                           IdentitySerializer, OptOutSerializer, HookSerializer,
                           CreateUserSerializer, OptInSerializer)
+from seed_identity_store.dbpool import pool_stats
 from seed_identity_store.utils import get_available_metrics
+from . import chains, changes
+from .addresses import normalize_address
+from .delivery import queue_depths
+from .detail_indexes import filter_identities
+from .estimates import exclude_inactive, planner_count, sample_count
+from .facets import query_facet
+from .guards import (QueryGuardMixin, check_cost, query_guard,
+                     statement_timeout)
 from .tasks import scheduled_metrics
 import django_filters
 
@@ -72,10 +90,12 @@ class IdentityFilter(filters.FilterSet):
                   'created_at', 'created_by', 'updated_at', 'updated_by']
 
 
-class IdentityViewSet(viewsets.ModelViewSet):
+class IdentityViewSet(QueryGuardMixin, viewsets.ModelViewSet):
     """ API endpoint that allows identities to be viewed or edited.
     """
     permission_classes = (IsAuthenticated,)
+    read_from_replica = True
+    guard_name = 'identity-list'
     queryset = Identity.objects.all()
     serializer_class = IdentitySerializer
     filter_class = IdentityFilter
@@ -88,8 +108,95 @@ class IdentityViewSet(viewsets.ModelViewSet):
         serializer.save(updated_by=self.request.user)
 
 
-class IdentitySearchList(generics.ListAPIView):
+def search_criteria(query_params, ignore=()):
+    """
+    Builds the criteria to filter identities by from search query
+    parameters. Returns the filter criteria and, if the "include_inactive"
+    parameter is false, the (address type, address) pairs that shouldn't be
+    inactive. Parameters in `ignore` are left out.
+    """
+    # variable that stores criteria to filter identities by
+    filter_criteria = {}
+    # variable that stores a list of addresses that should be active
+    # if the special filter is passed in
+    exclude_if_address_inactive = []
+
+    # Determine from param "include_inactive" whether inactive identities
+    # should be included in the search results
+    if "include_inactive" in query_params:
+        if query_params["include_inactive"] in ["False", 'false', False]:
+            include_inactive = False
+        else:
+            include_inactive = True
+    else:
+        include_inactive = True  # default to True
+
+    # Compile a list of criteria to filter the identities by, based on the
+    # query parameters
+    for filter in query_params.keys():
+        if filter == "include_inactive" or filter in ignore:
+            # Don't add the special params to the filter_criteria
+            pass
+        elif filter.startswith("details__addresses__"):
+            # Edit the query_param to evaluate the key instead of the value
+            # and add it to the filter_criteria
+            filter_criteria[filter + "__has_key"] = query_params[filter]
+
+            # Add the address to the list of addresses that should not
+            # be inactive (tuple e.g ("msisdn", "+27123"))
+            if include_inactive is False:
+                exclude_if_address_inactive.append(
+                    (filter.replace("details__addresses__", ""),
+                     query_params[filter])
+                )
+        else:
+            # Add the normal params to the filter criteria
+            filter_criteria[filter] = query_params[filter]
+
+    return filter_criteria, exclude_if_address_inactive
+
+
+def address_filter_type(name):
+    """
+    The address type of an address filter made by search_criteria, such as
+    details__addresses__msisdn__has_key, or None for any other filter.
+    """
+    prefix, suffix = "details__addresses__", "__has_key"
+    if not (name.startswith(prefix) and name.endswith(suffix)):
+        return None
+    address_type = name[len(prefix):-len(suffix)]
+    if not address_type or "__" in address_type or address_type in (
+            "has_key", "has_keys", "has_any_keys"):
+        return None
+    return address_type
+
+
+def search_identities(filter_criteria):
+    """
+    Identities matching the filter criteria, using the indexes on declared
+    detail keys where it can. Addresses are looked up by their canonical
+    form, so that an msisdn matches however it was formatted.
+    """
+    identities = Identity.objects.all()
+    criteria = {}
+    for name, value in filter_criteria.items():
+        address_type = address_filter_type(name)
+        if address_type is None:
+            criteria[name] = value
+        else:
+            identities = identities.filter(
+                id__in=IdentityAddress.objects.lookup(
+                    address_type, value).values('identity_id'))
+    try:
+        return filter_identities(identities, criteria)
+    except ValueError as e:
+        raise ValidationError({"detail": [str(e)]})
+
+
+class IdentitySearchList(QueryGuardMixin, generics.ListAPIView):
     permission_classes = (IsAuthenticated,)
+    read_from_replica = True
+    guard_name = 'identity-search'
     serializer_class = IdentitySerializer
 
     def get_queryset(self):
@@ -108,61 +215,57 @@ class IdentitySearchList(generics.ListAPIView):
         e.g.
         {"include_inactive": False}
         """
-        query_params = list(self.request.query_params.keys())
-
-        # variable that stores criteria to filter identities by
-        filter_criteria = {}
-        # variable that stores a list of addresses that should be active
-        # if the special filter is passed in
-        exclude_if_address_inactive = []
-
-        # Determine from param "include_inactive" whether inactive identities
-        # should be included in the search results
-        if "include_inactive" in query_params:
-            if self.request.query_params["include_inactive"] in [
-              "False", 'false', False]:
-                include_inactive = False
-            else:
-                include_inactive = True
-        else:
-            include_inactive = True  # default to True
-
-        # Compile a list of criteria to filter the identities by, based on the
-        # query parameters
-        for filter in query_params:
-            if filter == "include_inactive":
-                # Don't add the special param to the filter_criteria
-                pass
-            elif filter.startswith("details__addresses__"):
-                # Edit the query_param to evaluate the key instead of the value
-                # and add it to the filter_criteria
-                filter_criteria[filter + "__has_key"] = \
-                    self.request.query_params[filter]
-
-                # Add the address to the list of addresses that should not
-                # be inactive (tuple e.g ("msisdn", "+27123"))
-                if include_inactive is False:
-                    exclude_if_address_inactive.append(
-                        (filter.replace("details__addresses__", ""),
-                         self.request.query_params[filter])
-                    )
-            else:
-                # Add the normal params to the filter criteria
-                filter_criteria[filter] = self.request.query_params[filter]
+        filter_criteria, exclude_if_address_inactive = search_criteria(
+            self.request.query_params)
 
-        identities = Identity.objects.filter(**filter_criteria)
+        return exclude_inactive(
+            search_identities(filter_criteria), exclude_if_address_inactive)
 
-        if include_inactive is False:
-            # Check through all the identities and exclude ones where the
-            # addresses are inactive
-            for identity in identities:
-                for param in exclude_if_address_inactive:
-                    q_key = identity.details["addresses"][param[0]][param[1]]
-                    if ('inactive' in q_key and q_key['inactive'] in [True, 'True', 'true']):  # noqa
-                        identities = identities.exclude(
-                            id=identity.id)
 
-        return identities
+class IdentityCount(APIView):
+
+    """ Counts the identities matching search parameters, as for
+        /identities/search/
+        GET - returns the count. With `exact=false` the count is estimated
+              from a sample of COUNT_SAMPLE_PERCENT percent of identities
+              (`method=sample`, the default) or from the query planner's
+              estimate (`method=plan`). Sampled counts come with the margin
+              of error at 95% confidence, planner estimates have none.
+    """
+    permission_classes = (IsAuthenticated,)
+    read_from_replica = True
+    METHODS = ('sample', 'plan')
+
+    def get(self, request, *args, **kwargs):
+        exact = request.query_params.get('exact', 'true') not in (
+            'false', 'False')
+        method = request.query_params.get('method', 'sample')
+        if method not in self.METHODS:
+            raise ValidationError({"method": [
+                "Must be one of %s." % ", ".join(self.METHODS)]})
+
+        filter_criteria, inactive_addresses = search_criteria(
+            request.query_params, ignore=('exact', 'method'))
+        queryset = exclude_inactive(
+            search_identities(filter_criteria), inactive_addresses)
+        using = router.db_for_read(Identity)
+        guard = query_guard('identity-count')
+
+        if exact:
+            using = check_cost(queryset, guard, using)
+            with statement_timeout(using, guard["timeout"]):
+                count = queryset.using(using).count()
+            return Response({"count": count, "exact": True,
+                             "method": "exact", "error": 0})
+        if method == 'plan':
+            return Response({"count": planner_count(queryset, using),
+                             "exact": False, "method": method,
+                             "error": None})
+        with statement_timeout(using, guard["timeout"]):
+            count, error = sample_count(
+                queryset, settings.COUNT_SAMPLE_PERCENT, using)
+        return Response({"count": count, "exact": False, "method": method,
+                         "error": error})
 
 
 class Address(object):
@@ -211,12 +314,92 @@ class IdentityAddresses(generics.ListAPIView):
         return response
 
 
-class OptInViewSet(mixins.CreateModelMixin, viewsets.GenericViewSet):
-    """ API endpoint that allows opt-ins to be created.
+def stream_addresses(queryset, after=0, chunk_size=None):
+    """
+    Yields a JSON list of the addresses in the queryset in id order, read in
+    chunks that each continue from the last id of the one before.
+    """
+    chunk_size = chunk_size or settings.CONTACTABLE_CHUNK_SIZE
+    separator = ''
+    yield '['
+    while True:
+        chunk = list(
+            queryset.filter(id__gt=after).order_by('id').values_list(
+                'id', 'identity_id', 'address', 'default')[:chunk_size])
+        for address_id, identity_id, address, default in chunk:
+            yield separator + json.dumps({
+                "id": address_id,
+                "identity": str(identity_id),
+                "address": address,
+                "default": default,
+            })
+            separator = ','
+        if len(chunk) < chunk_size:
+            break
+        after = chunk[-1][0]
+    yield ']'
+
+
+class ContactableAddresses(APIView):
+
+    """ Contactable addresses for campaign targeting
+        GET - streams the addresses of `address_type` that aren't opted out
+              or inactive, in id order. `default=true` only returns default
+              addresses and `after` resumes after the given id.
     """
     permission_classes = (IsAuthenticated,)
+    read_from_replica = True
+
+    def get(self, request, *args, **kwargs):
+        address_type = request.query_params.get('address_type')
+        if not address_type:
+            raise ValidationError(
+                {"address_type": ["This field is required."]})
+        try:
+            after = int(request.query_params.get('after', 0))
+        except ValueError:
+            raise ValidationError({"after": ["A valid integer is required."]})
+
+        queryset = IdentityAddress.objects.contactable().filter(
+            address_type=address_type)
+        if request.query_params.get('default') in ('true', 'True'):
+            queryset = queryset.filter(default=True)
+        # Pick the database now, while a replica may still be in use
+        queryset = queryset.using(router.db_for_read(IdentityAddress))
+        return StreamingHttpResponse(stream_addresses(queryset, after),
+                                     content_type='application/json')
+
+
+class CreatedAtCursorPagination(pagination.CursorPagination):
+    """ Pages through history newest first, continuing from the last row
+        seen instead of counting and offsetting.
+    """
+    ordering = '-created_at'
+
+
+class OptInFilter(filters.FilterSet):
+    """Filter for opt-ins, using ISO 8601 formatted dates"""
+    created_from = django_filters.IsoDateTimeFilter(name="created_at",
+                                                    lookup_type="gte")
+    created_to = django_filters.IsoDateTimeFilter(name="created_at",
+                                                  lookup_type="lte")
+
+    class Meta:
+        model = OptIn
+        fields = ['identity', 'address_type', 'address', 'request_source',
+                  'created_by']
+
+
+class OptInViewSet(mixins.CreateModelMixin, mixins.ListModelMixin,
+                   viewsets.GenericViewSet):
+    """ API endpoint that allows opt-ins to be created and listed.
+    """
+    permission_classes = (IsAuthenticated,)
+    read_from_replica = True
     queryset = OptIn.objects.all()
     serializer_class = OptInSerializer
+    filter_class = OptInFilter
+    pagination_class = CreatedAtCursorPagination
 
     def perform_create(self, serializer):
         data = serializer.validated_data
@@ -234,12 +417,29 @@ class OptInViewSet(mixins.CreateModelMixin, viewsets.GenericViewSet):
         return serializer.save(created_by=self.request.user)
 
 
-class OptOutViewSet(mixins.CreateModelMixin, viewsets.GenericViewSet):
-    """ API endpoint that allows optouts to be created.
+class OptOutFilter(filters.FilterSet):
+    """Filter for opt-outs, using ISO 8601 formatted dates"""
+    created_from = django_filters.IsoDateTimeFilter(name="created_at",
+                                                    lookup_type="gte")
+    created_to = django_filters.IsoDateTimeFilter(name="created_at",
+                                                  lookup_type="lte")
+
+    class Meta:
+        model = OptOut
+        fields = ['identity', 'optout_type', 'address_type', 'address',
+                  'request_source', 'created_by']
+
+
+class OptOutViewSet(mixins.CreateModelMixin, mixins.ListModelMixin,
+                    viewsets.GenericViewSet):
+    """ API endpoint that allows optouts to be created and listed.
     """
     permission_classes = (IsAuthenticated,)
+    read_from_replica = True
     queryset = OptOut.objects.all()
     serializer_class = OptOutSerializer
+    filter_class = OptOutFilter
+    pagination_class = CreatedAtCursorPagination
 
     def perform_create(self, serializer):
         data = serializer.validated_data
@@ -257,6 +457,81 @@ class OptOutViewSet(mixins.CreateModelMixin, viewsets.GenericViewSet):
         return serializer.save(created_by=self.request.user)
 
 
+class OptOutStatus(APIView):
+
+    """ Opt-out status of a batch of addresses
+        POST - takes {"addresses": [{"address_type": "msisdn",
+               "address": "+27123"}, ...]} and returns, in the same order,
+               whether each address is opted out and whether any identity
+               has it. Addresses are compared in their canonical form and
+               at most OPTOUT_STATUS_MAX_BATCH can be checked at a time.
+    """
+    permission_classes = (IsAuthenticated,)
+    read_from_replica = True
+    read_only_methods = ('POST',)
+
+    def get_addresses(self, data):
+        addresses = data.get('addresses') if isinstance(data, dict) else None
+        if not isinstance(addresses, list) or not addresses:
+            raise ValidationError({"addresses": [
+                "A list of addresses is required."]})
+        if len(addresses) > settings.OPTOUT_STATUS_MAX_BATCH:
+            raise ValidationError({"addresses": [
+                "At most %s addresses can be checked at a time." %
+                settings.OPTOUT_STATUS_MAX_BATCH]})
+        pairs = []
+        for entry in addresses:
+            if not isinstance(entry, dict) or not all(
+                    isinstance(entry.get(field), six.string_types) and
+                    entry[field] for field in ('address_type', 'address')):
+                raise ValidationError({"addresses": [
+                    "Each address needs an address_type and address."]})
+            pairs.append((entry['address_type'], entry['address']))
+        return pairs
+
+    def post(self, request, *args, **kwargs):
+        addresses = self.get_addresses(request.data)
+        statuses = IdentityAddress.objects.db_manager(
+            router.db_for_read(IdentityAddress)).optout_status(addresses)
+        results = []
+        for address_type, address in addresses:
+            optedout = statuses.get(
+                (address_type, normalize_address(address_type, address)))
+            results.append({
+                "address_type": address_type,
+                "address": address,
+                "optedout": bool(optedout),
+                "known": optedout is not None,
+            })
+        return Response({"results": results}, status=200)
+
+
+class OptOutBloomFilterView(APIView):
+
+    """ The latest Bloom filter of opted out addresses
+        GET - returns the filter in the format of identities.bloom, with its
+              hash as the ETag and its version in X-Filter-Version. Returns
+              304 Not Modified if the If-None-Match header has the ETag.
+    """
+    permission_classes = (IsAuthenticated,)
+    read_from_replica = True
+
+    def get(self, request, *args, **kwargs):
+        version = OptOutBloomFilter.objects.db_manager(
+            router.db_for_read(OptOutBloomFilter)).latest_version()
+        if version is None:
+            raise Http404
+        etag = '"%s"' % version.etag
+        if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+            response = HttpResponse(status=304)
+        else:
+            response = HttpResponse(
+                bytes(version.data), content_type='application/octet-stream')
+        response['ETag'] = etag
+        response['X-Filter-Version'] = version.id
+        return response
+
+
 class HookViewSet(viewsets.ModelViewSet):
     """ Retrieve, create, update or destroy webhooks.
     """
@@ -268,6 +543,21 @@ class HookViewSet(viewsets.ModelViewSet):
         serializer.save(user=self.request.user)
 
 
+class HookQueueView(APIView):
+
+    """ Webhook delivery queue depths
+        GET - returns the pending, due and failed deliveries per hook target
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, *args, **kwargs):
+        status = 200
+        resp = {
+            "queues": queue_depths()
+        }
+        return Response(resp, status=status)
+
+
 class MetricsView(APIView):
 
     """ Metrics Interaction
@@ -293,7 +583,8 @@ class MetricsView(APIView):
 class HealthcheckView(APIView):
 
     """ Healthcheck Interaction
-        GET - returns service up - getting auth'd requires DB
+        GET - returns service up - getting auth'd requires DB - and the
+              usage of this process's database connection pools
     """
     permission_classes = (IsAuthenticated,)
 
@@ -302,7 +593,8 @@ class HealthcheckView(APIView):
         resp = {
             "up": True,
             "result": {
-                "database": "Accessible"
+                "database": "Accessible",
+                "database_pools": pool_stats()
             }
         }
         return Response(resp, status=status)
@@ -322,3 +614,178 @@ class DetailKeyView(APIView):
             "key_names": key_names
         }
         return Response(resp, status=status)
+
+
+class DetailFacets(APIView):
+
+    """ Value counts for detail keys
+        GET - returns the number of identities with each value of the
+              comma separated detail `keys`, which must be in DetailKey.
+              Keys in FACETED_DETAIL_KEYS are read from maintained counts,
+              other keys are counted over all identities.
+    """
+    permission_classes = (IsAuthenticated,)
+    read_from_replica = True
+
+    def get(self, request, *args, **kwargs):
+        keys = [key for key in request.query_params.get(
+            'keys', '').split(',') if key]
+        if not keys:
+            raise ValidationError({"keys": ["This field is required."]})
+        known = set(DetailKey.objects.filter(
+            key_name__in=keys).values_list('key_name', flat=True))
+        unknown = [key for key in keys if key not in known]
+        if unknown:
+            raise ValidationError({"keys": [
+                "Unknown detail keys: %s" % ", ".join(unknown)]})
+
+        using = router.db_for_read(DetailFacetCount)
+        facets = {}
+        for key in keys:
+            if key in settings.FACETED_DETAIL_KEYS:
+                source = "counts"
+                counts = DetailFacetCount.objects.using(using).filter(
+                    key_name=key, count__gt=0).values_list('value', 'count')
+            else:
+                source = "query"
+                counts = query_facet(key, using)
+            facets[key] = {
+                "source": source,
+                "values": [
+                    {"value": value, "count": count}
+                    for value, count in sorted(
+                        counts, key=lambda c: (-c[1], c[0] or ''))]
+            }
+        return Response({"facets": facets}, status=200)
+
+
+class IdentityTraversal(APIView):
+
+    """ Base for views that follow the `via` link (communicate_through or
+        operator) between identities, up to `max_depth` hops.
+    """
+    permission_classes = (IsAuthenticated,)
+    read_from_replica = True
+
+    def get_traversal(self, request, identity_id):
+        try:
+            uuid.UUID(identity_id)
+        except ValueError:
+            raise Http404
+        via = request.query_params.get('via', 'communicate_through')
+        if via not in chains.LINKS:
+            raise ValidationError({"via": [
+                "Must be one of %s." % ", ".join(sorted(chains.LINKS))]})
+        max_depth = positive_int(
+            request.query_params, 'max_depth',
+            settings.IDENTITY_TRAVERSAL_MAX_DEPTH,
+            settings.IDENTITY_TRAVERSAL_MAX_DEPTH)
+        return via, max_depth
+
+    def serialize(self, request, rows, using):
+        identities = Identity.objects.using(using).in_bulk(
+            [identity_id for identity_id, depth in rows])
+        return [
+            {"depth": depth, "identity": IdentitySerializer(
+                identities[identity_id], context={'request': request}).data}
+            for identity_id, depth in rows if identity_id in identities]
+
+
+def positive_int(query_params, name, default, maximum):
+    try:
+        value = int(query_params.get(name, default))
+    except ValueError:
+        value = 0
+    if not 0 < value <= maximum:
+        raise ValidationError({name: [
+            "Must be a whole number from 1 to %s." % maximum]})
+    return value
+
+
+class IdentityChain(IdentityTraversal):
+
+    """ The identities an identity communicates through in turn
+        GET - returns the identity at depth 0 followed by the identity each
+              one links to. `complete` is false if the chain was cut off by
+              `max_depth` or a cycle.
+    """
+
+    def get(self, request, identity_id, *args, **kwargs):
+        via, max_depth = self.get_traversal(request, identity_id)
+        using = router.db_for_read(Identity)
+        rows, complete = chains.chain(identity_id, via, max_depth, using)
+        if not rows:
+            raise Http404
+        return Response({"complete": complete,
+                         "results": self.serialize(request, rows, using)})
+
+
+class IdentityDependents(IdentityTraversal):
+
+    """ The identities that communicate through an identity
+        GET - returns the identities linking to the identity directly
+              (depth 1) or through others, up to `max_depth`, ordered by
+              depth and id. Pages hold up to `limit` identities and `next`
+              continues after the last one.
+    """
+
+    def get(self, request, identity_id, *args, **kwargs):
+        via, max_depth = self.get_traversal(request, identity_id)
+        limit = positive_int(
+            request.query_params, 'limit',
+            settings.IDENTITY_DEPENDENTS_PAGE_SIZE,
+            settings.IDENTITY_DEPENDENTS_PAGE_SIZE)
+        after = None
+        if 'after' in request.query_params:
+            try:
+                depth, after_id = request.query_params['after'].split(':')
+                after = (int(depth), str(uuid.UUID(after_id)))
+            except ValueError:
+                raise ValidationError({"after": [
+                    "Must be a depth and identity id, as depth:id."]})
+
+        using = router.db_for_read(Identity)
+        if not Identity.objects.using(using).filter(id=identity_id).exists():
+            raise Http404
+        rows = chains.dependents(identity_id, via, max_depth, limit, after,
+                                 using)
+        next_url = None
+        if len(rows) == limit:
+            last_id, last_depth = rows[-1]
+            next_url = replace_query_param(
+                request.build_absolute_uri(), 'after',
+                '%s:%s' % (last_depth, last_id))
+        return Response({"next": next_url,
+                         "results": self.serialize(request, rows, using)})
+
+
+class ChangeFeed(APIView):
+
+    """ Changes to identities, opt-outs and opt-ins in the order they were
+        committed
+        GET - returns up to `limit` changes after the `since` cursor, or from
+              the start without one, each with the model, object id and
+              action. Continue from `next`, which stays the same while there
+              are no new changes. `more` is true if the limit was reached.
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, *args, **kwargs):
+        position = changes.START
+        if 'since' in request.query_params:
+            try:
+                position = changes.parse_cursor(
+                    request.query_params['since'])
+            except ValueError:
+                raise ValidationError({"since": [
+                    "Must be a cursor returned by this endpoint."]})
+        limit = positive_int(request.query_params, 'limit',
+                             settings.CHANGE_FEED_PAGE_SIZE,
+                             settings.CHANGE_FEED_PAGE_SIZE)
+
+        results = changes.changes_since(position, limit)
+        next_cursor = (results[-1]["cursor"] if results
+                       else changes.format_cursor(position))
+        return Response({"next": next_cursor,
+                         "more": len(results) == limit,
+                         "results": results})
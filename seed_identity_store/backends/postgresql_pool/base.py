@@ -0,0 +1,53 @@
+"""
+The Postgres backend with connections taken from a bounded per-process
+ConnectionPool instead of opened and closed by each request or task.
+"""
+import os
+
+from django.conf import settings
+from django.db.backends.postgresql import base
+
+from seed_identity_store.dbpool import get_pool
+
+# Connections inherited from a parent process. They're kept referenced so
+# that they're never closed here, which would close the parent's socket.
+_inherited = []
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    connection_pid = None
+    pool = None
+
+    def get_new_connection(self, conn_params):
+        self.pool = get_pool(
+            self.alias, lambda: base.Database.connect(**conn_params),
+            settings.DATABASE_POOL_SIZE, settings.DATABASE_POOL_TIMEOUT,
+            settings.DATABASE_POOL_CHECK_INTERVAL)
+        connection = self.pool.checkout()
+        self.connection_pid = os.getpid()
+
+        options = self.settings_dict['OPTIONS']
+        try:
+            self.isolation_level = options['isolation_level']
+        except KeyError:
+            self.isolation_level = connection.isolation_level
+        else:
+            if self.isolation_level != connection.isolation_level:
+                connection.set_session(isolation_level=self.isolation_level)
+        return connection
+
+    def ensure_connection(self):
+        if (self.connection is not None and
+                self.connection_pid != os.getpid()):
+            self.close()
+        super(DatabaseWrapper, self).ensure_connection()
+
+    def _close(self):
+        if self.connection is None:
+            return
+        if self.connection_pid != os.getpid():
+            _inherited.append(self.connection)
+            return
+        with self.wrap_database_errors:
+            self.pool.checkin(self.connection)
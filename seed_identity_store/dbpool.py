@@ -0,0 +1,155 @@
+"""
+A bounded pool of Postgres connections per database per process, used by
+the postgresql_pool database backend. Pools are keyed by process id so that
+processes forked by gunicorn --preload or the Celery prefork pool never
+share a connection with their parent.
+"""
+import os
+import threading
+import time
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+class ConnectionPool(object):
+
+    """ Hands out up to `size` connections made with `connect`. Checking
+        out waits up to `timeout` seconds for a connection to be checked in
+        once all of them are in use. Connections that have been idle for
+        more than `check_interval` seconds are checked with a query before
+        being handed out, and replaced if they fail.
+    """
+
+    def __init__(self, connect, size, timeout, check_interval=0):
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self.idle = []
+        self.in_use = 0
+        self.created = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.discarded = 0
+        self.condition = threading.Condition()
+
+    def healthy(self, connection, idle_since):
+        if connection.closed:
+            return False
+        if time.time() - idle_since < self.check_interval:
+            return True
+        try:
+            cursor = connection.cursor()
+            try:
+                cursor.execute("SELECT 1")
+            finally:
+                cursor.close()
+            connection.rollback()
+            return True
+        except Exception:
+            return False
+
+    def discard(self, connection):
+        self.discarded += 1
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def checkout(self):
+        with self.condition:
+            if self.in_use >= self.size:
+                self.waits += 1
+                deadline = time.time() + self.timeout
+                while self.in_use >= self.size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise PoolExhausted(
+                            "All %s connections are in use" % self.size)
+                    self.condition.wait(remaining)
+            self.in_use += 1
+            self.checkouts += 1
+
+        try:
+            while True:
+                with self.condition:
+                    if not self.idle:
+                        break
+                    connection, idle_since = self.idle.pop()
+                if self.healthy(connection, idle_since):
+                    return connection
+                with self.condition:
+                    self.discard(connection)
+            connection = self.connect()
+            with self.condition:
+                self.created += 1
+            return connection
+        except Exception:
+            self.release()
+            raise
+
+    def release(self):
+        with self.condition:
+            self.in_use -= 1
+            self.condition.notify()
+
+    def checkin(self, connection):
+        """
+        Returns a connection to the pool, rolling back any transaction and
+        resetting the session. Connections that can't be reset are closed.
+        """
+        usable = not connection.closed
+        if usable:
+            try:
+                connection.reset()
+                connection.autocommit = False
+            except Exception:
+                usable = False
+        with self.condition:
+            if usable:
+                self.idle.append((connection, time.time()))
+            else:
+                self.discard(connection)
+        self.release()
+
+    def stats(self):
+        with self.condition:
+            return {
+                "size": self.size,
+                "in_use": self.in_use,
+                "idle": len(self.idle),
+                "created": self.created,
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "discarded": self.discarded,
+            }
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, connect, size, timeout, check_interval=0):
+    """
+    The pool for a database alias in the current process, created with the
+    given arguments if there isn't one yet.
+    """
+    key = (alias, os.getpid())
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(connect, size, timeout,
+                                         check_interval)
+        return _pools[key]
+
+
+def pool_stats():
+    """
+    Usage of the current process's connection pools by database alias.
+    """
+    pid = os.getpid()
+    with _pools_lock:
+        pools = [(alias, pool) for (alias, key_pid), pool in _pools.items()
+                 if key_pid == pid]
+    return dict((alias, pool.stats()) for alias, pool in pools)
@@ -0,0 +1,90 @@
+"""
+Routes the reads of views marked as safe for replicas to the databases in
+REPLICA_DATABASES, skipping replicas that lag more than REPLICA_MAX_LAG
+seconds behind the primary. Everything else goes to the default database.
+"""
+import random
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DatabaseError, connections
+
+
+_state = threading.local()
+
+LAG_SQL = """
+SELECT CASE WHEN pg_is_in_recovery() THEN
+    COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+ELSE 0 END
+"""
+
+
+def replica_lag(alias):
+    """
+    Seconds the replica is behind the primary, or None if it can't be
+    reached. Cached for REPLICA_LAG_CHECK_INTERVAL seconds.
+    """
+    key = 'replica-lag:%s' % alias
+    lag = cache.get(key)
+    if lag is None:
+        try:
+            with connections[alias].cursor() as cursor:
+                cursor.execute(LAG_SQL)
+                lag = float(cursor.fetchone()[0])
+        except DatabaseError:
+            lag = -1
+        cache.set(key, lag, settings.REPLICA_LAG_CHECK_INTERVAL)
+    return lag if lag >= 0 else None
+
+
+def choose_replica():
+    """
+    A random replica that is up to date enough to read from, or None.
+    """
+    replicas = [
+        alias for alias in settings.REPLICA_DATABASES
+        if replica_lag(alias) is not None and
+        replica_lag(alias) <= settings.REPLICA_MAX_LAG]
+    if not replicas:
+        return None
+    return random.choice(replicas)
+
+
+def reading_from_replica():
+    return getattr(_state, 'replica', False)
+
+
+@contextmanager
+def use_replica():
+    """
+    Sends the reads made in the block by this thread to a replica.
+    """
+    previous = reading_from_replica()
+    _state.replica = True
+    try:
+        yield
+    finally:
+        _state.replica = previous
+
+
+class ReplicaRouter(object):
+
+    """ Sends reads to a replica inside use_replica() and everything else to
+        the default database.
+    """
+
+    def db_for_read(self, model, **hints):
+        if reading_from_replica():
+            return choose_replica()
+        return None
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == 'default'
@@ -8,8 +8,10 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/1.9/ref/settings/
 """
 
+from datetime import timedelta
 from kombu import Exchange, Queue
 
+import json
 import os
 import djcelery
 import dj_database_url
@@ -62,6 +64,8 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'identities.middleware.RequestCaptureMiddleware',
+    'identities.middleware.ReplicaRoutingMiddleware',
 )
 
 ROOT_URLCONF = 'seed_identity_store.urls'
@@ -79,6 +83,35 @@ DATABASES = {
             'postgres://postgres:@localhost/seed_identity_store')),
 }
 
+# Read replicas for the reporting reads, as a comma separated list of
+# database URLs
+REPLICA_DATABASES = []
+for i, url in enumerate(filter(None, os.environ.get(
+        'REPLICA_DATABASE_URLS', '').split(','))):
+    alias = 'replica%d' % (i + 1)
+    DATABASES[alias] = dj_database_url.parse(url.strip())
+    DATABASES[alias]['TEST'] = {'MIRROR': 'default'}
+    REPLICA_DATABASES.append(alias)
+
+DATABASE_ROUTERS = ['seed_identity_store.routers.ReplicaRouter']
+REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG', 10))
+REPLICA_LAG_CHECK_INTERVAL = int(
+    os.environ.get('REPLICA_LAG_CHECK_INTERVAL', 5))
+REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS', 15))
+
+# Keep connections open between requests and tasks, or with DATABASE_POOL
+# take them from a bounded pool per process
+DATABASE_POOL = os.environ.get('DATABASE_POOL', 'false').lower() == 'true'
+DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE', 10))
+DATABASE_POOL_TIMEOUT = float(os.environ.get('DATABASE_POOL_TIMEOUT', 10))
+DATABASE_POOL_CHECK_INTERVAL = float(
+    os.environ.get('DATABASE_POOL_CHECK_INTERVAL', 5))
+for database in DATABASES.values():
+    database['CONN_MAX_AGE'] = int(
+        os.environ.get('DATABASE_CONN_MAX_AGE', 0 if DATABASE_POOL else 60))
+    if DATABASE_POOL:
+        database['ENGINE'] = 'seed_identity_store.backends.postgresql_pool'
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/1.9/topics/i18n/
@@ -139,9 +172,35 @@ HOOK_EVENTS = {
     'identity.created': 'identities.Identity.created+'
 }
 
-HOOK_DELIVERER = 'identities.tasks.deliver_hook_wrapper'
+# 'identities.tasks.queue_hook_delivery' hands deliveries to the concurrent
+# worker started with `manage.py deliver_hooks` instead of Celery
+HOOK_DELIVERER = os.environ.get(
+    'HOOK_DELIVERER', 'identities.tasks.deliver_hook_wrapper')
 
 HOOK_AUTH_TOKEN = os.environ.get('HOOK_AUTH_TOKEN', 'REPLACEME')
+HOOK_TIMEOUT = int(os.environ.get('HOOK_TIMEOUT', 30))
+
+# Deliver each opt-out and opt-in event to all its hooks from one task
+HOOK_FANOUT = os.environ.get('HOOK_FANOUT', 'false').lower() == 'true'
+HOOK_FANOUT_CONCURRENCY = int(os.environ.get('HOOK_FANOUT_CONCURRENCY', 20))
+
+# Failed deliveries are retried after HOOK_RETRY_BACKOFF seconds, doubling
+# up to HOOK_RETRY_BACKOFF_MAX, and then stored as FailedHookDelivery
+HOOK_MAX_RETRIES = int(os.environ.get('HOOK_MAX_RETRIES', 8))
+HOOK_RETRY_BACKOFF = int(os.environ.get('HOOK_RETRY_BACKOFF', 10))
+HOOK_RETRY_BACKOFF_MAX = int(os.environ.get('HOOK_RETRY_BACKOFF_MAX', 3600))
+# Deliveries to a target fail fast for HOOK_BREAKER_COOLDOWN seconds after
+# HOOK_BREAKER_THRESHOLD consecutive failures
+HOOK_BREAKER_THRESHOLD = int(os.environ.get('HOOK_BREAKER_THRESHOLD', 5))
+HOOK_BREAKER_COOLDOWN = int(os.environ.get('HOOK_BREAKER_COOLDOWN', 60))
+
+HOOK_WORKER_CONCURRENCY = int(os.environ.get('HOOK_WORKER_CONCURRENCY', 200))
+# The worker shares deliveries between targets round-robin, with an optional
+# JSON object of {target: weight} and a cap on deliveries in flight per target
+HOOK_TARGET_WEIGHTS = json.loads(os.environ.get('HOOK_TARGET_WEIGHTS', '{}'))
+HOOK_TARGET_CONCURRENCY = int(os.environ.get('HOOK_TARGET_CONCURRENCY', 20))
+HOOK_WORKER_BATCH_SIZE = int(os.environ.get('HOOK_WORKER_BATCH_SIZE', 500))
+HOOK_WORKER_LEASE = int(os.environ.get('HOOK_WORKER_LEASE', 60))
 
 # Celery configuration options
 CELERY_RESULT_BACKEND = 'djcelery.backends.database:DatabaseBackend'
@@ -182,11 +241,22 @@ CELERY_ROUTES = {
     },
     'identities.tasks.populate_detail_key': {
         'queue': 'priority'
-    }
+    },
+    'seed_identity_store.identities.tasks.fan_out_hook_event': {
+        'queue': 'priority'
+    },
+    'seed_identity_store.identities.tasks.rebuild_optout_filter': {
+        'queue': 'mediumpriority'
+    },
+    'seed_identity_store.identities.tasks.prune_changes': {
+        'queue': 'mediumpriority'
+    },
 }
 
 METRICS_REALTIME = [
-    'identities.created.sum'
+    'identities.created.sum',
+    'identities.query.rejected.sum',
+    'identities.query.downgraded.sum',
 ]
 METRICS_SCHEDULED = [
     'identities.created.last'
@@ -195,6 +265,42 @@ METRICS_SCHEDULED_TASKS = [
     'fire_created_last'
 ]
 
+# Publish signal-triggered tasks through the transactional outbox
+OUTBOX_ENABLED = os.environ.get('OUTBOX_ENABLED', 'false').lower() == 'true'
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', 500))
+
+# Hold events for hooks with a coalesce window. When off, hooks are
+# delivered at once whatever their window.
+HOOK_COALESCING_ENABLED = os.environ.get(
+    'HOOK_COALESCING_ENABLED', 'false').lower() == 'true'
+
+CELERYBEAT_SCHEDULE = {
+    'prune-changes': {
+        'task': 'seed_identity_store.identities.tasks.prune_changes',
+        'schedule': timedelta(hours=1),
+    },
+    'rebuild-optout-filter': {
+        'task': 'seed_identity_store.identities.tasks.rebuild_optout_filter',
+        'schedule': timedelta(
+            seconds=int(os.environ.get('OPTOUT_FILTER_REBUILD_INTERVAL',
+                                       300))),
+    },
+}
+
+if HOOK_COALESCING_ENABLED:
+    CELERYBEAT_SCHEDULE['flush-coalesced-hook-events'] = {
+        'task': 'seed_identity_store.identities.tasks.flush_coalesced_events',
+        'schedule': timedelta(
+            seconds=int(os.environ.get('HOOK_COALESCE_FLUSH_INTERVAL', 1))),
+    }
+
+if OUTBOX_ENABLED:
+    CELERYBEAT_SCHEDULE['relay-outbox'] = {
+        'task': 'seed_identity_store.identities.tasks.relay_outbox',
+        'schedule': timedelta(
+            seconds=int(os.environ.get('OUTBOX_RELAY_INTERVAL', 1))),
+    }
+
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_ACCEPT_CONTENT = ['json']
@@ -204,3 +310,76 @@ djcelery.setup_loader()
 
 METRICS_URL = os.environ.get("METRICS_URL", None)
 METRICS_AUTH_TOKEN = os.environ.get("METRICS_AUTH_TOKEN", "REPLACEME")
+
+# Number of addresses read at a time by the contactable addresses endpoint
+CONTACTABLE_CHUNK_SIZE = int(os.environ.get('CONTACTABLE_CHUNK_SIZE', 1000))
+
+# Percentage of identities sampled for approximate counts
+COUNT_SAMPLE_PERCENT = float(os.environ.get('COUNT_SAMPLE_PERCENT', 1))
+
+# Top-level detail keys whose value counts are kept up to date for facets
+FACETED_DETAIL_KEYS = [
+    key.strip() for key in os.environ.get(
+        'FACETED_DETAIL_KEYS',
+        'preferred_language,default_addr_type').split(',') if key.strip()]
+
+# Detail keys to index, as JSON mapping keys to "text", "numeric" or "date".
+# Create the indexes with `manage.py sync_detail_indexes`.
+INDEXED_DETAIL_KEYS = json.loads(
+    os.environ.get('INDEXED_DETAIL_KEYS', '{}'))
+
+# Deepest communicate_through or operator chain followed by the chain and
+# dependents endpoints, and the most dependents returned per page
+IDENTITY_TRAVERSAL_MAX_DEPTH = int(
+    os.environ.get('IDENTITY_TRAVERSAL_MAX_DEPTH', 10))
+IDENTITY_DEPENDENTS_PAGE_SIZE = int(
+    os.environ.get('IDENTITY_DEPENDENTS_PAGE_SIZE', 1000))
+
+# Most addresses checked by one request to the opt-out status endpoint
+OPTOUT_STATUS_MAX_BATCH = int(os.environ.get('OPTOUT_STATUS_MAX_BATCH', 1000))
+
+# False positive rate of the Bloom filter of opted out addresses, and the
+# number of its versions kept
+OPTOUT_FILTER_ERROR_RATE = float(
+    os.environ.get('OPTOUT_FILTER_ERROR_RATE', 0.001))
+OPTOUT_FILTER_VERSIONS = int(os.environ.get('OPTOUT_FILTER_VERSIONS', 3))
+
+# Most changes returned per request by the change feed, and the number of
+# days changes are kept for
+CHANGE_FEED_PAGE_SIZE = int(os.environ.get('CHANGE_FEED_PAGE_SIZE', 1000))
+CHANGE_RETENTION_DAYS = int(os.environ.get('CHANGE_RETENTION_DAYS', 30))
+
+# Country code given to national msisdns (starting with 0) when they are
+# normalized for lookups. Leave empty to only normalize international ones.
+MSISDN_DEFAULT_COUNTRY_CODE = os.environ.get(
+    'MSISDN_DEFAULT_COUNTRY_CODE', '27')
+
+# Address types offered by the admin's address type filter and searched by
+# its address searches
+ADDRESS_TYPES = [
+    address_type.strip() for address_type in os.environ.get(
+        'ADDRESS_TYPES', 'msisdn,email').split(',') if address_type.strip()]
+
+# Admin changelists estimated to hold more rows than this show the planner's
+# estimate instead of an exact count
+ADMIN_EXACT_COUNT_LIMIT = int(os.environ.get('ADMIN_EXACT_COUNT_LIMIT',
+                                             10000))
+
+# Guards on search and filter queries. Queries are cancelled after
+# QUERY_STATEMENT_TIMEOUT milliseconds (0 for no timeout). Queries the
+# planner estimates to cost more than QUERY_MAX_COST (0 for no limit) are
+# rejected, or sent to a replica if QUERY_OVER_COST is "replica".
+# QUERY_GUARDS overrides these per endpoint, as JSON such as
+# {"identity-search": {"max_cost": 100000, "timeout": 5000}}. The endpoints
+# are "identity-list", "identity-search" and "identity-count".
+QUERY_STATEMENT_TIMEOUT = int(
+    os.environ.get('QUERY_STATEMENT_TIMEOUT', 30000))
+QUERY_MAX_COST = float(os.environ.get('QUERY_MAX_COST', 0))
+QUERY_OVER_COST = os.environ.get('QUERY_OVER_COST', 'reject')
+QUERY_GUARDS = json.loads(os.environ.get('QUERY_GUARDS', '{}'))
+
+# Opt-in capture of sampled API requests for offline replay
+REQUEST_CAPTURE_FILE = os.environ.get("REQUEST_CAPTURE_FILE", None)
+REQUEST_CAPTURE_SAMPLE_RATE = float(
+    os.environ.get("REQUEST_CAPTURE_SAMPLE_RATE", 0.01))
+REQUEST_CAPTURE_REDACT = ['password', 'token', 'auth_token', 'secret']